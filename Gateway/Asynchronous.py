@@ -1,129 +1,118 @@
 #! /usr/bin/python
 
-import math
-import json
-import serial
-import httplib, urllib
-import os.path
+# Local consumer for the XBee coordinators: decodes, calibrates and logs every received frame and keeps
+# it in an in-memory history, without uploading anything (ZigB2Netv5.3.py is the gateway that uploads).
+# usage: python Asynchronous.py [/dev/ttyUSB0 | replay:capture.jsonl@10 | pty:capture.jsonl@10 ...]
+
 import time
 import Queue
-import csv
-from xbee import ZigBee
-from collections import defaultdict
+import sys
+import signal
+import logging
+import threading
 
-import packethandler
 import calibration
+import schemas
+import framesource
+import dedup
+import history
+import gatewaylog
+import metrics
 
 PORT = '/dev/ttyAMA0'
 BAUD_RATE = 9600
+FRAME_SOURCES = sys.argv[1:] or [PORT]    #one per XBee coordinator, or replay:capture.jsonl@speed / pty:capture.jsonl@speed - see framesource.py
+LOG_LEVEL = logging.INFO    #INFO shows each calibrated reading, DEBUG adds queue timings
+METRICS_ADDRESS = ('127.0.0.1', 9108)    #Prometheus endpoint at http://<address>/metrics, None = off
 
-packetQueue = Queue.Queue()
+log = logging.getLogger("asynchronous")
 
-##Thingspeak interface constants
-user_ID = 'cundall'         #User ID used to create Thingspeak account - VITAL
-user_key = ''      #write API key - found at https://thingspeak.com/account, allows read & write operations - VITAL
-
-field1name = 'Dry Bulb Temperature - *C'
-field2name = 'Relative Humidity - %'
-field3name = 'Illuminance - Lux'
-field4name = 'TVOC - ug/m3'
-field5name = 'PM2.5 - ug/m3'
-field6name = 'PM10 - ug/m3'
-field7name = 'CO2 - ppm'
-field8name = 'NO2 - ppm'
-
-headers = {"Content-type": "application/x-www-form-urlencoded","Accept": "text/plain"}  
-conn = httplib.HTTPConnection("api.thingspeak.com:80")    
-
-#Regressed sensitivity curve constants for Rs/Ro to ppm from sensor manufacturer's datasheet.
-#C7H8Curve = [37.22590719,2.078062258]                      
-#H2S_Curve = [0.05566582614,-2.954075758]                   
-#C2H5OH_Curve = [0.5409499131,-2.312489623]                  
-NH3_Curve = [1052.3,-3377.3,4031.2,-2103.9,374.82,22.863]   
-NH3_MMass = 17.03 #(g/mol)
-Mvolume = 22.414
-
-#global variables with initial values
-CO2 = 400
-floatHum = 50
-floatTemp = 20.0
-floatTVOC = 0
-hum = 50
-intCO2 = 400
-intLight = 0
-intNO2 = 0
-intPM10 = 0
-intPM2_5 = 0
-light = 0
-PM10 = 0
-PM2_5 = 0
-temp = 20.0
-tvoc = 0.9
-
-# Open serial port
-xbeeSerial = serial.Serial(PORT, BAUD_RATE)
-
-# read calibration files
-Calib_CSV=csv.DictReader(open('Calib_CSV.csv','rb'))
-
-#receives packet data and places it into the queue
-def packet_received(data):
-    packetQueue.put(data, block = False)
-
-# Create API object, which spawns a new thread
-xbee = ZigBee(xbeeSerial, callback=packet_received)
-
-# main thread
-xbeeSerial.flushInput()            #clear serial buffer
-
-while True:
+packetQueue = Queue.Queue()
+duplicates = dedup.DuplicateFilter()    #drops XBee retransmissions of a frame already received
+
+#recent calibrated readings per Qube - history.History.latest(source) / recent(source, minutes)
+recentReadings = history.History()
+
+# load calibration coefficients (re-read automatically if the file changes)
+Calib_CSV=calibration.CalibrationStore('Calib_CSV.csv')
+
+#receives packet data from port and places it into the queue, stamped with its arrival time - retransmitted copies are dropped
+def packet_received(port, data):
+    received = time.time()
+    if duplicates.check(data, received):
+        metrics.FRAMES_DROPPED.inc('duplicate')
+        metrics.PORT_LOST.inc(port, 'duplicate')
+        return
+    packetQueue.put((received, data), block = False)
+
+#decodes, calibrates, logs and keeps a single packet
+def processPacket(newPacket, received=None):
+    start = time.time()
+    source = newPacket['source_addr_long'].encode('hex')
+    incoming = newPacket['rf_data']
+    schema = schemas.lookup(incoming)
+    if schema is None:
+        metrics.FRAMES_DROPPED.inc('unknown_type')
+        log.warning("unhandled sensor type from %s: %r", source, incoming)
+        return
+    metrics.FRAMES.inc(schema.typeid)
+    reading = schema.decode(incoming)
+    start = metrics.STAGE_SECONDS.since(start, 'decode')
+    reading = schema.calibrate(Calib_CSV, source, reading)
+    metrics.STAGE_SECONDS.since(start, 'calibrate')
+    recentReadings.record(source, schema, reading, received)
+    log.info("%s %s: %r", schema.description, source, reading)
+
+#consumer thread - blocks on the queue until the XBee callback delivers a packet,
+#then drains everything that arrived meanwhile as one batch. None stops the thread
+def consumer():
+    while True:
+        batch = [packetQueue.get()]
+        while True:
+            try:
+                batch.append(packetQueue.get_nowait())
+            except Queue.Empty:
+                break
+        for item in batch:
+            if item is None:
+                return
+            received, newPacket = item
+            log.debug("packet received, waited %.1f ms", (time.time() - received) * 1000.0)
+            metrics.STAGE_SECONDS.since(received, 'queue')
+            try:
+                processPacket(newPacket, received)
+            except Exception:
+                metrics.FRAMES_DROPPED.inc('error')
+                log.exception("failed to process packet %r", newPacket)
+        log.debug("batch of %d packets done, queue length is now %d", len(batch), packetQueue.qsize())
+
+#SIGTERM (kill, systemctl stop) shuts down the same way as Ctrl-C
+def terminate(signum, frame):
+    raise KeyboardInterrupt
+signal.signal(signal.SIGTERM, terminate)
+gatewaylog.setup(LOG_LEVEL)
+gatewaylog.installSignals()
+metrics.QUEUE_DEPTH.track(packetQueue.qsize)
+if METRICS_ADDRESS:
+    metrics.serve(METRICS_ADDRESS)
+
+# Open the frame sources (serial ports flushed once on open) - each one's reader thread calls packet_received
+frameSources = framesource.openSources(FRAME_SOURCES, BAUD_RATE)
+for frameSource in frameSources:    #one reader thread per port, all feeding packetQueue
+    frameSource.start(lambda data, port=frameSource.name: packet_received(port, data))
+
+consumerThread = threading.Thread(target=consumer)
+consumerThread.daemon = True
+consumerThread.start()
+
+# sleep until interrupted - all work happens on the reader and consumer threads
+while consumerThread.is_alive():
     try:
-        time.sleep(0.1)
-        if packetQueue.qsize() > 0:
-            newPacket = packetQueue.get_nowait()
-            print 'Packet received'
-            print 'queue length is now', packetQueue.qsize()
-            source = newPacket['source_addr_long'].encode('hex')
-            incoming = newPacket['rf_data']
-            Calib_CSV=csv.DictReader(open('Calib_CSV.csv','rb'))
-            if incoming[0] == "0":	#PM+VOC Qube
-                sensortype = 0
-                stamp,floatTVOC,PM2_5,PM10 = packethandler.unpacket(incoming, sensortype)
-                calibTVOC,calibPM2_5,calibPM10 = calibration.calibrate_0(Calib_CSV,source,sensortype,floatTVOC,PM2_5,PM10)
-                print stamp,calibTVOC,calibPM2_5,calibPM10                
-                print " " 
-            elif incoming[0] == "1":	#Temp+Hum+Lux Qube
-                sensortype = 1
-                stamp,floatHum,floatTemp,intLight = packethandler.unpacket(incoming, sensortype)
-                calibTemp,calibHum,calibLight = calibration.calibrate_1(Calib_CSV,source,sensortype,floatTemp,floatHum,intLight)
-                print stamp,calibTemp,calibHum,calibLight
-                print " " 
-            elif incoming[0] == "2":	#Temp,Hum,Lux,CO2 Qube
-                sensortype = 2
-                print "THLCO2 Qube - doesn't exist yet!"
-                print " " 
-            elif incoming[0] == "3":	#CO2 Qube
-                sensortype = 3
-                stamp,CO2 = packethandler.unpacket(incoming,sensortype)
-                calibCO2 = calibration.calibrate_3(Calib_CSV,source,sensortype,CO2)
-                print stamp, calibCO2
-                print " " 
-            elif incoming[0] == "4":	#PM,VOC,CO2 Qube
-                sensortype = 4
-                stamp,floatTVOC,intPM2_5,intPM10,intCO2 = packethandler.unpacket(incoming,sensortype)
-                calibTVOC,calibPM2_5,calibPM10,calibCO2 = calibration.calibrate_4(Calib_CSV,source,sensortype,floatTVOC,intPM2_5,intPM10,intCO2)
-                print stamp,calibTVOC,calibPM2_5,calibPM10,calibCO2
-                print " " 
-            elif incoming[0] == "5":	#NO2,Temp,Hum Qube
-                sensortype = 5
-                stamp,intNO2,floatTemp,floatHum = packethandler.unpacket(incoming,sensortype)
-                calibNO2,calibTemp,calibHum = calibration.calibrate_5(Calib_CSV,source,sensortype,intNO2,floatTemp,floatHum)
-                print stamp,calibNO2,calibTemp,calibHum
-                print " " 
-
+        signal.pause()
     except KeyboardInterrupt:
         break
 
-# halt() must be called before closing the serial port to ensure proper thread shutdown
-xbee.halt()
-xbeeSerial.close()
+packetQueue.put(None)
+consumerThread.join(5)
+for frameSource in frameSources:
+    frameSource.close()
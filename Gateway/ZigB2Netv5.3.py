@@ -13,554 +13,505 @@
 
 import math
 import json
-import serial
-import httplib, urllib
+import urllib
 import os.path
 import time
 import Queue
-import csv
-from xbee import ZigBee
+import sys
+import signal
+import threading
 from collections import defaultdict
 
+import calibration
+import bulkupload
+import scheduler
+import aggregate
+import connpool
+import spool
+import keystore
+import channels
+import schemas
+import logging
+import gatewaylog
+import metrics
+import framesource
+import dedup
+import history
+import readapi
+import sinks
+
+startTime = time.time()    #for time-to-first-frame reporting
+
 #constants
 
-zbport = serial.Serial("/dev/ttyAMA0", baudrate=9600, timeout=1.0)    #Open serial port connected to XBEE
-zb = ZigBee(zbport)    #instantiate a Zigbee on the port above
+SERIAL_PORT = "/dev/ttyAMA0"    #serial port connected to XBEE - opened when the main routine starts
+BAUD_RATE = 9600
+FRAME_SOURCES = sys.argv[1:] or [SERIAL_PORT]    #one per XBee coordinator, e.g. /dev/ttyAMA0 /dev/ttyUSB0, or replay:capture.jsonl@speed / pty:capture.jsonl@speed - see framesource.py
+FRAME_CAPTURE = None    #file to record every received frame to, for replaying later (None = don't record)
+DEDUP_WINDOW = dedup.WINDOW    #seconds within which a repeated payload from the same Qube is a retransmission and dropped (None = keep all)
+LOG_LEVEL = logging.INFO     #console log level - DEBUG shows every frame (SIGUSR1 toggles it at run time)
+RING_LEVEL = gatewaylog.RING_LEVEL    #level kept in memory and dumped when an error is logged (SIGUSR2 dumps it) - DEBUG, rate-limited
+METRICS_ADDRESS = ('127.0.0.1', 9108)    #Prometheus endpoint at http://<address>/metrics - '' instead of 127.0.0.1 to scrape from other machines, None = off
+log = logging.getLogger("gateway")
+if __name__ == '__main__':    #a script importing the gateway (bench_gateway.py) configures logging itself
+    gatewaylog.setup(LOG_LEVEL, RING_LEVEL)
+UPLOAD_WORKERS = 4         #threads decoding, calibrating and uploading received frames
+FRAME_QUEUE_SIZE = 1000    #frames waiting for a worker before new ones are dropped
+SHUTDOWN_TIMEOUT = 10.0    #seconds the workers get at shutdown to process the frames still queued
+frameQueue = Queue.Queue(FRAME_QUEUE_SIZE)    #frames handed from the serial reader thread to the workers
+duplicates = dedup.DuplicateFilter(DEDUP_WINDOW) if DEDUP_WINDOW else None
+registryLock = threading.Lock()    #serialises channel/key resolution across workers so a new sensor only gets one channel
 user_ID = 'cundall'         #User ID used to create Thingspeak account - VITAL
 user_key = 'P13RYTD0TZ2RVA1P'      #write API key - found at https://thingspeak.com/account, allows read & write operations - VITAL
-field1name = 'Dry Bulb Temperature - *C'
-field2name = 'Relative Humidity - %'
-field3name = 'Illuminance - Lux'
-field4name = 'TVOC - ug/m3'
-field5name = 'PM2.5 - ug/m3'
-field6name = 'PM10 - ug/m3'
-field7name = 'CO2 - ppm'
-field8name = 'NO2 - ppm'
 headers = {"Content-type": "application/x-www-form-urlencoded","Accept": "text/plain"}  #standard headers for all Thspeak communications
-conn = httplib.HTTPConnection("api.thingspeak.com:80")    #standard conn to main Thspeak server - update for personal server
-
-#Regressed sensitivity curves constants for Rs/Ro to ppm from sensor manufacturer's datasheet
-
-#C7H8Curve = [37.22590719,2.078062258]                   	#TGS2602 (0.3;1)( 0.8;10) (0.4;30)
-#H2S_Curve = [0.05566582614,-2.954075758]        		#TGS2602 (0.8,0.1) (0.4,1) (0.25,3)
-#C2H5OH_Curve = [0.5409499131,-2.312489623]      		#TGS2602 (0.75,1) (0.3,10) (0.17,30)  
-NH3_Curve = [1052.3,-3377.3,4031.2,-2103.9,374.82,22.863]	#Ammonia sensitivity curve 
-NH3_MMass = 17.03 #(g/mol)
-Mvolume = 22.414
-
-#global variables with initial values
-
-hum = 50
-temp = 20.0
-light = 0
-RsRo = 1.00
-tvoc = 0.9
-CO2 = 400
-PM2_5 = 0
-PM10 = 0
-intPM10 = 0
-intPM2_5 = 0
-intCO2 = 400
-intLight = 0
-floatTVOC = 0
-floatHum = 50
-floatTemp = 20.0
-intNO2 = 0
-
-#creates a timestamp for log purposes only - NEED TO UPDATE TO SEND TIMESTAMP TO THINGSPEAK WITH DATA
-
-def timestamp():
-    stamp = time.strftime("%a, %d %b %Y %H:%M:%S ",time.localtime(time.time()))
-    return stamp
-
-#calculates VOC concentration based on RsRo ratio - see TGS2602 datasheet for details
-
-def TVOCcalc(RsRo):
-    x = float(RsRo)
-    tvoc = ((NH3_Curve[0]*pow(x,5))+(NH3_Curve[1]*pow(x,4))+(NH3_Curve[2]*pow(x,3))+(NH3_Curve[3]*pow(x,2)+NH3_Curve[4]*x)+NH3_Curve[5])
-    if tvoc < 0:
-    	tvoc = 0
-        print "Rs/Ro= ",RsRo
-    	print "= ",tvoc, "ppm"
-        conc = 0.00
-    else:
-        #concentration(mg/m3) = concentration(ppm) X ( molar mass(g/mol) / molar volume(L) )
-        print "Rs/Ro= ",RsRo
-    	print "= ",tvoc, "ppm"
-        conc = round(tvoc*(NH3_MMass/Mvolume),2)
-        print "= ",conc,"mg/m^3"
-    return conc
+THINGSPEAK_HOST = "api.thingspeak.com:80"    #main Thspeak server - update for personal server (or see configure())
+conn = connpool.ConnectionPool(THINGSPEAK_HOST, size=4)    #keep-alive connections to the Thspeak server
+BULK_UPLOAD = True    #buffer readings per channel and send them with Thingspeak's bulk update endpoint
+BULK_SIZE = 20        #readings per channel that trigger a bulk update
+BULK_AGE = 120.0      #maximum seconds a reading waits in the buffer
+UPDATE_INTERVAL = scheduler.UPDATE_INTERVAL    #seconds between updates (single or bulk) of one channel - Thingspeak's rate limit
+UPDATE_CONCURRENCY = 2    #updates (single or bulk) in flight at once
+channelLimits = scheduler.RateLimiter(UPDATE_INTERVAL, concurrency=UPDATE_CONCURRENCY)    #shared by every upload path
+uploadBuffer = bulkupload.UploadBuffer(conn, max_size=BULK_SIZE, max_age=BULK_AGE, limiter=channelLimits)
+CHANNEL_MISS_TTL = 600.0          #seconds a sensor missing from the channel list is remembered as missing
+CHANNEL_REFRESH_INTERVAL = 60.0   #minimum seconds between channel list downloads
+KEY_WRITE_DELAY = 5.0        #seconds to gather write key changes before saving writeKeys.json
+SPOOL_PATH = 'spool.db'       #on-disk store-and-forward spool - every reading is written here first (None = upload directly)
+SPOOL_MAX_ROWS = 500000       #oldest readings are discarded beyond this (~2 days for 84 Qubes at 30 s, ~50 MB)
+MQTT_BROKER = None         #(host, port) of an MQTT broker to publish every reading to, e.g. ('localhost', 1883) - needs paho-mqtt
+FILE_SINK_FOLDER = None    #folder for hourly gzip CSV files of every reading, e.g. 'readings' (None = off)
+AGGREGATE_WINDOWS = aggregate.WINDOWS    #seconds of readings per upload by sensor type, e.g. {"1": 300} - None = upload every reading
+calibStore = calibration.CalibrationStore('Calib_CSV.csv')    #calibration coefficients indexed by serial number, reloaded when the file changes
+HISTORY_SIZE = history.CAPACITY    #calibrated readings kept in memory per Qube for local queries (None = keep none)
+recentReadings = history.History(HISTORY_SIZE) if HISTORY_SIZE else None
+READ_API_ADDRESS = ('127.0.0.1', 9109)    #JSON API with the latest readings at http://<address>/latest - '' instead of 127.0.0.1 for dashboards on other machines, None = off
 
 #defines parameters to use to create new channels, based on sensor type
 
 def newchannelParams(sensorID,sensortype):
-    try:
-        if sensortype == "0": #TVOC,PM2.5,PM10
-            print "TVOC, PM2.5, PM10 Sensor"
-            params = urllib.urlencode({'name': sensorID,'field1': field4name, 'field2':field5name, 'field3':field6name, 'api_key':user_key})
-            return params
-        elif sensortype == "1": #Temp,Hum,Lux sensor
-            print "New Temp, Hum, Lux Sensor"
-            params = urllib.urlencode({'name': sensorID,'field1': field1name, 'field2':field2name, 'field3':field3name, 'api_key':user_key})
-            return params
-        elif sensortype == "2": #TVOC,Lux sensor
-            print "New TVOC, Lux Sensor"
-            params = urllib.urlencode({'name': sensorID,'field1': field4name, 'field2':field3name, 'api_key':user_key})
-            return params
-        elif sensortype == "3": #CO2 Sensor
-            print "New CO2 Sensor"
-            params = urllib.urlencode({'name': sensorID,'field1': field7name, 'api_key':user_key})
-            return params
-        elif sensortype == "4": #TVOC,PM2.5,PM10,CO2 Sensor
-            print "TVOC, PM2.5, PM10, CO2 Sensor"
-            params = urllib.urlencode({'name': sensorID,'field1': field4name, 'field2':field5name, 'field3':field6name, 'field4':field7name,'api_key':user_key})
-            return params
-        elif sensortype == "5": #NO2 Sensor
-            print "NO2, Temp, Humidity sensor"
-            params = urllib.urlencode({'name': sensorID,'field1': field1name, 'field2':field2name,'field3':field3name,'api_key':user_key})
-            return params
-        else:
-            print "Sensor type is not defined!"
-    except:
-            print "This shouldn't happen!"
+    schema = schemas.SCHEMAS.get(sensortype)
+    if schema is None:
+        log.warning("sensor type %s is not defined", sensortype)
+        return
+    log.info("new %s: %s", schema.description, sensorID)
+    params = schema.channelFields()
+    params['name'] = sensorID
+    params['api_key'] = user_key
+    return urllib.urlencode(params)
+
+#Defines upload fields for each type of sensor
+
+def uploadFields(sensortype,reading):
+    schema = schemas.SCHEMAS.get(sensortype)
+    if schema is not None:
+        return schema.fields(reading)
 
 #Defines upload parameters like field names and write key for each type of sensor
 
-def uploadParams(sensortype,WriteKey):
+def uploadParams(WriteKey,fields,stamp=None):
     try:
-        if sensortype == "0": #TVOC,PM10,PM2.5
-            params = urllib.urlencode({'field1':floatTVOC, 'field2':intPM2_5, 'field3':intPM10, 'api_key': WriteKey})
-            return params
-        elif sensortype == "1": #Temp,Hum,Lux sensor
-            params = urllib.urlencode({'field1':floatTemp, 'field2':floatHum, 'field3':intLight, 'api_key':WriteKey})
-            return params
-        elif sensortype == "2": #TVOC,Lux sensor
-            params = urllib.urlencode({'field1':floatTVOC, 'field2':intLight, 'api_key':WriteKey})
-            return params
-        elif sensortype == "3": #CO2 sensor
-            params = urllib.urlencode({'field1':intCO2, 'api_key':WriteKey})
-            return params
-        elif sensortype == "4": #TVOC,PM2.5,PM10,CO2 Sensor
-            params = urllib.urlencode({'field1':floatTVOC, 'field2':intPM2_5, 'field3':intPM10, 'field4':intCO2, 'api_key': WriteKey})
-            return params
-        elif sensortype == "5": #NO2,Temp,Hum Sensor
-            params = urllib.urlencode({'field1':intNO2, 'field2':floatTemp, 'field3':floatHum, 'api_key': WriteKey})
-            return params
-        else:
-            print "Sensor type is not defined!"
+        params = dict(fields)
+        params['api_key'] = WriteKey
+        if stamp is not None:
+            params['created_at'] = bulkupload.bulkStamp(stamp)
+        return urllib.urlencode(params)
     except Exception:
-            print "This shouldn't happen!"
+            log.exception("could not build upload parameters")
 
 #Create New Thingspeak Channel
 
 def createChannel(sensorID,sensortype):
 
     try:
-        print "creating channel..."
+        log.info("creating channel for %s", sensorID)
         params = newchannelParams(sensorID,sensortype)
-        conn.request("POST", "/channels.json", params, headers)
-        response = conn.getresponse()
-        print "got response"
-        print response.status, response.reason
-        if response.status == 200:
-            data = response.read()
+        status, reason, data = conn.request("POST", "/channels.json", params, headers)
+        if status == 200:
             json_data = json.loads(data)
-            print "Channel created"
             newkey = json_data['id']
+            log.info("channel %s created for %s", newkey, sensorID)
             return newkey
         else:
-            print "Channel creation failed"
-            print response.status
-            conn.close()
+            log.warning("channel creation for %s failed: %s %s", sensorID, status, reason)
     except:
-        print "Create channel failed - connection probably failed"
-        conn.close()
-
-#reads local channel infomation file and returns dictionary of names & ids
-
-def checkLocalChannels():
-
-    with open ('channelList.json') as infile:
-        json_data_from_file = json.load(infile)
-    list_length = len(json_data_from_file['channels'])
-    name_list = [0]*list_length
-    id_list = [0]*list_length
-
-    for i in range(0,list_length):
-        name_list[i] = json_data_from_file['channels'][i]['name']
-        id_list[i] = json_data_from_file['channels'][i]['id']
-        i+1
-
-    names_ids = dict(zip(name_list,id_list))
-    return names_ids
-
-# parses local Thingspeak write key list
-
-def checkLocalKeyList():
-
-    with open ('writeKeys.json') as infile:
-        json_data_from_file = json.load(infile)
-    return json_data_from_file
+        log.warning("create channel failed - connection probably failed", exc_info=True)
 
-# Downloads existing channel info from Thingspeak on startup
-
-def downloadChannels():
-
-    try:
-         params = urllib.urlencode({'api_key': user_key})
-         conn.request("GET", "/users/" + user_ID + "/channels.json/", params, headers)
-         response =  conn.getresponse()
-         print response.status, response.reason
-         if response.status == 200:
-             print "Got response OK"
-             data = response.read()
-#            print data
-             json_data = json.loads(data)
-             conn.close()
-             print "writing channel list to local file"
-             with open ('channelList.json', 'w') as outfile:
-                 json.dump(json_data, outfile, sort_keys = True, indent = 4)
-             with open ('channelList.json') as infile:
-                 json_data_from_file = json.load(infile)
-#                 print json_data_from_file
-             list_length = len(json_data_from_file['channels'])
-             name_list = [0]*list_length
-             id_list = [0]*list_length
-             for i in range(0,list_length):
-                 name_list[i] = json_data_from_file['channels'][i]['name']
-                 id_list[i] = json_data_from_file["channels"][i]["id"]
-                 i+1
-             print "created ID list"
-         else:
-             print response.status, response.reason
-             conn.close()
-    except Exception:
-         print "No response - had difficulty communicating with Thingspeak"
-         print "Check network connection"
-         conn.close()
-         pass
-    else:
-         names_ids = dict(zip(name_list,id_list))
-         print "returned list of existing sensors"
-         return names_ids
-
-
-# checks which channels already exist on Thingspeak using userID. 
-# If in localDB (local, non-persistent dictionary), returns the existing dictionary without download
-# otherwise contacts Thingspeak and downloads list of all existing channels
+# checks whether a channel already exists on Thingspeak for a sensor.
+# Known sensors are answered from the channel registry without any network call; an unknown one triggers
+# (at most one per minute) download of the channel list, merged into the registry - see channels.py.
+# Returns True if the channel exists, False if it doesn't, None if Thingspeak couldn't be reached
 
 def checkChannel(sensorID, sensorID_dict):
 
-    print sensorID
-    if sensorID in sensorID_dict:
-        print "Already have sensorID in local DB"
-        return sensorID_dict
-    else:
-         print "Downloading existing channel information"
-    try:
-         params = urllib.urlencode({'api_key': user_key})
-         conn.request("GET", "/users/" + user_ID + "/channels.json/", params, headers)
-         response =  conn.getresponse()
-         print response.status, response.reason
-         if response.status == 200:
-             print "Got response OK"
-             data = response.read()
-             print data
-             json_data = json.loads(data)
-             conn.close()
-             print "writing channel list to local file"
-             with open ('channelList.json', 'w') as outfile:
-                 json.dump(json_data, outfile, sort_keys = True, indent = 4)
-             with open ('channelList.json') as infile:
-                 json_data_from_file = json.load(infile)
-                 print json_data_from_file
-             list_length = len(json_data_from_file['channels'])
-             name_list = [0]*list_length
-             id_list = [0]*list_length
-             for i in range(0,list_length):
-                 name_list[i] = json_data_from_file['channels'][i]['name']
-                 id_list[i] = json_data_from_file["channels"][i]["id"]
-                 i+1
-             print "created ID list"
-         else:
-             print response.status, response.reason
-             conn.close()
-    except Exception:
-         print "No response - had difficulty communicating with Thingspeak"
-         print "Check network connection"
-         conn.close()
-         pass
-    else:
-         names_ids = dict(zip(name_list,id_list))
-         print "returned list of existing sensors"
-         return names_ids
+    found = sensorID_dict.resolve(sensorID)
+    if found:
+        log.debug("%s already in channel registry", sensorID)
+    elif found is None:
+        log.warning("could not check channel list for %s - Thingspeak unreachable", sensorID)
+    return found
 
 #does a false update of the channel to retrieve the writekey as a single string
 
 def getWriteKey(CHANNEL_ID):
     uploadID = str(CHANNEL_ID)
     try:
-        print "getting write key"
+        log.info("getting write key for channel %s", uploadID)
         params = urllib.urlencode({'api_key': user_key})
-        conn.request("PUT", "/channels/" + uploadID + ".json", params, headers)
-        response = conn.getresponse()
-        print response.status, response.reason
-        if response.status == 200:
-            print "got key!"
-            data = response.read()
+        status, reason, data = conn.request("PUT", "/channels/" + uploadID + ".json", params, headers)
+        if status == 200:
             json_data = json.loads(data)
             apikeys = json_data['api_keys']
             return apikeys
         else:
-            print response.status, response.reason
-            conn.close()
+            log.warning("getting write key for channel %s failed: %s %s", uploadID, status, reason)
     except:
-        print "Get write key failed - connection probably timed-out"
-        conn.close()
-
-def storeWriteKeys(writeKey_dict):
-     print "appending write key to local file..."
-     json_data = writeKey_dict
-#     print "json key data is", json_data
-     with open ('writeKeys.json', 'w') as f:
-         json.dump(json_data,f, indent=4)
-     print "Done"
-     return    
-
-def is_number(s):
-    print s
-    if s == "NaN":
-       s = 0
-       return s         
+        log.warning("get write key failed - connection probably timed-out", exc_info=True)
+
+#uploads sensor data (upload fields as built by uploadFields) using writekey - buffered for a bulk update when the
+#channel ID is known, otherwise queued for the channel's next slot under Thingspeak's rate limit
+
+def uploadData(WriteKey,fields,channelID=None,stamp=None):
+    if channelID is None:
+        postUpdate(channelID,WriteKey,fields,stamp)
+    elif BULK_UPLOAD:
+        uploadBuffer.add(channelID, WriteKey, fields, stamp)
+        log.debug("buffered for bulk upload to channel %s", channelID)
     else:
-       return s
+        updateScheduler.submit(channelID, WriteKey, fields, stamp)
+        log.debug("queued for upload to channel %s", channelID)
 
-#uploads sensor data using writekey
+#sends one channel update, returns True if Thingspeak accepted it. Thingspeak answers 200 with entry id 0
+#when it rejects an update, e.g. for coming too soon after the previous one
 
-def uploadData(WriteKey,sensortype):
-    params = uploadParams(sensortype,WriteKey)
+def postUpdate(channelID,WriteKey,fields,stamp=None):
+    params = uploadParams(WriteKey,fields,stamp)
+    start = time.time()
     try:
-        print "Uploading data..."
-        conn.request("POST", "/update", params, headers)
-        response = conn.getresponse()
-        print response.status, response.reason
-        if response.status == 200:
-            print "UPLOADED!"
-            print "**********"
-            conn.close()
-        else:
-            print response.status, response.reason
-            conn.close()
+        status, reason, data = conn.request("POST", "/update", params, headers)
+        metrics.STAGE_SECONDS.since(start, 'upload')
+        if status == 200 and data.strip() != "0":
+            metrics.UPLOADS.inc('single', 'success')
+            metrics.UPLOADED_READINGS.inc()
+            log.debug("uploaded to channel %s", channelID)
+            return True
+        metrics.UPLOADS.inc('single', 'failure')
+        log.warning("upload to channel %s failed: %s %s %r", channelID, status, reason, data[:100])
     except:
-        print "connection probably timed-out"
-        conn.close()
-
-def Calibration(source,sensortype,floatTemp,floatHum,intLight,intCO2,floatTVOC,intPM10,intPM2_5):
-    Calib_CSV=csv.DictReader(open('Calib_CSV.csv','rb'))
-    print "Sensor serial number is: " , source
-    for row in Calib_CSV:
-        Serial_Number=row["Serial Number"]
-        Temp_Slope=float(row["Temp_Slope"])
-        Temp_Intercept=float(row["Temp_Intercept"])
-        Humid_Slope=float(row["Humid_Slope"])
-        Humid_Intercept=float(row["Humid_Intercept"])
-        Lux_Slope=float(row["Lux_Slope"])
-        Lux_Intercept=float(row["Lux_Intercept"])
-        CO2_A=float(row["CO2_A"])
-        CO2_B=float(row["CO2_B"])
-        VOC_Slope=float(row["VOC_Slope"])
-        VOC_Intercept=float(row["VOC_Intercept"])
-        PM10_Slope=float(row["PM10_Slope"])
-        PM10_Intercept=float(row["PM10_Intercept"])
-        PM2_5_Slope=float(row["PM25_Slope"])
-        PM2_5_Intercept=float(row["PM25_Intercept"])
-        if source==Serial_Number:
-            print "Matching CSV Serial Number is: ",Serial_Number
-            print "Sensor type is: " ,sensortype
-            if sensortype == "0":
-                floatTVOC=round(floatTVOC*VOC_Slope+VOC_Intercept,2)
-                intPM10=round(intPM10*PM10_Slope+PM10_Intercept,0)
-                intPM2_5=round(intPM2_5*PM2_5_Slope+PM2_5_Intercept,0)
-                print (floatTVOC, intPM10, intPM2_5)
-		return (floatTVOC, intPM10, intPM2_5)
-            elif sensortype == "1":
-                print (floatTemp, floatHum, intLight)
-                floatTemp=round(floatTemp*Temp_Slope+Temp_Intercept,1)
-                floatHum=round(floatHum*Humid_Slope+Humid_Intercept,1)
-                intLight=round(intLight*Lux_Slope+Lux_Intercept,0)
-                print (floatTemp, floatHum, intLight)
-		return (floatTemp, floatHum, intLight)
-            elif sensortype == "2":
-                floatTVOC=round(floatTVOC*VOC_Slope+VOC_Intercept,2)
-                intLight=round(intLight*Lux_Slope+Lux_Intercept,0)
-                print (floatTVOC, intLight)
-		return (floatTVOC, intLight)
-            elif sensortype == "3":
-                intCO2=round(CO2_A*(pow(intCO2,CO2_B)),0)
-                print intCO2
-		return intCO2
-            elif sensortype == "4":
-                print intCO2, floatTVOC, intPM10, PM2_5
-                intCO2=round(CO2_A*pow(intCO2,CO2_B),0)
-                floatTVOC=round(floatTVOC*VOC_Slope+VOC_Intercept,2)
-                intPM10=round(intPM10*PM10_Slope+PM10_Intercept,0)
-                intPM2_5=round(intPM2_5*PM2_5_Slope+PM2_5_Intercept,0)
-                print (intCO2,floatTVOC,intPM10,intPM2_5)
-		return (intCO2,floatTVOC,intPM10,intPM2_5)
-	    else:
-                print "There's no sensor match!"
-    
-        
+        metrics.STAGE_SECONDS.since(start, 'upload')
+        metrics.UPLOADS.inc('single', 'failure')
+        log.warning("upload failed - connection probably timed-out", exc_info=True)
+    return False
+
+updateScheduler = scheduler.UploadScheduler(postUpdate, concurrency=UPDATE_CONCURRENCY, limiter=channelLimits)
+
 ###################################### Main sub-routine #############################################
 # Checks if sensor exists in db, or on thingspeak and does all required calls to get info to upload #
 
-def ThingspeakProcess(source,sensortype,sensorID_dict,writeKey_dict):
+def ThingspeakProcess(source,sensortype,fields,sensorID_dict,writeKey_dict,stamp=None):
+    start = time.time()
+    with registryLock:
+        channelID, writekey = resolveWriteKey(source,sensortype,sensorID_dict,writeKey_dict)
+    metrics.STAGE_SECONDS.since(start, 'resolve')
+    if channelID is None or not writekey:
+        log.warning("no channel or write key for %s - reading not uploaded", source)
+        return writeKey_dict, sensorID_dict
+    uploadData(writekey,fields,channelID,stamp)   #upload outside the lock so workers upload concurrently
+    return writeKey_dict, sensorID_dict
+
+# finds (or creates) the channel for a source and its write key - caller must hold registryLock
+
+def resolveWriteKey(source,sensortype,sensorID_dict,writeKey_dict):
     if source in sensorID_dict:
-        print "1 Source in sensorID_dict"
+        log.debug("1 %s in channel registry", source)
         if source in writeKey_dict:
-            print "1-1 source in writeKey_dict"
-            if len(writeKey_dict[source]) == 2:
-            	print "1-1-1 source in both db"
-                uploadData(writeKey_dict[source][1],sensortype)       #upload
+            log.debug("1-1 %s in writeKey_dict", source)
+            if len(writeKey_dict[source]) == 2 and writeKey_dict[source][1]:
+                log.debug("1-1-1 %s in both db", source)
+                return writeKey_dict[source][0], writeKey_dict[source][1]
             else:
-                print "1-1-2 source in both db, no write key?"
+                log.debug("1-1-2 %s in both db, no write key", source)
                 channelID = sensorID_dict[source]
                 readwritekey = getWriteKey(channelID)   #get key object from thingspeak json response
+                if not readwritekey:
+                    return channelID, None              #Thingspeak unreachable - fetched again next time
                 writekey = readwritekey[0]['api_key']   #get writekey from object
-                writeKey_dict[source].append(writekey)  #write key into DB
-                uploadData(writekey,sensortype)         #upload
+                writeKey_dict[source] = [channelID,writekey]  #write key into DB
+                return channelID, writekey
         else:
-            print "1-2 source not in writeKey_dict"
+            log.debug("1-2 %s not in writeKey_dict", source)
             channelID = sensorID_dict[source]           #create new channel with source_addr as name - returns ID of new channel
-            writeKey_dict[source] = [channelID,0]       #insert channelID and empty list item for writekey
             readwritekey = getWriteKey(channelID)
+            if not readwritekey:
+                return channelID, None
             writekey = readwritekey[0]['api_key']
-            writeKey_dict[source][1] = writekey         #write key into DB
-            uploadData(writekey,sensortype)             #upload
+            writeKey_dict[source] = [channelID,writekey]  #write key into DB
+            return channelID, writekey
     
-    elif source not in sensorID_dict:                   # = new sensor = create a channel, add the write API key to memory
-        print "2 Source not in sensorID_dict"
+    else:                                               # = new sensor = create a channel, add the write API key to memory
+        log.debug("2 %s not in channel registry", source)
         if source not in writeKey_dict:
-            print "2-1 source not in writeKey_dict"
+            log.debug("2-1 %s not in writeKey_dict", source)
             channelID = createChannel(source,sensortype)#create new channel with source_addr as name - returns ID of new channel
-            sensorID_dict[source] = [channelID]         #add new channelID to sensorIDlist
-            writeKey_dict[source] = [channelID,0]       #insert channelID and empty list item for writekey
+            if channelID is None:
+                return None, None
+            sensorID_dict[source] = channelID           #add new channelID to channel registry
             readwritekey = getWriteKey(channelID)       #get key object from thingspeak json resposne
+            if not readwritekey:
+                return channelID, None                  #channel is registered - its key is fetched next time
             writekey = readwritekey[0]['api_key']       #get writekey from object
-            writeKey_dict[source][1] = writekey         #write key int DB
-            uploadData(writekey,sensortype)             #upload
+            writeKey_dict[source] = [channelID,writekey]  #write key int DB
+            return channelID, writekey
         else:
-            print "2-2 source already in writeKey_dict"
-            writeKey_dict[source][1] = writekey         #write key into DB
-            uploadData(writekey,sensortype)             #upload
+            log.debug("2-2 %s already in writeKey_dict", source)
+            return writeKey_dict[source][0], writeKey_dict[source][1]
+
+#gateway state - loaded from local files only, so nothing here waits for the network
+
+sensorID_dict = channels.ChannelRegistry(conn, user_ID, user_key, 'channelList.json',
+                                         miss_ttl=CHANNEL_MISS_TTL, refresh_interval=CHANNEL_REFRESH_INTERVAL)    #global channel registry, loaded from the local file only
+writeKey_dict = keystore.KeyStore('writeKeys.json', delay=KEY_WRITE_DELAY)    #global dictionary for storing writekeys, saved when a key changes
+log.info("%d channels and %d write keys loaded from local files", len(sensorID_dict), len(writeKey_dict))
+
+readingSpool = None
+if SPOOL_PATH:
+    readingSpool = spool.Spool(SPOOL_PATH, max_rows=SPOOL_MAX_ROWS)
+    log.info("%d readings waiting in spool", len(readingSpool))
+
+#resolves channel ID and write key for the spool drainer - returns None while Thingspeak can't be reached
+
+def spoolResolve(source,sensortype):
+    start = time.time()
+    with registryLock:
+        if checkChannel(source, sensorID_dict) is None:
+            return None
+        channelID, writekey = resolveWriteKey(source,sensortype,sensorID_dict,writeKey_dict)
+    metrics.STAGE_SECONDS.since(start, 'resolve')
+    if channelID is None or not writekey:
+        return None
+    return channelID, writekey
+
+#drops a source's write key after Thingspeak refused it, so the next attempt fetches it again
+
+def forgetWriteKey(source):
+    with registryLock:
+        if source in writeKey_dict:
+            del writeKey_dict[source]
+    log.info("write key for %s dropped - will be fetched again", source)
+
+spoolDrainer = spool.SpoolDrainer(readingSpool, conn, spoolResolve, forgetWriteKey, min_batch=BULK_SIZE, max_age=BULK_AGE,
+                                  limiter=channelLimits, windows=AGGREGATE_WINDOWS)    #spooled readings are aggregated as they are uploaded
+
+#hands one reading on to the spool, or (without a spool) one reading or window's aggregate straight to Thingspeak.
+#stamp is when it was measured (the start of the window for aggregates)
+
+def forward(source, sensortype, fields, stamp, summary=None):
+    start = time.time()
+    if readingSpool is not None:
+        readingSpool.append(source, sensortype, fields, stamp)    #the drainer resolves the channel and uploads
+        metrics.STAGE_SECONDS.since(start, 'spool')
+        log.debug("spooled, %d readings waiting", len(readingSpool))
+        return
+    with registryLock:
+        found = checkChannel(source, sensorID_dict)
+    metrics.STAGE_SECONDS.since(start, 'resolve')
+    if found is None:
+        log.warning("reading from %s not uploaded - Thingspeak unreachable", source)
+        return
+    ThingspeakProcess(source,sensortype,fields,sensorID_dict,writeKey_dict,stamp)
+
+aggregator = None
+if AGGREGATE_WINDOWS and readingSpool is None:    #with a spool the drainer aggregates, so nothing waits in memory for its window
+    aggregator = aggregate.Aggregator(forward, AGGREGATE_WINDOWS)
+
+#Thingspeak sink (no spool) - folds the reading into its window, or forwards it straight away
+
+def thingspeakDeliver(source, sensortype, fields, stamp):
+    if aggregator is not None:
+        start = time.time()
+        aggregator.add(source, sensortype, fields, stamp)    #forwarded once per window
+        metrics.STAGE_SECONDS.since(start, 'aggregate')
     else:
-        print "this shouldn't happen"
-        conn.close()
-    return writeKey_dict, sensorID_dict
+        forward(source, sensortype, fields, stamp)
+
+#every calibrated reading is fanned out to these, each with its own queue and thread. With a spool the Thingspeak
+#path isn't one of them: processFrame writes each reading to the spool itself, so none waits in memory or is dropped
+outputs = []
+if readingSpool is None:
+    outputs.append(sinks.ThingspeakSink(thingspeakDeliver))
+if MQTT_BROKER:
+    outputs.append(sinks.MQTTSink(*MQTT_BROKER))
+if FILE_SINK_FOLDER:
+    outputs.append(sinks.FileSink(FILE_SINK_FOLDER))
+outputs = sinks.Fanout(outputs)
+
+#decodes and calibrates one received frame, spools it and hands it to the output sinks - runs on the worker threads.
+#received is when the reader took the frame off the serial port
+
+def processFrame(packet, received):
+    now = metrics.STAGE_SECONDS.since(received, 'queue')
+    source = packet['source_addr_long'].encode('hex')   #read sending address
+    incoming = packet['rf_data']                        #read incoming packet data
+    schema = schemas.lookup(incoming)                   #decoding and calibration are declared per sensor type in schemas.py
+    if schema is None:
+        metrics.FRAMES_DROPPED.inc('unknown_type')
+        log.warning("non-recognised sensor type from %s: %r", source, incoming)
+        return
+    sensortype = schema.typeid
+    metrics.FRAMES.inc(sensortype)
+    reading = schema.decode(incoming)
+    now = metrics.STAGE_SECONDS.since(now, 'decode')
+    log.debug("%s from %s: %r", schema.description, source, reading)     #pre-calibration values
+    reading = schema.calibrate(calibStore, source, reading)
+    now = metrics.STAGE_SECONDS.since(now, 'calibrate')
+    log.debug("calibrated: %r", reading)
+    if recentReadings is not None:
+        recentReadings.record(source, schema, reading, received)
+    fields = uploadFields(sensortype,reading)
+    if readingSpool is not None:
+        forward(source, sensortype, fields, received)    #a local insert - on disk before the other outputs see it
+    outputs.put(source, sensortype, fields, received)
+
+#called on a port's reader thread for every frame it receives - only queues it, so a slow upload never
+#holds up the radio. Frames from all ports go into the one queue
+
+firstFrames = set()    #ports that have received a frame
+
+def frameReceived(port, packet):
+    received = time.time()
+    if port not in firstFrames:
+        firstFrames.add(port)
+        log.info("first frame from %s received %.2f s after start", port, received - startTime)
+    if duplicates is not None and duplicates.check(packet, received):
+        metrics.FRAMES_DROPPED.inc('duplicate')
+        metrics.PORT_LOST.inc(port, 'duplicate')
+        log.debug("duplicate frame from %s dropped", packet['source_addr_long'].encode('hex'))
+        return
+    try:
+        frameQueue.put_nowait((received, packet))
+    except Queue.Full:
+        metrics.FRAMES_DROPPED.inc('queue_full')
+        metrics.PORT_LOST.inc(port, 'queue_full')
+        log.warning("frame queue full - dropping frame from %s, workers can't keep up", port)
+
+#worker thread - takes frames off the queue and processes them one at a time, until it takes a None or
+#stopping is set (at shutdown, when the workers haven't reached the Nones in time)
+
+stopping = threading.Event()
+
+def uploadWorker():
+    while not stopping.is_set():
+        item = frameQueue.get()
+        if item is None:
+            return
+        received, packet = item
+        try:
+            processFrame(packet, received)
+        except Exception:
+            metrics.FRAMES_DROPPED.inc('error')
+            log.exception("error is preventing upload of frame %r", packet)
 
-##################### MAIN GATEWAY ROUTINE #######################
-# Routine waits until a packet is received from a remote sensors #
-#    checks source and sensor type then calls main sub-routine   #
-##################################################################
+#background startup - fetches the channel list if there is no local copy. Write keys and any channels
+#still missing are resolved lazily, the first time a sensor's readings are uploaded
 
-list = [0,0]
-sensorID_dict = {}                                      #global dictionary for storing checkChannel results
-writeKey_dict = dict.fromkeys(range(1),list)               #global dictionary for storing writekeys, 
-print timestamp()
-print "Starting Thingspeak processes"
-time.sleep(3)
-print "Checking for saved channel list"
-
-if os.path.isfile("/home/pi/zigb2net/channelList.json"):
-    print "Channel list exists"
-    sensorID_dict = checkLocalChannels()
-    print "sensorID_dict from file is", sensorID_dict
-else:
-    print "No saved channel list...downloading remote list"
-    try :
-         sensorID_dict = downloadChannels();
-    except Exception:
-         print "error downloading channel list"
-         pass
+def resolveStartup():
+    if len(sensorID_dict):
+        return
+    log.info("no saved channel list - downloading remote list")
+    if not sensorID_dict.refresh():
+        log.warning("error downloading channel list - will retry when a sensor needs it")
 
-if os.path.isfile("/home/pi/zigb2net/writeKeys.json"):
-    print "Writekey list exists"
-    writeKey_dict = checkLocalKeyList()
-    print "writeKey_dict from file is", writeKey_dict
-else:
-    print "No saved writekey list"
+#points the gateway at another Thingspeak server, and sets the seconds between updates of one channel and the
+#aggregation windows of spooled readings - for a personal server, or bench_gateway.py's stub. Call before main()
 
-while True:
-    try:
-        zbport.flushInput()                                 #clear serial buffer
-        print "Waiting for packet..."
-        packet = zb.wait_read_frame()                       #wait for incoming packet
-        source = packet['source_addr_long'].encode('hex')   #read sending address
-        incoming = packet['rf_data']                        #read incoming packet data
-        print incoming					    #show what's coming in
-        if incoming[0] == "0":
-            print "PM and VOC Data"
-            sensortype,RsRo,PM2_5,PM10 = incoming.split(",")       #split data (comma separated values)
-            print source,sensortype,RsRo,PM2_5,PM10                #print to verify
-	    tvoc = TVOCcalc(RsRo)
-	    floatTVOC = float(tvoc)
-            intPM10 = int(PM10)
-            intPM2_5 = int(PM2_5)
-	    floatTVOC,intPM10,intPM2_5=Calibration(source,sensortype,floatTemp,floatHum,intLight,intCO2,floatTVOC,intPM10,intPM2_5)
-        elif incoming[0] == "1":
-            print "Temp,Hum & Lux Data"
-            sensortype,hum,temp,light = incoming.split(",")        #split data (comma separated values)
-            tempReplace = temp.replace(' ', '')
-            lightReplace = light.replace('\n','')
-            floatTemp = float(tempReplace)
-            floatHum = float(hum)
-            nanLight = is_number(lightReplace)
-            intLight = int(nanLight)
-            print "Pre-calibration values are: " ,floatTemp,floatHum,intLight                 #print to verify
-            floatTemp, floatHum,intLight=Calibration(source,sensortype,floatTemp,floatHum,intLight,intCO2,floatTVOC,intPM10,intPM2_5) #send to calibration function
-            print "Post-calibration values are: " ,floatTemp,floatHum,intLight                #print to verify   
-        elif incoming[0] == "2":                                        
-            print "TVOC & Lux Data"
-            sensortype,RsRo,light = incoming.split(",")            #add light to this once sensor hooked up
-            lightReplace = light.replace('\n','')
-	    tvoc = TVOCcalc(RsRo)                                  #not used!
-	    floatTVOC = float(tvoc)
-            print source,sensortype,RsRo,light
-            floatTVOC,intLight=Calibration(source,sensortype,floatTemp,floatHum,intLight,intCO2,floatTVOC,intPM10,intPM2_5)
-        elif incoming[0] == "3":
-	    print "CO2 Data"
-	    sensortype,CO2 = incoming.split(",")                   #split data (comma separated values)
-	    intCO2 = int(CO2)
-            print source,sensortype,CO2                            #print to verify#
-            intCO2=Calibration(source,sensortype,floatTemp,floatHum,intLight,intCO2,floatTVOC,intPM10,intPM2_5)
-        elif incoming[0] == "4":
-            print "PM, VOC & CO2 Data"
-            sensortype,RsRo,PM2_5,PM10,CO2 = incoming.split(",")   #split data (comma separated values)            
-            tvoc = TVOCcalc(RsRo)
-            intCO2 = int(CO2)
-            floatTVOC = float(tvoc)
-            intPM10 = int(PM10)
-            intPM2_5 = int(PM2_5)
-            print "Pre-calibration values are: " ,intCO2,floatTVOC,intPM10,intPM2_5            #print to verify
-            intCO2,floatTVOC,intPM10,intPM2_5=Calibration(source,sensortype,floatTemp,floatHum,intLight,intCO2,floatTVOC,intPM10,intPM2_5)
-            print "Post-calibration values are: " ,intCO2,floatTVOC,intPM10,intPM2_5
-        elif incoming[0] == "5":
-            print "NO2,Temp & Hum Data"
-            sensortype,intNO2,floatTemp,floatHum = incoming.split(",")   #split data (comma separated values)            
-            print source,sensortype,intNO2,floatTemp,floatHum                            #print to verify#
-        else:
-            print "Non-recognised sensor type in Gateway Routine, Ed need to fix this!"
-        try:
-            print timestamp()
-            sensorID_dict = checkChannel(source, sensorID_dict)
-        except Exception:
-            sensorID_dict = {}
-        ThingspeakProcess(source,sensortype,sensorID_dict,writeKey_dict)
-        storeWriteKeys(writeKey_dict)
-    except Exception:
-       print "error is preventing upload, please check logs"
-       pass
+def configure(host=THINGSPEAK_HOST, interval=UPDATE_INTERVAL, windows=AGGREGATE_WINDOWS):
+    conn.close()    #idle connections to the old host
+    conn.host = host
+    channelLimits.setInterval(interval)
+    spoolDrainer.windows = windows
 
-zbport.close()
+##################### MAIN GATEWAY ROUTINE #######################
+# Starts receiving straight away: frames are decoded and spooled #
+#  while channels and write keys are resolved in the background  #
+##################################################################
+
+#SIGTERM (kill, systemctl stop) shuts down the same way as Ctrl-C, spooling and flushing what is in memory
+def terminate(signum, frame):
+    raise KeyboardInterrupt
+
+#runs the gateway until Ctrl-C or SIGTERM. Importing this file (as bench_gateway.py does) sets the gateway up without running it
+
+def main():
+    signal.signal(signal.SIGTERM, terminate)
+    gatewaylog.installSignals()
+    metrics.QUEUE_DEPTH.track(frameQueue.qsize)
+    if METRICS_ADDRESS:
+        metrics.serve(METRICS_ADDRESS)
+    if READ_API_ADDRESS and recentReadings is not None:
+        readapi.serve(READ_API_ADDRESS, recentReadings, sensorID_dict.lookup)
+    log.info("starting Thingspeak processes")
+
+    frameSources = framesource.openSources(FRAME_SOURCES, BAUD_RATE)    #XBees on serial ports (each flushed once on open), or replays
+    if FRAME_CAPTURE:
+        frameSources = [framesource.Recorder(frameSource, FRAME_CAPTURE) for frameSource in frameSources]
+
+    workers = []
+    for i in range(UPLOAD_WORKERS):
+        worker = threading.Thread(target=uploadWorker)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    for frameSource in frameSources:    #one reader thread per port
+        frameSource.start(lambda packet, port=frameSource.name: frameReceived(port, packet))
+        log.info("receiving from %s %.2f s after start", frameSource.name, time.time() - startTime)
+
+    startup = threading.Thread(target=resolveStartup)
+    startup.daemon = True
+    startup.start()
+
+    outputs.start()
+    if aggregator is not None:
+        aggregator.start()
+    if readingSpool is not None:
+        spoolDrainer.start()
+    elif BULK_UPLOAD:
+        uploadBuffer.start()
+    else:
+        updateScheduler.start()
 
+    while True:                                                 #main thread just waits for Ctrl-C or SIGTERM
+        try:
+            signal.pause()
+        except KeyboardInterrupt:
+            break
+
+    for frameSource in frameSources:    #nothing more is queued after this
+        frameSource.close()
+        log.info("%s: %d frames, %d bytes", frameSource.name, metrics.PORT_FRAMES.value(frameSource.name),
+                 metrics.PORT_BYTES.value(frameSource.name))
+    deadline = time.time() + SHUTDOWN_TIMEOUT
+    try:
+        for worker in workers:
+            frameQueue.put(None, timeout=max(deadline - time.time(), 0.01))
+    except Queue.Full:
+        pass
+    for worker in workers:
+        worker.join(max(deadline - time.time(), 0.01))
+    if any(worker.is_alive() for worker in workers):    #stuck behind something slow - stop them after their current frame
+        stopping.set()
+        log.warning("workers still busy after %.0f s - %d queued frames not processed", SHUTDOWN_TIMEOUT, frameQueue.qsize())
+    outputs.stop()    #writes out what the sinks still have queued
+    if aggregator is not None:
+        aggregator.stop()    #uploads the unfinished windows
+    if readingSpool is not None:    #the upload path that was started
+        spoolDrainer.stop()
+        readingSpool.close()
+    elif BULK_UPLOAD:
+        uploadBuffer.stop()
+    else:
+        updateScheduler.stop()
+    writeKey_dict.close()
+    conn.close()
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+#! /usr/bin/python
+
+# Streaming aggregation of calibrated readings between calibration and upload.
+# Readings are folded into a window per source as they arrive - per field only a running sum, min, max
+# and count are kept, so memory is constant however many readings a window sees. When a window closes
+# one aggregate is handed on in its place: the mean of each field goes to the Thingspeak fields, and
+# min, max and count come along for anything local that wants them.
+# Windows are aligned to multiples of their length (a 60 s window covers hh:mm:00 - hh:mm:59), and the
+# length is set per sensor type - a type with no window (or 0) passes every reading straight through.
+# A window closes when a reading from the same source falls into a later window, or at the latest
+# grace seconds after its end (Aggregator.start() runs the check in the background), so a Qube that
+# stops reporting doesn't keep its last readings back.
+# The gateway spools every raw reading and aggregates at upload time instead, with windowRows(): the
+# spool drainer folds a source's spooled rows into the same windows and sends one update per closed
+# window, so no reading is held only in memory while its window is open. The Aggregator is used when
+# there is no spool.
+# usage: python aggregate.py   aggregates a synthetic capture and prints the reduction in uploads
+
+import time
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+WINDOWS = {"0": 60, "1": 60, "2": 60, "3": 60, "4": 60, "5": 60}    #seconds per window by sensor type - one value per minute per channel
+GRACE = 5.0     #seconds after a window's end that late readings (still in the frame queue) are waited for
+DECIMALS = 2    #means are rounded like the calibrated values
+
+#running statistics of one window of one source - {field: [sum, min, max, count]}
+class Window(object):
+
+    __slots__ = ('sensortype', 'start', 'end', 'stats')
+
+    def __init__(self, sensortype, start, length):
+        self.sensortype = sensortype
+        self.start = start
+        self.end = start + length
+        self.stats = {}
+
+    def add(self, fields):
+        for field, value in fields.items():
+            if value is None:
+                continue
+            entry = self.stats.get(field)
+            if entry is None:
+                self.stats[field] = [value, value, value, 1]
+            else:
+                entry[0] += value
+                if value < entry[1]:
+                    entry[1] = value
+                elif value > entry[2]:
+                    entry[2] = value
+                entry[3] += 1
+
+    #mean per field, as an upload dict like {'field1': 21.5}
+    def means(self):
+        return dict((field, round(float(total) / count, DECIMALS)) for field, (total, low, high, count) in self.stats.items())
+
+    #{field: (mean, min, max, count)}
+    def summary(self):
+        return dict((field, (round(float(total) / count, DECIMALS), low, high, count))
+                    for field, (total, low, high, count) in self.stats.items())
+
+#folds one source's spooled rows (id, stamp, sensortype, fields), oldest first, into windows as Aggregator does.
+#Returns [(ids, sensortype, fields, stamp)], one per closed window with the means as fields and stamped at the
+#window's start (fields empty if it had no values), or one per row for types without a window. The last window
+#is left out while it can still get readings - it ends less than grace seconds before now, or more is True
+#because the rows were cut off at a limit - so its rows stay in the spool for a later pass
+def windowRows(rows, windows=WINDOWS, now=None, grace=GRACE, more=False):
+    if now is None:
+        now = time.time()
+    out = []
+    window = None
+    ids = []
+    for rowid, stamp, sensortype, fields in rows:
+        length = windows.get(sensortype)
+        if window is not None and (not length or stamp - stamp % length > window.start or window.sensortype != sensortype):
+            out.append((ids, window.sensortype, window.means(), window.start))
+            window = None
+        if not length:
+            out.append(([rowid], sensortype, fields, stamp))
+            continue
+        if window is None:
+            window = Window(sensortype, stamp - stamp % length, length)
+            ids = []
+        window.add(fields)    #a late reading for an earlier window goes into the current one
+        ids.append(rowid)
+    if window is not None and ((not more and now >= window.end + grace) or (more and not out)):
+        out.append((ids, window.sensortype, window.means(), window.start))    #a window of more than limit rows goes in parts
+    return out
+
+class Aggregator(object):
+
+    #emit(source, sensortype, fields, stamp, summary) is called once per closed window, with the means as fields,
+    #stamped at the window's start. Pass-through readings are emitted as they are, with summary None
+    def __init__(self, emit, windows=WINDOWS, grace=GRACE):
+        self.emit = emit
+        self.windows = dict(windows)
+        self.grace = grace
+        self.lock = threading.Lock()
+        self.open = {}    #source -> Window
+        self.readings = 0
+        self.emitted = 0
+        self.thread = None
+        self.running = False
+
+    def add(self, source, sensortype, fields, stamp=None):
+        if stamp is None:
+            stamp = time.time()
+        length = self.windows.get(sensortype)
+        if not length:
+            self.emit(source, sensortype, fields, stamp, None)
+            return
+        start = stamp - stamp % length
+        closed = None
+        with self.lock:
+            self.readings += 1
+            window = self.open.get(source)
+            if window is not None and (start > window.start or window.sensortype != sensortype):
+                closed = window
+                window = None
+            if window is None:
+                window = self.open[source] = Window(sensortype, start, length)
+            window.add(fields)    #a late reading for an already closed window goes into the current one
+        if closed is not None:
+            self.close(source, closed)
+
+    def close(self, source, window):
+        if not window.stats:
+            return
+        with self.lock:
+            self.emitted += 1
+        log.debug("window %s-%s of %s closed", window.start, window.end, source)
+        self.emit(source, window.sensortype, window.means(), window.start, window.summary())
+
+    #closes windows that ended more than grace seconds ago
+    def flushDue(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            due = [(source, window) for source, window in self.open.items() if now >= window.end + self.grace]
+            for source, window in due:
+                del self.open[source]
+        for source, window in due:
+            self.close(source, window)
+
+    #closes every window, finished or not
+    def flushAll(self):
+        with self.lock:
+            due = self.open.items()
+            self.open = {}
+        for source, window in due:
+            self.close(source, window)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.open)
+
+    def start(self, interval=1.0):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=(interval,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, interval):
+        while self.running:
+            time.sleep(interval)
+            try:
+                self.flushDue()
+            except Exception:
+                log.exception("error closing aggregation windows")
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.flushAll()
+
+if __name__ == '__main__':
+    import random
+    import calibration
+    import schemas
+    import bench_gateway
+
+    random.seed(1)
+    store = calibration.CalibrationStore('Calib_CSV.csv')
+    sources = bench_gateway.fleet()
+    logging.getLogger().setLevel(logging.ERROR)
+    out = []
+    aggregator = Aggregator(lambda *args: out.append(args))
+
+    #every Qube reporting every 30 s for 10 minutes, fed in time order
+    minutes = 10
+    offsets = dict((serial, random.uniform(0, 30)) for serial in sources)
+    readings = sorted((start + 30 * n, serial) for serial, start in offsets.items() for n in range(minutes * 2))
+    begin = 1600000000.0
+    first = {}
+    for stamp, serial in readings:
+        frame = bench_gateway.synthetic_frame(serial, sources[serial])
+        schema = schemas.lookup(frame['rf_data'])
+        fields = schema.fields(schema.calibrate(store, serial, schema.decode(frame['rf_data'])))
+        first.setdefault(serial, fields)
+        aggregator.add(serial, schema.typeid, fields, begin + stamp)
+    aggregator.flushDue(begin + minutes * 60 + 60)
+
+    #one aggregate per source per minute, and every reading counted exactly once
+    assert all(len(set(stamp for s, t, f, stamp, summary in out if s == serial)) == len([o for o in out if o[0] == serial])
+               for serial in sources)
+    assert sum(summary.values()[0][3] for source, sensortype, fields, stamp, summary in out) == len(readings)
+    for source, sensortype, fields, stamp, summary in out:
+        assert stamp % 60 == 0
+        for field, (mean, low, high, count) in summary.items():
+            assert low - 0.01 <= fields[field] <= high + 0.01
+    print "%d readings from %d Qubes -> %d aggregates (%.1fx fewer uploads)" % (
+        len(readings), len(sources), len(out), float(len(readings)) / len(out))
+
+    #the same windows when the raw readings are spooled and aggregated per source at upload time, in two passes
+    spooled = []
+    for rowid, (stamp, serial) in enumerate(readings):
+        frame = bench_gateway.synthetic_frame(serial, sources[serial])
+        spooled.append((rowid, serial, begin + stamp, schemas.lookup(frame['rf_data']).typeid, first[serial]))
+    drained = []
+    for serial in sources:
+        rows = [(rowid, stamp, sensortype, fields) for rowid, source, stamp, sensortype, fields in spooled if source == serial]
+        early = windowRows([row for row in rows if row[1] <= begin + 300], now=begin + 300)    #part way through
+        assert all(stamp + 60 <= begin + 300 for ids, sensortype, fields, stamp in early)    #the open window stays spooled
+        done = set(rowid for ids, sensortype, fields, stamp in early for rowid in ids)
+        late = windowRows([row for row in rows if row[0] not in done], now=begin + minutes * 60 + 60)
+        drained += [(serial, stamp, len(ids)) for ids, sensortype, fields, stamp in early + late]
+    assert sorted(drained) == sorted((s, stamp, summary.values()[0][3]) for s, t, f, stamp, summary in out)
+    print "aggregating the spooled readings at upload time gives the same %d windows" % len(drained)
+
+    best = None
+    for r in range(3):
+        aggregator = Aggregator(lambda *args: None)
+        start = time.time()
+        for stamp, serial in readings:
+            aggregator.add(serial, sources[serial], first[serial], begin + stamp)
+        best = min(best, time.time() - start) if best is not None else time.time() - start
+    print "%.1f us per reading" % (best / len(readings) * 1e6)
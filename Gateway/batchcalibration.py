@@ -0,0 +1,75 @@
+#! /usr/bin/python
+
+# Vectorised versions of calibration.calibrate_0..calibrate_4 for calibrating
+# large blocks of readings at once (backfills, buffered uploads).
+# Each sensor type applies its linear / power-law models in one NumPy pass and
+# rounds exactly like the scalar calibrate_N functions.
+
+import numpy as np
+
+from calibration import Coefficients
+
+#per sensor type: one model per reading column, in the same order as the calibrate_N arguments
+#('linear', slope, intercept, ndigits) -> round(x*slope+intercept, ndigits)
+#('power', A, B, ndigits)              -> round(A*pow(x,B), ndigits)
+MODELS = {
+    0: [('linear', 'VOC_Slope', 'VOC_Intercept', 2),
+        ('linear', 'PM2_5_Slope', 'PM2_5_Intercept', 0),
+        ('linear', 'PM10_Slope', 'PM10_Intercept', 0)],
+    1: [('linear', 'Temp_Slope', 'Temp_Intercept', 1),
+        ('linear', 'Humid_Slope', 'Humid_Intercept', 1),
+        ('linear', 'Lux_Slope', 'Lux_Intercept', 0)],
+    3: [('power', 'CO2_A', 'CO2_B', 0)],
+    4: [('power', 'CO2_A', 'CO2_B', 0),
+        ('linear', 'VOC_Slope', 'VOC_Intercept', 2),
+        ('linear', 'PM2_5_Slope', 'PM2_5_Intercept', 0),
+        ('linear', 'PM10_Slope', 'PM10_Intercept', 0)],
+}
+
+COLUMN = dict((name, i) for i, name in enumerate(Coefficients._fields))
+
+#rounds half away from zero like the builtin round() used by the scalar path.
+#values that land (almost) exactly on a half are re-rounded with round() itself so
+#binary representation edge cases (e.g. 2.675) resolve identically
+def round_half_away(values, ndigits):
+    scale = 10.0 ** ndigits
+    scaled = np.abs(values * scale)
+    whole = np.floor(scaled)
+    result = np.copysign(np.floor(scaled + 0.5), values) / scale
+    ties = np.abs(scaled - whole - 0.5) <= 1e-7 * np.maximum(1.0, scaled)
+    for i in np.flatnonzero(ties & np.isfinite(values)):
+        result.flat[i] = round(values.flat[i], ndigits)
+    return result
+
+#builds a (len(sources), 14) coefficient matrix - one calibration lookup per distinct source.
+#sources missing from the calibration file get NaN coefficients
+def coefficient_matrix(store, sources):
+    sources = np.asarray(sources)
+    unique, inverse = np.unique(sources, return_inverse=True)
+    table = np.empty((len(unique), len(COLUMN)))
+    for i, serial in enumerate(unique):
+        record = store.coefficients(serial)
+        table[i] = np.nan if record is None else record
+    return table[inverse]
+
+#calibrates arrays of readings from many Qubes of one sensor type.
+#returns a tuple of float arrays in the same order as calibrate_N returns its values;
+#readings from sources without calibration data come back as NaN
+def calibrate_batch(store, sources, sensortype, *readings):
+    if sensortype not in MODELS:
+        return tuple(np.asarray(column, dtype=float) for column in readings)
+    models = MODELS[sensortype]
+    if len(readings) != len(models):
+        raise ValueError("sensor type %s expects %d reading columns, got %d" % (sensortype, len(models), len(readings)))
+    coeffs = coefficient_matrix(store, sources)
+    results = []
+    for (model, first, second, ndigits), column in zip(models, readings):
+        x = np.asarray(column, dtype=float)
+        a = coeffs[:, COLUMN[first]]
+        b = coeffs[:, COLUMN[second]]
+        if model == 'linear':
+            y = x * a + b
+        else:
+            y = a * np.power(x, b)
+        results.append(round_half_away(y, ndigits))
+    return tuple(results)
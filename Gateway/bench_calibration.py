@@ -0,0 +1,104 @@
+#! /usr/bin/python
+
+# Compares the per-reading calibrate_N loop with batchcalibration.calibrate_batch
+# on synthetic readings from the Qubes listed in Calib_CSV.csv, and checks that
+# both paths give identical results - exits with status 1 if they don't. The
+# coefficients in Calib_CSV.csv are all 1 and 0, so the Qubes get random slopes
+# and intercepts for the comparison, which exercises the scaling and rounding.
+# usage: python bench_calibration.py [readings per sensor type]
+
+import os
+import sys
+import csv
+import time
+import random
+import shutil
+import tempfile
+
+import numpy as np
+
+import calibration
+import batchcalibration
+
+#random raw readings per sensor type, in calibrate_N argument order
+def synthetic_readings(sensortype, count):
+    if sensortype == 0:
+        return [[round(random.uniform(0, 2), 2) for i in range(count)],
+                [random.randint(0, 150) for i in range(count)],
+                [random.randint(0, 300) for i in range(count)]]
+    elif sensortype == 1:
+        return [[round(random.uniform(15, 30), 1) for i in range(count)],
+                [round(random.uniform(20, 80), 1) for i in range(count)],
+                [random.randint(0, 1500) for i in range(count)]]
+    elif sensortype == 3:
+        return [[random.randint(350, 2500) for i in range(count)]]
+    elif sensortype == 4:
+        return [[random.randint(350, 2500) for i in range(count)],
+                [round(random.uniform(0, 2), 2) for i in range(count)],
+                [random.randint(0, 150) for i in range(count)],
+                [random.randint(0, 300) for i in range(count)]]
+
+SCALAR = {0: calibration.calibrate_0, 1: calibration.calibrate_1,
+          3: calibration.calibrate_3, 4: calibration.calibrate_4}
+
+def scalar_loop(store, sources, sensortype, readings):
+    calibrate = SCALAR[sensortype]
+    results = []
+    for i, source in enumerate(sources):
+        result = calibrate(store, source, sensortype, *[column[i] for column in readings])
+        if not isinstance(result, tuple):
+            result = (result,)
+        results.append(result)
+    return results
+
+#writes a copy of the calibration table with random slopes and intercepts to path
+def random_coefficients(source, path):
+    with open(source) as infile:
+        reader = csv.DictReader(infile)
+        rows = list(reader)
+    with open(path, 'w') as outfile:
+        writer = csv.DictWriter(outfile, reader.fieldnames)
+        writer.writeheader()
+        for row in rows:
+            for column in calibration.CSV_COLUMNS:
+                if column == 'CO2_B':    #an exponent: CO2_A * raw ** CO2_B
+                    row[column] = round(random.uniform(0.9, 1.1), 4)
+                elif column.endswith('Slope') or column == 'CO2_A':
+                    row[column] = round(random.uniform(0.5, 1.5), 4)
+                else:
+                    row[column] = round(random.uniform(-20, 20), 3)
+            writer.writerow(row)
+
+def main(count):
+    random.seed(1)
+    folder = tempfile.mkdtemp()    #the store checks the file's mtime on every lookup, so it stays until the end
+    path = os.path.join(folder, 'Calib_CSV.csv')
+    random_coefficients('Calib_CSV.csv', path)
+    store = calibration.CalibrationStore(path)
+    serials = sorted(store.rows)
+    mismatched = []
+    print "%-5s %8s %12s %12s %9s" % ("type", "readings", "loop (s)", "batch (s)", "speedup")
+    try:
+        for sensortype in sorted(SCALAR):
+            sources = [random.choice(serials) for i in range(count)]
+            readings = synthetic_readings(sensortype, count)
+
+            start = time.time()
+            expected = scalar_loop(store, sources, sensortype, readings)
+            loop_time = time.time() - start
+
+            start = time.time()
+            actual = batchcalibration.calibrate_batch(store, sources, sensortype, *readings)
+            batch_time = time.time() - start
+
+            if not np.array_equal(np.array(expected), np.column_stack(actual)):
+                mismatched.append(sensortype)
+            print "%-5d %8d %12.4f %12.4f %8.1fx" % (sensortype, count, loop_time, batch_time, loop_time / batch_time)
+    finally:
+        shutil.rmtree(folder)
+    if mismatched:
+        print "MISMATCH for sensor types", ", ".join(str(sensortype) for sensortype in mismatched)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,92 @@
+#! /usr/bin/python
+
+# Measures queue latency and idle CPU of the Asynchronous.py consumer loop:
+# the original 100 ms sleep/poll loop versus the blocking consumer that drains bursts.
+# A producer thread plays the part of the XBee callback, enqueueing (arrival time, frame)
+# tuples in bursts of 1-5 frames.
+# usage: python bench_consumer.py [frames] [idle seconds]
+
+import os
+import sys
+import time
+import random
+import threading
+import Queue
+
+FRAME = {'source_addr_long': '\x00\x13\xa2\x00\x40\xd7\xb7\xfc', 'rf_data': '1,45.20, 21.30,310\n'}
+
+#original loop: sleep 100 ms, take at most one packet per tick
+def polling_consumer(packetQueue, latencies, wakeups, stop):
+    while not stop.is_set():
+        time.sleep(0.1)
+        wakeups[0] += 1
+        if packetQueue.qsize() > 0:
+            item = packetQueue.get_nowait()
+            if item is None:
+                return
+            received, packet = item
+            latencies.append(time.time() - received)
+
+#new loop: block until a packet arrives, then drain the burst
+def blocking_consumer(packetQueue, latencies, wakeups, stop):
+    while True:
+        batch = [packetQueue.get()]
+        wakeups[0] += 1
+        while True:
+            try:
+                batch.append(packetQueue.get_nowait())
+            except Queue.Empty:
+                break
+        for item in batch:
+            if item is None:
+                return
+            received, packet = item
+            latencies.append(time.time() - received)
+
+def producer(packetQueue, frames):
+    sent = 0
+    while sent < frames:
+        time.sleep(random.uniform(0.0, 1.0))
+        for i in range(min(random.randint(1, 5), frames - sent)):
+            packetQueue.put((time.time(), FRAME), block = False)
+            sent += 1
+
+def cpu():
+    times = os.times()
+    return times[0] + times[1]
+
+def run(consumer, frames, idle):
+    packetQueue = Queue.Queue()
+    latencies, wakeups, stop = [], [0], threading.Event()
+    thread = threading.Thread(target=consumer, args=(packetQueue, latencies, wakeups, stop))
+    thread.daemon = True
+    thread.start()
+
+    producer(packetQueue, frames)
+    while len(latencies) < frames:
+        time.sleep(0.01)
+
+    wakeups[0] = 0
+    start = cpu()
+    time.sleep(idle)
+    idle_cpu = cpu() - start
+    idle_wakeups = wakeups[0]
+
+    stop.set()
+    packetQueue.put(None)
+    thread.join()
+
+    latencies.sort()
+    mean = sum(latencies) / len(latencies)
+    p95 = latencies[int(len(latencies) * 0.95)]
+    print "%-9s mean %7.2f ms  p95 %7.2f ms  max %7.2f ms | idle: %5.1f wakeups/s, %6.2f ms CPU/s" % (
+        consumer.__name__.split('_')[0], mean * 1000, p95 * 1000, latencies[-1] * 1000,
+        idle_wakeups / idle, idle_cpu * 1000 / idle)
+
+if __name__ == '__main__':
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 150
+    idle = float(sys.argv[2]) if len(sys.argv) > 2 else 10.0
+    random.seed(1)
+    run(polling_consumer, frames, idle)
+    random.seed(1)
+    run(blocking_consumer, frames, idle)
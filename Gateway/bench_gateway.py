@@ -0,0 +1,257 @@
+#! /usr/bin/python
+
+# Benchmarks for the gateway's frame path, on synthetic frames from every sensor type:
+#   - per-function timings for packethandler.unpacket, voc.TVOCcalc, calibration.readRows, the calibrate_N
+#     functions and the schema decode/calibrate used by the gateway
+#   - end-to-end throughput of the gateway itself (ZigB2Netv5.3.py loaded as a module): frames handed to its
+#     frameReceived, processed by its workers into its spool, then drained by its spool drainer to a
+#     local stub Thingspeak server with aggregation off, timed until the spool is empty
+# The synthetic frames use the serials in Calib_CSV.csv with their sensor types (THL -> 1, CO2 -> 3,
+# IAQ -> 0 and 4), plus uncalibrated serials for types 2 and 5.
+# usage: python bench_gateway.py [frames for the end-to-end run] [binary]
+
+import os
+import sys
+import csv
+import json
+import time
+import imp
+import random
+import shutil
+import logging
+import tempfile
+import threading
+import BaseHTTPServer
+import SocketServer
+
+import calibration
+import packethandler
+import schemas
+import voc
+import metrics
+import gatewaylog
+
+CSV_TYPES = {'THL': ["1"], 'CO2': ["3"], 'IAQ': ["0", "4"]}
+EXTRA_TYPES = ["2", "5"]    #types without Qubes in Calib_CSV.csv
+EXTRA_SERIALS = 4           #made-up serials per extra type
+
+#serial number -> sensor type for the synthetic fleet
+def fleet(path='Calib_CSV.csv'):
+    sources = {}
+    with open(path, 'rb') as f:
+        for row in csv.DictReader(f):
+            if row['Serial Number'] and row['Type'] in CSV_TYPES:
+                types = CSV_TYPES[row['Type']]
+                seen = sum(1 for t in sources.values() if t in types)
+                sources[row['Serial Number']] = types[seen % len(types)]
+    for n, sensortype in enumerate(EXTRA_TYPES):
+        for i in range(EXTRA_SERIALS):
+            sources['0013a200ffff%02x%02x' % (n, i)] = sensortype
+    return sources
+
+#raw readings in payload order, as the firmware measures them
+def synthetic_raw(sensortype):
+    if sensortype == "0":
+        return [random.randint(50, 1000), random.randint(0, 150), random.randint(0, 300)]
+    elif sensortype == "1":
+        return [random.randint(2000, 8000), random.randint(1500, 3000), random.choice([random.randint(0, 1500), 0xFFFF])]
+    elif sensortype == "2":
+        return [random.randint(50, 1000), random.randint(0, 1500)]
+    elif sensortype == "3":
+        return [random.randint(350, 2500)]
+    elif sensortype == "4":
+        return [random.randint(50, 1000), random.randint(0, 150), random.randint(0, 300), random.randint(350, 2500)]
+    elif sensortype == "5":
+        return [random.randint(0, 200), random.randint(1500, 3000), random.randint(2000, 8000)]
+
+#ASCII payload in the format each Qube's sketch sends
+def ascii_payload(sensortype, raw):
+    if sensortype == "0":
+        return "0,%.2f,%d,%d" % (raw[0] / 1000.0, raw[1], raw[2])
+    elif sensortype == "1":
+        light = "NaN" if raw[2] == 0xFFFF else str(raw[2])
+        return "1,%.2f, %.2f,%s\n" % (raw[0] / 100.0, raw[1] / 100.0, light)
+    elif sensortype == "2":
+        return "2,%.2f,%d" % (raw[0] / 1000.0, raw[1])
+    elif sensortype == "3":
+        return "3,%d" % raw[0]
+    elif sensortype == "4":
+        return "4,%.2f,%d,%d,%d" % (raw[0] / 1000.0, raw[1], raw[2], raw[3])
+    elif sensortype == "5":
+        return "5,%d,%.1f,%.1f" % (raw[0], raw[1] / 100.0, raw[2] / 100.0)
+
+#one frame as ZigBee.wait_read_frame() returns it (only the keys the gateway uses)
+def synthetic_frame(source, sensortype, binary=False):
+    raw = synthetic_raw(sensortype)
+    if binary:
+        payload = schemas.SCHEMAS[sensortype].pack(raw)
+    else:
+        payload = ascii_payload(sensortype, raw)
+    return {'source_addr_long': source.decode('hex'), 'rf_data': payload}
+
+#count frames from random Qubes of the fleet
+def synthetic_frames(sources, count, binary=False):
+    serials = sorted(sources)
+    return [synthetic_frame(serial, sources[serial], binary) for serial in (random.choice(serials) for i in range(count))]
+
+#best time per call in microseconds
+def per_call(function, args, repeat=3):
+    best = None
+    for r in range(repeat):
+        start = time.time()
+        for arg in args:
+            function(*arg)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(args) * 1e6
+
+def function_timings(store, sources, count):
+    frames = dict((sensortype, [f for f in synthetic_frames(sources, count * 3) if f['rf_data'][0] == sensortype][:count])
+                  for sensortype in sorted(schemas.SCHEMAS))
+    calibrated = dict((sensortype, [(f['source_addr_long'].encode('hex'), schemas.SCHEMAS[sensortype].decode(f['rf_data']))
+                                    for f in frames[sensortype]]) for sensortype in frames)
+    timings = []
+    for sensortype in sorted(frames):
+        timings.append(("packethandler.unpacket type " + sensortype, per_call(packethandler.unpacket,
+                        [(f['rf_data'], int(sensortype)) for f in frames[sensortype]])))
+    ratios = [(random.randint(50, 1000) / 1000.0,) for i in range(count)]
+    timings.append(("voc.TVOCcalc", per_call(voc.TVOCcalc, ratios)))
+    table = voc.TVOCTable()
+    timings.append(("voc.TVOCTable", per_call(table, ratios)))
+    serials = sorted(store.rows)
+    timings.append(("calibration.readRows", per_call(calibration.readRows,
+                    [(store, serial, int(sources[serial])) for serial in (random.choice(serials) for i in range(count))])))
+    arguments = {0: lambda r: (r.floatTVOC, r.intPM2_5, r.intPM10),
+                 1: lambda r: (r.floatTemp, r.floatHum, r.intLight),
+                 3: lambda r: (r.intCO2,),
+                 4: lambda r: (r.intCO2, r.floatTVOC, r.intPM2_5, r.intPM10)}
+    for sensortype, args in sorted(arguments.items()):
+        calibrate = getattr(calibration, 'calibrate_%d' % sensortype)
+        calls = [(store, source, sensortype) + args(r)
+                 for source, r in calibrated[str(sensortype)] if source in store]
+        timings.append(("calibration.calibrate_%d" % sensortype, per_call(calibrate, calls)))
+    for sensortype in sorted(frames):
+        schema = schemas.SCHEMAS[sensortype]
+        timings.append(("schemas decode type " + sensortype, per_call(schema.decode, [(f['rf_data'],) for f in frames[sensortype]])))
+        timings.append(("schemas calibrate type " + sensortype, per_call(schema.calibrate,
+                        [(store, source, r) for source, r in calibrated[sensortype]])))
+    return timings
+
+#a stub Thingspeak: an empty channel list, a new channel for every POST /channels.json, a write key for every
+#channel, and every bulk update accepted and counted. No rate limit
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True    #headers and body are written separately; delayed ACKs would add 40 ms to every request
+    def body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    def reply(self, status, data):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    def do_GET(self):
+        self.body()
+        self.reply(200, json.dumps({'channels': []}))
+    def do_PUT(self):
+        self.body()
+        self.reply(200, json.dumps({'api_keys': [{'api_key': 'KEY' + self.path.split('/')[-1].split('.')[0], 'write_flag': True}]}))
+    def do_POST(self):
+        body = self.body()
+        with self.server.lock:
+            if self.path == '/channels.json':
+                self.server.channels += 1
+                reply = json.dumps({'id': 1000 + self.server.channels})
+            else:
+                self.server.requests += 1
+                self.server.updates += len(json.loads(body)['updates'])
+                reply = "{}"
+        self.reply(202 if reply == "{}" else 200, reply)
+    def log_message(self, *args):
+        pass
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    lock = threading.Lock()
+    channels = 0
+    requests = 0
+    updates = 0
+
+#loads ZigB2Netv5.3.py from folder as a module - its main() isn't run. It keeps its spool and json files in the current folder
+def load_gateway(folder):
+    return imp.load_source('gateway', os.path.join(folder, 'ZigB2Netv5.3.py'))
+
+#frames -> the gateway's own path: frameReceived (duplicate filter, frame queue) -> its worker threads (processFrame:
+#decode, calibrate, history, spool), then its spool drainer (channels created and write keys fetched from the stub,
+#bulk updates) -> stub Thingspeak. Aggregation is off, so every reading is uploaded.
+#returns (seconds until every frame was spooled, seconds until the spool was empty, bulk requests, readings uploaded,
+#frames dropped as duplicates or errors)
+def end_to_end(frames):
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    stub = threading.Thread(target=server.serve_forever)
+    stub.daemon = True
+    stub.start()
+    here = os.path.dirname(os.path.abspath(__file__))
+    folder = tempfile.mkdtemp()
+    shutil.copy(os.path.join(here, 'Calib_CSV.csv'), folder)
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        gateway = load_gateway(here)
+        gateway.configure("127.0.0.1:%d" % server.server_port, interval=1e-6, windows={})    #the stub has no rate limit
+        workers = [threading.Thread(target=gateway.uploadWorker) for i in range(gateway.UPLOAD_WORKERS)]
+        for worker in workers:
+            worker.start()
+        gateway.outputs.start()
+        lost = lambda: (gateway.duplicates.duplicates +
+                        metrics.FRAMES_DROPPED.value('unknown_type') + metrics.FRAMES_DROPPED.value('error'))
+
+        start = time.time()
+        for frame in frames:
+            while gateway.frameQueue.full():    #a serial port delivers far slower; here we wait for the workers instead
+                time.sleep(0.0005)
+            gateway.frameReceived('bench', frame)
+        for worker in workers:
+            gateway.frameQueue.put(None)
+        for worker in workers:
+            worker.join()    #every reading is in the spool once its worker is done with it
+        spooled = time.time() - start
+        while len(gateway.readingSpool):
+            if not gateway.spoolDrainer.drain(everything=True):
+                raise RuntimeError("the stub refused an upload")
+        drained = time.time() - start
+
+        gateway.outputs.stop()
+        gateway.readingSpool.close()
+        gateway.writeKey_dict.close()
+        gateway.conn.close()
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        shutil.rmtree(folder)
+    return spooled, drained, server.requests, server.updates, lost()
+
+def main(count, binary):
+    gatewaylog.setup(logging.ERROR, logging.ERROR)    #no warning for every uncalibrated serial
+    random.seed(1)
+    store = calibration.CalibrationStore('Calib_CSV.csv')
+    sources = fleet()
+    print len(sources), "Qubes:", ", ".join("type %s x%d" % (t, sources.values().count(t)) for t in sorted(set(sources.values())))
+
+    timings = function_timings(store, sources, 2000)
+    print
+    print "%-32s %10s" % ("function", "us/call")
+    for name, micros in timings:
+        print "%-32s %10.1f" % (name, micros)
+
+    frames = synthetic_frames(sources, count, binary)
+    spooled, drained, requests, updates, lost = end_to_end(frames)
+    print
+    print "end to end through the gateway, %d %s frames, without aggregation:" % (count, "binary" if binary else "ASCII")
+    print "  %d frames received, %d dropped as duplicates or errors" % (count, lost)
+    print "  decoded, calibrated and spooled in %.2f s (%.0f frames/s)" % (spooled, count / spooled)
+    print "  %d readings uploaded in %d bulk requests, spool empty after %.2f s (%.0f readings/s, %.0f requests/s)" % (
+        updates, requests, drained, updates / drained, requests / drained)
+    print "  a fleet of Qubes reporting every 30 s needs %.1f frames/s per 100 Qubes" % (100 / 30.0)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000, 'binary' in sys.argv[2:])
@@ -0,0 +1,233 @@
+#! /usr/bin/python
+
+# Buffered uploads to Thingspeak's bulk update endpoint.
+# Readings are collected per channel with their timestamp and sent as one
+# POST /channels/<id>/bulk_update.json once a channel has max_size readings
+# waiting or its oldest reading is older than max_age seconds.
+# A channel whose update fails keeps its readings (the newest BULK_LIMIT) and is not tried
+# again for retry_interval seconds, doubling with each further failure up to max_retry_interval.
+# A flush also waits for the channel's token in a scheduler.RateLimiter (Thingspeak's per-channel
+# rate limit) and for one of its slots, which cap the requests in flight.
+
+import json
+import time
+import logging
+import threading
+
+import connpool
+import metrics
+import scheduler
+
+log = logging.getLogger(__name__)
+
+BULK_LIMIT = 960    #maximum number of updates Thingspeak accepts in one bulk request
+bulkHeaders = {"Content-type": "application/json", "Accept": "application/json"}
+ACCEPTED = (200, 202)    #statuses of a bulk update Thingspeak has taken
+
+#Thingspeak timestamp format for created_at (UTC)
+def bulkStamp(stamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(stamp))
+
+#sends a list of updates (dicts of fieldN: value plus created_at) to one channel. Returns the HTTP status
+#(200 or 202 when accepted), or None if Thingspeak couldn't be reached
+
+def bulkSend(pool, channelID, writeKey, updates):
+    body = json.dumps({'write_api_key': writeKey, 'updates': updates})
+    start = time.time()
+    try:
+        status, reason, data = pool.request("POST", "/channels/" + str(channelID) + "/bulk_update.json", body, bulkHeaders)
+    except Exception as e:
+        metrics.STAGE_SECONDS.since(start, 'upload')
+        metrics.UPLOADS.inc('bulk', 'failure')
+        log.warning("bulk update of channel %s failed - connection probably timed-out: %s", channelID, e)
+        return None
+    metrics.STAGE_SECONDS.since(start, 'upload')
+    if status in ACCEPTED:
+        metrics.UPLOADS.inc('bulk', 'success')
+        metrics.UPLOADED_READINGS.add(len(updates))
+        return status
+    metrics.UPLOADS.inc('bulk', 'failure')
+    log.warning("bulk update of channel %s failed: %s %s", channelID, status, reason)
+    return status
+
+#as bulkSend, returns True if accepted
+
+def bulkUpdate(pool, channelID, writeKey, updates):
+    return bulkSend(pool, channelID, writeKey, updates) in ACCEPTED
+
+#per-channel buffer of timestamped readings, flushed on size or age
+
+class UploadBuffer(object):
+
+    def __init__(self, pool, max_size=20, max_age=120.0, retry_interval=30.0, max_retry_interval=900.0, limiter=None):
+        self.pool = pool
+        self.limiter = limiter if limiter is not None else scheduler.RateLimiter()
+        self.max_size = min(max_size, BULK_LIMIT)
+        self.max_age = max_age
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.lock = threading.Lock()
+        self.pending = {}    #channelID -> [writeKey, first reading time, [updates]]
+        self.retry = {}      #channelID -> [time of the next attempt, seconds to wait after the next failure] while failing
+        self.thread = None
+        self.running = False
+
+    #queues one reading; fields is a dict like {'field1': 21.5, 'field2': 40.1}
+    def add(self, channelID, writeKey, fields, stamp=None):
+        if stamp is None:
+            stamp = time.time()
+        update = dict(fields)
+        update['created_at'] = bulkStamp(stamp)
+        with self.lock:
+            entry = self.pending.get(channelID)
+            if entry is None:
+                entry = self.pending[channelID] = [writeKey, time.time(), []]
+            entry[0] = writeKey
+            entry[2].append(update)
+            if len(entry[2]) > BULK_LIMIT:
+                del entry[2][0]    #failing for a while - keep the newest readings
+            full = len(entry[2]) >= self.max_size and not self.waiting(channelID, time.time())
+        if full:
+            self.flush(channelID)
+
+    #True while a failed channel waits for its next attempt. Caller holds the lock
+    def waiting(self, channelID, now):
+        retry = self.retry.get(channelID)
+        return retry is not None and now < retry[0]
+
+    #sends everything waiting for one channel, if its rate limit allows (wait=True waits for it).
+    #Failed updates are put back (up to BULK_LIMIT) for the next attempt, which is held off for the channel's retry interval
+    def flush(self, channelID, wait=False):
+        with self.lock:
+            if channelID not in self.pending:
+                return True
+        if wait:
+            time.sleep(self.limiter.delay(channelID))
+        if not self.limiter.take(channelID):
+            return False    #sent to too recently - flushDue tries again
+        with self.lock:
+            entry = self.pending.pop(channelID, None)
+        if not entry:
+            return True
+        writeKey, first, updates = entry
+        with self.limiter.slots:
+            ok = bulkUpdate(self.pool, channelID, writeKey, updates)
+        if ok:
+            with self.lock:
+                self.retry.pop(channelID, None)
+            return True
+        with self.lock:
+            newer = self.pending.get(channelID)
+            if newer is not None:
+                updates = updates + newer[2]
+                writeKey = newer[0]    #added while the request was in flight - may replace a revoked key
+            self.pending[channelID] = [writeKey, first, updates[-BULK_LIMIT:]]
+            wait = self.retry.get(channelID, [0, self.retry_interval])[1]
+            self.retry[channelID] = [time.time() + wait, min(wait * 2, self.max_retry_interval)]
+        log.info("channel %s: %d readings kept, next attempt in %.0f s", channelID, len(updates[-BULK_LIMIT:]), wait)
+        return False
+
+    #flushes channels whose oldest reading has waited longer than max_age, except those waiting to retry
+    def flushDue(self):
+        now = time.time()
+        with self.lock:
+            due = [channelID for channelID, entry in self.pending.items()
+                   if now - entry[1] >= self.max_age and not self.waiting(channelID, now)]
+        for channelID in due:
+            self.flush(channelID)
+
+    def flushAll(self):
+        with self.lock:
+            channels = list(self.pending)
+        for channelID in channels:
+            self.flush(channelID, wait=True)
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(entry[2]) for entry in self.pending.values())
+
+    #starts a background thread that flushes aged channels even when no new readings arrive
+    def start(self, interval=1.0):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=(interval,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, interval):
+        while self.running:
+            time.sleep(interval)
+            self.flushDue()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.flushAll()
+
+# test routine - runs a stub Thingspeak server on localhost and flushes a few readings to it
+
+if __name__ == '__main__':
+    import BaseHTTPServer
+    import SocketServer
+
+    received = []
+    inflight = threading.Event()
+    replaced = threading.Event()
+
+    class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"    #keep-alive, like Thingspeak
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            received.append((self.path, json.loads(body)))
+            reply = '{"success":true}'
+            status = 400 if '/1003/' in self.path else 202    #a channel whose updates are refused
+            if json.loads(body)['write_api_key'] == 'OLD1004':    #a revoked key, replaced while its request is in flight
+                inflight.set()
+                replaced.wait(5)
+                status = 401
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+        def log_message(self, *args):
+            pass
+
+    class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    stub = threading.Thread(target=server.serve_forever)
+    stub.daemon = True
+    stub.start()
+
+    logging.basicConfig(level=logging.ERROR)
+    pool = connpool.ConnectionPool("127.0.0.1:%d" % server.server_port)
+    buf = UploadBuffer(pool, max_size=5, max_age=0.5, retry_interval=0.4, limiter=scheduler.RateLimiter(0.2))
+    buf.start(interval=0.1)
+    for i in range(12):
+        buf.add(1001, 'KEY1001', {'field1': 20.0 + i, 'field2': 45.0, 'field3': 300})
+    buf.add(1002, 'KEY1002', {'field1': 612})
+    buf.add(1003, 'KEY1003', {'field1': 1})
+    time.sleep(2.0)
+    buf.stop()
+
+    revoked = UploadBuffer(pool, max_size=5, max_age=60, retry_interval=60, limiter=scheduler.RateLimiter(0.2))
+    revoked.add(1004, 'OLD1004', {'field1': 1})
+    sender = threading.Thread(target=revoked.flush, args=(1004,))
+    sender.start()
+    inflight.wait(5)
+    revoked.add(1004, 'NEW1004', {'field1': 2})
+    replaced.set()
+    sender.join()
+    assert revoked.pending[1004][0] == 'NEW1004', "the failed batch must not bring back the revoked key"
+    assert revoked.flush(1004, wait=True) and received[-1][1]['write_api_key'] == 'NEW1004' and len(received[-1][1]['updates']) == 2
+    pool.close()
+    server.shutdown()
+    received = [(path, body) for path, body in received if '/1004/' not in path]
+    for path, body in received:
+        print path, len(body['updates']), "updates"
+    print sum(len(body['updates']) for path, body in received), "readings in", len(received), "requests"
+    refused = sum(1 for path, body in received if '/1003/' in path)
+    assert refused <= 4, "refused channel retried %d times" % refused    #0.5, 0.9, 1.7 s, then once more on stop
+    assert len(buf) == 1
+    print pool.created, "connections opened,", pool.reused, "reused"
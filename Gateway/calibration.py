@@ -2,46 +2,99 @@
 
 import math
 import csv
+import os.path
+import logging
+import operator
+from collections import namedtuple
+
+log = logging.getLogger(__name__)
+
+#calibration coefficients for a single Qube, one record per row of Calib_CSV.csv
+Coefficients = namedtuple('Coefficients', ['Temp_Slope','Temp_Intercept','Humid_Slope','Humid_Intercept',
+                                           'Lux_Slope','Lux_Intercept','CO2_A','CO2_B',
+                                           'VOC_Slope','VOC_Intercept','PM10_Slope','PM10_Intercept',
+                                           'PM2_5_Slope','PM2_5_Intercept'])
+
+#CSV column names in the same order as the Coefficients fields
+CSV_COLUMNS = ['Temp_Slope','Temp_Intercept','Humid_Slope','Humid_Intercept',
+               'Lux_Slope','Lux_Intercept','CO2_A','CO2_B',
+               'VOC_Slope','VOC_Intercept','PM10_Slope','PM10_Intercept',
+               'PM25_Slope','PM25_Intercept']
+
+#coefficients returned to calibrate_N for each sensor type (None = no calibration routine)
+TYPE_COEFFICIENTS = {
+    0: ('VOC_Slope','VOC_Intercept','PM10_Slope','PM10_Intercept','PM2_5_Slope','PM2_5_Intercept'),
+    1: ('Temp_Slope','Temp_Intercept','Humid_Slope','Humid_Intercept','Lux_Slope','Lux_Intercept'),
+    2: None,
+    3: ('CO2_A','CO2_B'),
+    4: ('CO2_A','CO2_B','VOC_Slope','VOC_Intercept','PM10_Slope','PM10_Intercept','PM2_5_Slope','PM2_5_Intercept'),
+    5: None,
+}
+
+#Calibration store - parses Calib_CSV.csv once and indexes the coefficients by serial number
+#(XBee source_addr_long as hex). The file is only re-read when its modification time changes.
+class CalibrationStore(object):
+
+    def __init__(self, path='Calib_CSV.csv'):
+        self.path = path
+        self.mtime = None
+        self.rows = {}
+        self.getters = {}
+        for sensortype, names in TYPE_COEFFICIENTS.items():
+            if names is not None:
+                self.getters[sensortype] = operator.attrgetter(*names)
+        self.refresh()
+
+    #re-reads the CSV if it has been modified since the last load
+    def refresh(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            log.warning("calibration file not found: %s", self.path)
+            return
+        if mtime == self.mtime:
+            return
+        rows = {}
+        with open(self.path, 'rb') as infile:
+            for row in csv.DictReader(infile):
+                if not row.get("Serial Number"):
+                    continue    #asset not yet assigned to a Qube
+                try:
+                    rows[row["Serial Number"]] = Coefficients(*[float(row[column]) for column in CSV_COLUMNS])
+                except (KeyError, TypeError, ValueError):
+                    log.warning("skipping bad calibration row for %s", row.get("Serial Number"))
+        self.rows = rows
+        self.mtime = mtime
+
+    #returns the full coefficient record for a serial number, or None if it isn't in the file
+    def coefficients(self, serial):
+        self.refresh()
+        return self.rows.get(serial)
+
+    #returns the coefficients used by calibrate_N for the given sensor type
+    def lookup(self, serial, sensortype):
+        record = self.coefficients(serial)
+        if record is None:
+            log.warning("sensor ID %s not found", serial)
+            return
+        if sensortype not in TYPE_COEFFICIENTS:
+            log.warning("unhandled sensor type %s in calibration routine", sensortype)
+            return
+        getter = self.getters.get(sensortype)
+        if getter is None:
+            return
+        return getter(record)
+
+    def __contains__(self, serial):
+        return serial in self.rows
+
+    def __len__(self):
+        return len(self.rows)
 
 def readRows(calibration_data, newSource, sensortype):
-    print "source address is ", newSource
-    for row in calibration_data:
-        Serial_Number=row["Serial Number"]
-        Temp_Slope=float(row["Temp_Slope"])
-        Temp_Intercept=float(row["Temp_Intercept"])
-        Humid_Slope=float(row["Humid_Slope"])
-        Humid_Intercept=float(row["Humid_Intercept"])
-        Lux_Slope=float(row["Lux_Slope"])
-        Lux_Intercept=float(row["Lux_Intercept"])
-        CO2_A=float(row["CO2_A"])
-        CO2_B=float(row["CO2_B"])
-        VOC_Slope=float(row["VOC_Slope"])
-        VOC_Intercept=float(row["VOC_Intercept"])
-        PM10_Slope=float(row["PM10_Slope"])
-        PM10_Intercept=float(row["PM10_Intercept"])
-        PM2_5_Slope=float(row["PM25_Slope"])
-        PM2_5_Intercept=float(row["PM25_Intercept"])
-        if newSource==Serial_Number:
-#           print "Matching CSV Serial Number is: ",Serial_Number
-#	    print "Sensor type is: " ,sensortype
-            if sensortype == 0:
-                return VOC_Slope,VOC_Intercept,PM10_Slope,PM10_Intercept,PM2_5_Slope,PM2_5_Intercept
-            elif sensortype == 1: 
-                return Temp_Slope,Temp_Intercept,Humid_Slope,Humid_Intercept,Lux_Slope,Lux_Intercept
-	    elif sensortype == 2: 
-	        return
-	    elif sensortype == 3: 
-	        return CO2_A,CO2_B
-	    elif sensortype == 4: 
-	        return CO2_A,CO2_B,VOC_Slope,VOC_Intercept,PM10_Slope,PM10_Intercept,PM2_5_Slope,PM2_5_Intercept
-	    elif sensortype == 5: 
-	        return 
-	    else:
-	        print "Unhandled sensor type in calibration routine"
-                return
-    else:
-        print "sensor ID not found"
-    
+    log.debug("source address is %s", newSource)
+    return calibration_data.lookup(newSource, sensortype)
+
 def calibrate_0(Calib_CSV,source,sensortype,floatTVOC,intPM2_5,intPM10):
     VOC_Slope,VOC_Intercept,PM10_Slope,PM10_Intercept,PM2_5_Slope,PM2_5_Intercept = readRows(Calib_CSV, source, sensortype)
     floatTVOC=round(floatTVOC*VOC_Slope+VOC_Intercept,2)
@@ -59,7 +112,7 @@ def calibrate_1(Calib_CSV,packetSource,sensortype,floatTemp,floatHum,intLight):
 #        print (floatTemp, floatHum, intLight)
         return (floatTemp, floatHum, intLight)
     except:
-        print "calibration failed"
+        log.warning("calibration of %s failed", packetSource)
         return (floatTemp, floatHum, intLight)
 
 def calibrate_2():
@@ -73,7 +126,7 @@ def calibrate_3(Calib_CSV,packetSource,sensortype,preCO2):
 
 def calibrate_4(Calib_CSV,packetSource,sensortype,preCO2,floatTVOC,intPM2_5,intPM10):
     CO2_A,CO2_B,VOC_Slope,VOC_Intercept,PM10_Slope,PM10_Intercept,PM2_5_Slope,PM2_5_Intercept = readRows(Calib_CSV, packetSource, sensortype)
-    postCO2=round(CO2_A*pow(postCO2,CO2_B),0)
+    postCO2=round(CO2_A*pow(preCO2,CO2_B),0)
     floatTVOC=round(floatTVOC*VOC_Slope+VOC_Intercept,2)
     intPM10=round(intPM10*PM10_Slope+PM10_Intercept,0)
     intPM2_5=round(intPM2_5*PM2_5_Slope+PM2_5_Intercept,0)
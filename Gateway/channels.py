@@ -0,0 +1,134 @@
+#! /usr/bin/python
+
+# Registry of Thingspeak channels, keyed by channel name (the Qube's source address).
+# Known channels are answered from memory with no network call. An unknown name triggers
+# at most one download of the user's channel list per refresh_interval; the result is
+# merged into the registry (never replacing it) and written to channelList.json.
+# Names that still aren't found are remembered as misses for miss_ttl seconds so a new
+# sensor doesn't cause a download for every packet.
+
+import os
+import json
+import time
+import urllib
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+headers = {"Content-type": "application/x-www-form-urlencoded","Accept": "text/plain"}
+
+class ChannelRegistry(object):
+
+    def __init__(self, pool, user_ID, user_key, path='channelList.json', miss_ttl=600.0, refresh_interval=60.0):
+        self.pool = pool
+        self.user_ID = user_ID
+        self.user_key = user_key
+        self.path = path
+        self.miss_ttl = miss_ttl
+        self.refresh_interval = refresh_interval
+        self.lock = threading.RLock()
+        self.ids = {}           #channel name -> channel ID
+        self.misses = {}        #channel name -> time it was last looked up and not found
+        self.lastRefresh = None
+        self.downloads = 0
+        if os.path.isfile(path):
+            self.load()
+
+    #merges the channels saved in channelList.json
+    def load(self):
+        with open(self.path) as infile:
+            json_data_from_file = json.load(infile)
+        self.merge(json_data_from_file['channels'])
+
+    #adds/updates channels from a Thingspeak channel listing, returns the number of new names
+    def merge(self, channels):
+        added = 0
+        with self.lock:
+            for channel in channels:
+                name = channel['name']
+                if name not in self.ids:
+                    added += 1
+                self.ids[name] = channel['id']
+                self.misses.pop(name, None)
+        return added
+
+    #writes the registry back to channelList.json (same layout as the Thingspeak listing), atomically
+    def save(self):
+        with self.lock:
+            data = {'channels': [{'name': name, 'id': channelID} for name, channelID in sorted(self.ids.items())]}
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as outfile:
+            json.dump(data, outfile, sort_keys = True, indent = 4)
+        os.rename(temp, self.path)
+
+    #downloads the user's channel list and merges it. Returns False if Thingspeak couldn't be reached
+    def refresh(self):
+        params = urllib.urlencode({'api_key': self.user_key})
+        try:
+            status, reason, data = self.pool.request("GET", "/users/" + self.user_ID + "/channels.json/", params, headers)
+        except Exception:
+            log.warning("no response - had difficulty communicating with Thingspeak, check network connection")
+            return False
+        if status != 200:
+            log.warning("channel list download failed: %s %s", status, reason)
+            return False
+        with self.lock:
+            self.downloads += 1
+            self.lastRefresh = time.time()
+            added = self.merge(json.loads(data)['channels'])
+        if added:
+            self.save()
+        log.info("channel list downloaded, %d new channels", added)
+        return True
+
+    #channel ID for a name from memory only (None if unknown)
+    def lookup(self, name):
+        with self.lock:
+            return self.ids.get(name)
+
+    #True if the channel is known, False if Thingspeak doesn't have it (cached for miss_ttl),
+    #None if it couldn't be checked because Thingspeak is unreachable
+    def resolve(self, name):
+        with self.lock:
+            if name in self.ids:
+                return True
+            now = time.time()
+            missed = self.misses.get(name)
+            if missed is not None and now - missed < self.miss_ttl:
+                return False
+            recent = self.lastRefresh is not None and now - self.lastRefresh < self.refresh_interval
+        if not recent and not self.refresh():
+            return None
+        with self.lock:
+            if name in self.ids:
+                return True
+            self.misses[name] = time.time()
+            return False
+
+    #registers a channel created by the gateway
+    def add(self, name, channelID):
+        with self.lock:
+            if self.ids.get(name) == channelID:
+                return
+            self.ids[name] = channelID
+            self.misses.pop(name, None)
+        self.save()
+
+    def __contains__(self, name):
+        return self.lookup(name) is not None
+
+    def __getitem__(self, name):
+        channelID = self.lookup(name)
+        if channelID is None:
+            raise KeyError(name)
+        return channelID
+
+    def __setitem__(self, name, channelID):
+        self.add(name, channelID)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return repr(self.ids)
@@ -0,0 +1,87 @@
+#! /usr/bin/python
+
+# Thread-safe pool of keep-alive HTTP connections to one host.
+# Connections are handed out to one request at a time and returned afterwards,
+# so several upload workers can share the pool without re-connecting for every call.
+# A pooled connection that turns out to be dead (server closed the keep-alive socket,
+# network dropped) is discarded and the request is retried once on a fresh connection - but only
+# when the failure shows the server never got the request (reset or broken pipe on sending, or the
+# socket closed before any response). A timeout means the server may still be processing it,
+# so the request is not repeated: a slow POST would otherwise be applied twice.
+
+import errno
+import socket
+import httplib
+import threading
+import Queue
+
+STALE_ERRORS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)    #a kept-alive socket the server has closed
+
+#True if a request failed because its connection was already dead, before the server could act on it
+def stale(error):
+    if isinstance(error, socket.timeout):
+        return False
+    if isinstance(error, httplib.BadStatusLine):
+        return True    #closed without a response
+    return isinstance(error, socket.error) and error.errno in STALE_ERRORS
+
+class ConnectionPool(object):
+
+    def __init__(self, host, size=4, timeout=10):
+        self.host = host
+        self.timeout = timeout
+        self.idle = Queue.LifoQueue(size)    #most recently used first - least likely to have been closed by the server
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def connect(self):
+        with self.lock:
+            self.created += 1
+        return httplib.HTTPConnection(self.host, timeout=self.timeout)
+
+    #takes an idle connection, or opens a new one if none are free. Returns (connection, reused)
+    def acquire(self):
+        try:
+            conn = self.idle.get_nowait()
+        except Queue.Empty:
+            return self.connect(), False
+        with self.lock:
+            self.reused += 1
+        return conn, True
+
+    #returns a healthy connection to the pool, closing it if the pool is full
+    def release(self, conn):
+        try:
+            self.idle.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    #performs one request and reads the whole response so the connection can be reused.
+    #returns (status, reason, data); raises httplib.HTTPException / socket.error if the request fails on a fresh connection
+    def request(self, method, url, body=None, headers={}):
+        conn, reused = self.acquire()
+        while True:
+            try:
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if not reused or not stale(e):
+                    raise
+                conn, reused = self.connect(), False    #stale keep-alive socket - retry once on a new connection
+                continue
+            if response.will_close:
+                conn.close()
+            else:
+                self.release(conn)
+            return response.status, response.reason, data
+
+    #closes all idle connections
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                return
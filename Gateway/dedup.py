@@ -0,0 +1,101 @@
+#! /usr/bin/python
+
+# Suppression of duplicate frames. A Qube sends its frame again when it doesn't get a TX status back
+# from its XBee (getDeliveryStatus() in the sketches), so the coordinator can receive the same reading
+# two or more times within a second or so. Every copy would be decoded, calibrated and uploaded as a
+# separate reading.
+# DuplicateFilter remembers the hashes of the last few payloads of each source with their arrival time;
+# a frame whose payload matches one from the same source that arrived less than window seconds earlier
+# is a duplicate. The window is much shorter than the reporting interval, so two genuine readings that
+# happen to be identical are both kept. Memory is fixed: a ring of size entries per source, and at most
+# max_sources sources (least recently heard from forgotten first).
+# usage: python dedup.py   checks the filter on a synthetic capture with retransmissions and times it
+
+import time
+import threading
+from collections import deque, OrderedDict
+
+WINDOW = 5.0           #seconds within which an identical payload from the same source is a retransmission
+SIZE = 4               #payloads remembered per source
+MAX_SOURCES = 1024     #sources remembered
+
+class DuplicateFilter(object):
+
+    def __init__(self, window=WINDOW, size=SIZE, max_sources=MAX_SOURCES):
+        self.window = window
+        self.size = size
+        self.max_sources = max_sources
+        self.lock = threading.Lock()
+        self.recent = OrderedDict()    #source -> deque of (payload hash, arrival time), least recently heard from first
+        self.duplicates = 0
+
+    #returns True if payload from source is a copy of one received less than window seconds before now,
+    #otherwise remembers it and returns False
+    def duplicate(self, source, payload, now=None):
+        if now is None:
+            now = time.time()
+        digest = hash(payload)
+        with self.lock:
+            ring = self.recent.pop(source, None)
+            if ring is None:
+                ring = deque(maxlen=self.size)
+                if len(self.recent) >= self.max_sources:
+                    self.recent.popitem(last=False)
+            self.recent[source] = ring
+            for seen, arrival in ring:
+                if seen == digest and now - arrival < self.window:
+                    self.duplicates += 1
+                    return True
+            ring.append((digest, now))
+            return False
+
+    #filters a received frame dict, as the frame sources deliver them
+    def check(self, frame, now=None):
+        return self.duplicate(frame['source_addr_long'], frame['rf_data'], now)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.recent)
+
+if __name__ == '__main__':
+    import random
+    import bench_gateway
+
+    random.seed(1)
+    sources = bench_gateway.fleet()
+    frames = []
+    copies = 0
+    for serial, sensortype in sources.items():
+        offset = random.uniform(0, 30)
+        frame = bench_gateway.synthetic_frame(serial, sensortype)
+        for n in range(20):
+            if n % 5:    #every fifth reading repeats the previous payload, like a CO2 Qube with a steady room
+                frame = bench_gateway.synthetic_frame(serial, sensortype)
+            stamp = offset + 30 * n
+            frames.append((stamp, frame, False))
+            for retry in range(random.choice([0, 0, 0, 1, 2])):    #retransmissions within a second
+                stamp += random.uniform(0.05, 0.5)
+                frames.append((stamp, frame, True))
+                copies += 1
+    frames.sort(key=lambda item: item[0])
+
+    dedup = DuplicateFilter()
+    for stamp, frame, copy in frames:
+        assert dedup.check(frame, stamp) == copy
+    print "%d frames, %d retransmissions suppressed, no genuine reading dropped" % (len(frames), dedup.duplicates)
+    assert dedup.duplicates == copies
+
+    small = DuplicateFilter(max_sources=10)
+    for stamp, frame, copy in frames:
+        small.check(frame, stamp)
+    assert len(small) == 10
+
+    best = None
+    for r in range(3):
+        dedup = DuplicateFilter()
+        start = time.time()
+        for stamp, frame, copy in frames:
+            dedup.check(frame, stamp)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print "%.1f us per frame" % (best / len(frames) * 1e6)
@@ -0,0 +1,471 @@
+#! /usr/bin/python
+
+# Frame sources for the gateway scripts - where received XBee API frames come from.
+#   SerialSource(port)          the XBee coordinator on a serial port (the default, /dev/ttyAMA0). A drain thread
+#                               reads the UART continuously, in whatever chunks have arrived, splits the bytes
+#                               into API frames and keeps them in a bounded ring until read() takes them, so
+#                               frames are never lost while the gateway is busy with something else
+#   ReplaySource(frames, speed) captured frames replayed in-process, with their original spacing
+#                               divided by speed (0 = as fast as possible)
+#   FakeSerialPort(frames, speed) the same replay written as raw API frames into a pty, so the serial and
+#                               XBee parsing path runs exactly as on the Pi
+# All sources have read() (blocks for the next frame dict, as ZigBee.wait_read_frame() returns it),
+# start(callback) (reader thread calling callback(frame), like ZigBee(callback=...)), isOpen() and close().
+# openSource(spec) picks one from a string, so the scripts take them as arguments - one per XBee coordinator:
+#   /dev/ttyUSB0                   serial port
+#   replay:capture.jsonl@10        in-process replay at 10x
+#   pty:capture.jsonl@10           replay through a pty-backed fake serial port at 10x
+# openSources(specs) opens several, e.g. USB XBee dongles on separate PANs, each read by its own thread.
+# Loss on a serial port is counted in gateway_port_frames_lost_total by reason:
+#   checksum     frames with a bad checksum, e.g. cut short by an overrun, or a length no XBee frame has
+#   ring_full    frames dropped by policy because nothing took them from the ring - the oldest goes first
+# and bytes lost by the UART or the kernel's tty buffer before the drain thread could read them in
+# gateway_port_overrun_bytes_total (the driver's TIOCGICOUNT counters - not available on ptys and some USB adapters).
+# Captures are JSON lines {"time": seconds, "source_addr_long": hex, "rf_data": hex}; Recorder wraps a
+# source and writes everything it receives to one.
+# usage: python framesource.py   checks frame splitting, checksum resync and ring drops on a pty, and per-port
+#                                 counters with two pty: sources read at once
+#        python framesource.py <capture.jsonl> [minutes] [ports]   writes a synthetic capture of the Qubes in
+#        Calib_CSV.csv reporting every 30 s (see bench_gateway.py). With ports > 1 the Qubes are split across
+#        that many captures, capture-1.jsonl, capture-2.jsonl..., one per fake coordinator:
+#        python ZigB2Netv5.3.py pty:capture-1.jsonl@10 pty:capture-2.jsonl@10
+
+import os
+import json
+import time
+import tty
+import fcntl
+import struct
+import logging
+import threading
+from collections import deque
+
+import serial
+from xbee import ZigBee
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+REPORT_INTERVAL = 30.0    #seconds between readings from one Qube in synthetic captures
+RING_SIZE = 1000          #received frames a serial port keeps waiting for read() before dropping the oldest
+MAX_FRAME_LENGTH = 300    #longest frame data accepted - an explicit RX frame (0x91) with the largest fragmented payload is 273 bytes
+TIOCGICOUNT = 0x545D      #Linux ioctl returning a tty's interrupt counters (struct serial_icounter_struct)
+
+#loads a capture as [(time, frame), ...]
+def load(path):
+    frames = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                frames.append((record['time'], rxFrame(record['source_addr_long'].decode('hex'),
+                                                       record['rf_data'].decode('hex'))))
+    return frames
+
+#writes [(time, frame), ...] as a capture
+def save(path, frames):
+    with open(path, 'w') as f:
+        for stamp, frame in frames:
+            f.write(captureLine(stamp, frame))
+
+def captureLine(stamp, frame):
+    return json.dumps({'time': stamp, 'source_addr_long': frame['source_addr_long'].encode('hex'),
+                       'rf_data': frame['rf_data'].encode('hex')}) + "\n"
+
+#frame dict as the xbee library returns a ZigBee receive packet
+def rxFrame(source, data):
+    return {'id': 'rx', 'source_addr_long': source, 'source_addr': '\xff\xfe', 'options': '\x01', 'rf_data': data}
+
+#raw 0x90 receive packet in API mode 1, as the coordinator sends it over the UART
+def encodeFrame(frame):
+    body = '\x90' + frame['source_addr_long'] + frame.get('source_addr', '\xff\xfe') + frame.get('options', '\x01') + frame['rf_data']
+    return '\x7e' + struct.pack('>H', len(body)) + body + chr(0xff - (sum(map(ord, body)) & 0xff))
+
+#parses "path@speed" - speed defaults to 1 (original timing)
+def replaySpec(spec):
+    path, sep, speed = spec.rpartition('@')
+    if not sep:
+        return spec, 1.0
+    return path, float(speed)
+
+def openSource(spec, baudrate=9600):
+    if spec.startswith('replay:'):
+        path, speed = replaySpec(spec[len('replay:'):])
+        source = ReplaySource(load(path), speed)
+        source.name = spec
+        return source
+    if spec.startswith('pty:'):
+        path, speed = replaySpec(spec[len('pty:'):])
+        fake = FakeSerialPort(load(path), speed)
+        source = SerialSource(fake.port, baudrate, name=spec)
+        source.fake = fake
+        fake.start()
+        return source
+    return SerialSource(spec, baudrate)
+
+#opens every source in specs - closes the ones already open if one fails
+def openSources(specs, baudrate=9600):
+    sources = []
+    try:
+        for spec in specs:
+            sources.append(openSource(spec, baudrate))
+    except Exception:
+        for source in sources:
+            source.close()
+        raise
+    return sources
+
+#runs read() on a daemon thread and hands every frame to callback until the source is closed.
+#frames, payload bytes and read errors are counted per source name
+def startReader(source, callback):
+    def run():
+        while source.isOpen():
+            try:
+                frame = source.read()
+            except Exception:
+                if source.isOpen():
+                    metrics.PORT_LOST.inc(source.name, 'read_error')
+                    log.warning("error reading frame from %s", source.name, exc_info=True)
+                continue
+            metrics.PORT_FRAMES.inc(source.name)
+            metrics.PORT_BYTES.add(len(frame.get('rf_data', '')), source.name)
+            callback(frame)
+    reader = threading.Thread(target=run, name='reader ' + source.name)
+    reader.daemon = True
+    reader.start()
+    return reader
+
+#UART overrun counts (hardware FIFO + tty buffer) of a serial port, None if the driver doesn't report them
+def overrunCount(port):
+    try:
+        counts = struct.unpack('20i', fcntl.ioctl(port.fileno(), TIOCGICOUNT, '\0' * 80))
+    except (IOError, ValueError, AttributeError):
+        return None
+    return counts[7] + counts[10]    #overrun, buf_overrun
+
+class SerialSource(object):
+
+    def __init__(self, port, baudrate=9600, timeout=1.0, ringSize=RING_SIZE, name=None):
+        self.name = name or port
+        self.fake = None
+        self.port = serial.Serial(port, baudrate=baudrate, timeout=timeout)
+        self.zb = ZigBee(self.port)    #only used to split frames into dicts - the drain thread does the reading
+        self.ring = deque()
+        self.ringSize = ringSize
+        self.available = threading.Condition(threading.Lock())
+        self.buffer = ''
+        self.frames = 0
+        self.overruns = 0
+        self.checksumErrors = 0
+        self.dropped = 0
+        self.port.flushInput()    #clear serial buffer once, before the drain thread starts - nothing is discarded after this
+        self.drainer = threading.Thread(target=self.drain, name='uart ' + self.name)
+        self.drainer.daemon = True
+        self.drainer.start()
+
+    #drain thread - reads whatever the UART has, blocking for up to timeout when it has nothing
+    def drain(self):
+        baseline = overrunCount(self.port)
+        lastCheck = time.time()
+        while self.port.isOpen():
+            try:
+                data = self.port.read(max(self.port.inWaiting(), 1))
+            except Exception:
+                if self.port.isOpen():
+                    log.warning("error reading %s", self.name, exc_info=True)
+                    time.sleep(1.0)
+                continue
+            if data:
+                self.split(data)
+            if baseline is not None and time.time() - lastCheck >= 1.0:
+                lastCheck = time.time()
+                count = overrunCount(self.port)
+                if count is not None and count > baseline:
+                    self.overruns += count - baseline
+                    metrics.PORT_OVERRUN_BYTES.add(count - baseline, self.name)
+                    log.warning("%s: %d bytes lost to UART overruns", self.name, count - baseline)
+                    baseline = count
+        with self.available:
+            self.available.notify_all()
+
+    #splits received bytes into API frames (API mode 1: 0x7E, 2-byte length, frame data, checksum)
+    def split(self, data):
+        buffer = self.buffer + data
+        while True:
+            start = buffer.find('\x7e')
+            if start < 0:
+                buffer = ''
+                break
+            if len(buffer) - start < 3:
+                buffer = buffer[start:]
+                break
+            length = struct.unpack('>H', buffer[start + 1:start + 3])[0]
+            if length > MAX_FRAME_LENGTH:    #a stray or corrupted start byte - don't wait for up to 64 kB behind it
+                self.checksumErrors += 1
+                metrics.PORT_LOST.inc(self.name, 'checksum')
+                buffer = buffer[start + 1:]
+                continue
+            end = start + 3 + length + 1
+            if len(buffer) < end:
+                buffer = buffer[start:]
+                break
+            body = buffer[start + 3:end - 1]
+            if (sum(bytearray(body)) + ord(buffer[end - 1])) & 0xff != 0xff:
+                self.checksumErrors += 1
+                metrics.PORT_LOST.inc(self.name, 'checksum')
+                buffer = buffer[start + 1:]    #resynchronise on the next start byte
+                continue
+            buffer = buffer[end:]
+            if body:
+                try:
+                    frame = self.zb._split_response(body)
+                except Exception:
+                    log.warning("%s: could not parse frame %r", self.name, body, exc_info=True)
+                    continue
+                self.push(frame)
+        self.buffer = buffer
+
+    def push(self, frame):
+        with self.available:
+            if len(self.ring) >= self.ringSize:
+                self.ring.popleft()
+                self.dropped += 1
+                metrics.PORT_LOST.inc(self.name, 'ring_full')
+                if self.dropped & (self.dropped - 1) == 0:    #1st, 2nd, 4th, 8th... drop, not every one
+                    log.warning("%s: frame ring full - %d oldest frames dropped", self.name, self.dropped)
+            self.ring.append(frame)
+            self.frames += 1
+            self.available.notify()
+
+    #blocks for the next frame from the ring - raises EOFError once the port is closed. No timeout: on Python 2 a
+    #timed wait polls, so push() and close() notify instead
+    def read(self):
+        with self.available:
+            while not self.ring:
+                if not self.port.isOpen():
+                    raise EOFError("%s closed" % self.name)
+                self.available.wait()
+            return self.ring.popleft()
+
+    def __len__(self):
+        return len(self.ring)
+
+    def start(self, callback):
+        metrics.PORT_RING_DEPTH.track(self.__len__, self.name)
+        return startReader(self, callback)
+
+    def isOpen(self):
+        return self.port.isOpen()
+
+    def close(self):
+        if self.fake is not None:
+            self.fake.close()
+        self.port.close()
+        with self.available:
+            self.available.notify_all()    #wakes a blocked read() to raise EOFError
+        self.drainer.join(2.0)
+
+class ReplaySource(object):
+
+    def __init__(self, frames, speed=1.0):
+        self.name = "replay"
+        self.frames = iter(frames)
+        self.speed = speed
+        self.first = None
+        self.begin = None
+        self.closed = threading.Event()
+        self.replayed = 0
+
+    #waits until the next frame is due. After the last frame it blocks until close() and raises EOFError
+    def read(self):
+        for stamp, frame in self.frames:
+            now = time.time()
+            if self.first is None:
+                self.first, self.begin = stamp, now
+            elif self.speed > 0:
+                delay = self.begin + (stamp - self.first) / self.speed - now
+                if delay > 0 and self.closed.wait(delay):
+                    break
+            self.replayed += 1
+            return frame
+        if self.replayed:
+            log.info("replay finished, %d frames in %.1f s", self.replayed, time.time() - self.begin)
+            self.replayed = 0
+        self.closed.wait()
+        raise EOFError("replay closed")
+
+    def start(self, callback):
+        return startReader(self, callback)
+
+    def isOpen(self):
+        return not self.closed.is_set()
+
+    def close(self):
+        self.closed.set()
+
+#replays frames as raw API bytes into the master side of a pty - open .port like a serial device.
+#the pty has no baud rate, so frames arrive as fast as their timing allows
+class FakeSerialPort(object):
+
+    def __init__(self, frames, speed=1.0):
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self.slave = slave
+        self.replay = ReplaySource(frames, speed)
+        self.writer = None
+
+    def start(self):
+        self.writer = threading.Thread(target=self.run)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def run(self):
+        while self.replay.isOpen():
+            try:
+                frame = self.replay.read()
+            except EOFError:
+                return
+            os.write(self.master, encodeFrame(frame))
+
+    def close(self):
+        self.replay.close()
+        os.close(self.master)
+        os.close(self.slave)
+
+#passes frames through from another source and appends each one to a capture file
+class Recorder(object):
+
+    def __init__(self, source, path):
+        self.source = source
+        self.name = source.name
+        self.capture = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def read(self):
+        frame = self.source.read()
+        with self.lock:
+            self.capture.write(captureLine(time.time(), frame))
+            self.capture.flush()
+        return frame
+
+    def start(self, callback):
+        return startReader(self, callback)
+
+    def isOpen(self):
+        return self.source.isOpen()
+
+    def close(self):
+        self.source.close()
+        with self.lock:
+            self.capture.close()
+
+if __name__ == '__main__':
+    import sys
+    import random
+    import bench_gateway
+
+    random.seed(1)
+    sources = bench_gateway.fleet()
+
+    if len(sys.argv) < 2:
+        #3000 frames written in 4000-byte chunks that cut frames anywhere, after some line noise, with 10 bad
+        #checksums and two start bytes with impossible lengths (one right before the last frame), into a 500-frame
+        #ring nothing reads from
+        logging.basicConfig(level=logging.ERROR)
+        frames = bench_gateway.synthetic_frames(sources, 3000)
+        encoded = [encodeFrame(rxFrame(frame['source_addr_long'], frame['rf_data'])) for frame in frames]
+        bad = set(random.sample(range(len(encoded)), 10))
+        for i in bad:
+            encoded[i] = encoded[i][:-1] + chr(ord(encoded[i][-1]) ^ 0x55)
+        encoded[1500] = '\x7e\xff\xf0' + encoded[1500]    #would hold back every frame in the next 64 kB
+        encoded[-1] = '\x7e\x01\x2d' + encoded[-1]       #would hold back the last frame until more data arrives
+        data = 'noise\x7e\x00' + ''.join(encoded)    #a stray start byte: one bad frame, then resync on the first real one
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        source = SerialSource(os.ttyname(slave), ringSize=500, name='check')
+        start = time.time()
+        for i in range(0, len(data), 4000):
+            os.write(master, data[i:i + 4000])
+        while source.frames < len(frames) - len(bad) and time.time() - start < 10:
+            time.sleep(0.01)
+        elapsed = time.time() - start
+        good = [frame['rf_data'] for i, frame in enumerate(frames) if i not in bad]
+        kept = [source.read()['rf_data'] for i in range(len(source))]
+        assert source.frames == len(good) and source.checksumErrors == len(bad) + 3, (source.frames, source.checksumErrors)
+        assert kept == good[-500:], "ring should hold the newest 500 good frames in order"
+        assert source.dropped == len(good) - 500
+        assert metrics.PORT_LOST.value('check', 'checksum') == len(bad) + 3
+        assert metrics.PORT_LOST.value('check', 'ring_full') == source.dropped
+        assert metrics.PORT_OVERRUN_BYTES.value('check') == 0
+        print "%d frames split in %.2f s: %d bad checksums or lengths skipped, %d oldest dropped from the full ring, newest 500 kept in order" % (
+            source.frames, elapsed, source.checksumErrors, source.dropped)
+        source.close()
+        os.close(master)
+        os.close(slave)
+
+        #two fake coordinators read at once, the second by a consumer that stalls until its replay is over and more
+        #frames than its ring holds have arrived - frames and losses must be counted against the right port
+        import shutil
+        import tempfile
+        folder = tempfile.mkdtemp()
+        serials = sorted(sources)
+        specs = []
+        sent = []
+        for port, repeat in ((0, 10), (1, 40)):
+            own = serials[port::2]
+            captured = [(n * 0.001, bench_gateway.synthetic_frame(qube, sources[qube])) for n, qube in enumerate(own * repeat)]
+            save(os.path.join(folder, 'port%d.jsonl' % port), captured)
+            specs.append('pty:%s@0' % os.path.join(folder, 'port%d.jsonl' % port))
+            sent.append(len(captured))
+        ports = openSources(specs)
+        received = [[], []]
+        stalled = threading.Event()
+        def stall(frame):
+            stalled.wait()
+            received[1].append(frame)
+        readers = [ports[0].start(received[0].append), ports[1].start(stall)]
+        start = time.time()
+        while (len(received[0]) < sent[0] or ports[1].frames < sent[1]) and time.time() - start < 10:
+            time.sleep(0.01)
+        stalled.set()
+        while len(received[1]) < sent[1] - ports[1].dropped and time.time() - start < 10:
+            time.sleep(0.01)
+        for port, reader in zip(ports, readers):
+            port.close()
+            reader.join(2.0)
+        shutil.rmtree(folder)
+        assert len(received[0]) == sent[0] and ports[0].dropped == 0
+        assert metrics.PORT_FRAMES.value(specs[0]) == sent[0] and metrics.PORT_LOST.value(specs[0], 'ring_full') == 0
+        assert metrics.PORT_BYTES.value(specs[0]) == sum(len(frame['rf_data']) for frame in received[0])
+        assert sent[1] - RING_SIZE - 1 <= ports[1].dropped <= sent[1] - RING_SIZE    #a full ring, plus the frame the consumer holds
+        assert metrics.PORT_FRAMES.value(specs[1]) == len(received[1]) == sent[1] - ports[1].dropped
+        assert metrics.PORT_LOST.value(specs[1], 'ring_full') == ports[1].dropped
+        print "two pty ports: all %d frames of the first read, %d of %d on the stalled second (%d dropped from its ring), counted per port" % (
+            sent[0], len(received[1]), sent[1], ports[1].dropped)
+        sys.exit(0)
+
+    path = sys.argv[1]
+    minutes = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    ports = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    start = time.time()
+    offsets = dict((serial, random.uniform(0, REPORT_INTERVAL)) for serial in sources)
+    frames = []
+    for serial, offset in offsets.items():
+        stamp = offset
+        while stamp < minutes * 60:
+            frames.append((start + stamp, bench_gateway.synthetic_frame(serial, sources[serial])))
+            stamp += REPORT_INTERVAL
+    frames.sort(key=lambda item: item[0])
+    if ports == 1:
+        save(path, frames)
+        print len(frames), "frames from", len(sources), "Qubes over", minutes, "minutes written to", path
+    else:
+        serials = sorted(sources)
+        base, ext = os.path.splitext(path)
+        for port in range(ports):
+            own = set(serials[port::ports])
+            portPath = "%s-%d%s" % (base, port + 1, ext)
+            save(portPath, [(stamp, frame) for stamp, frame in frames if frame['source_addr_long'].encode('hex') in own])
+            print len(own), "Qubes over", minutes, "minutes written to", portPath
@@ -0,0 +1,129 @@
+#! /usr/bin/python
+
+# Logging set-up for the gateway scripts. The modules log through the standard logging module
+# (logging.getLogger(__name__)) with %-style arguments, so a message that is filtered out is never formatted.
+# Levels used across the gateway:
+#   DEBUG    per-frame detail (payloads, decoded and calibrated values, channel lookups)
+#   INFO     events - channels created, write keys fetched, startup summary
+#   WARNING  something didn't work but will be retried or skipped
+#   ERROR    a frame or upload was lost - also dumps the ring buffer
+# setup() sends records at the console level to stdout and keeps the most recent records at the ring
+# level (DEBUG) in memory. When an ERROR is logged the ring is written out first, so the lead-up to the
+# error is visible even though it was below the console level. DEBUG records are several per frame, so the
+# ring keeps at most debugRate of them a second - a busy minute can't push the warnings and events out.
+# Creating the DEBUG records costs about 0.1 ms a frame, nothing next to a fleet's few frames a second;
+# setup(ringLevel=logging.INFO) turns them off.
+# At run time: SIGUSR1 toggles the console between its level and DEBUG, SIGUSR2 dumps the ring.
+
+import sys
+import signal
+import logging
+import threading
+from collections import deque
+
+LEVEL = logging.INFO          #console level - per-frame DEBUG records go to the ring only
+RING_LEVEL = logging.DEBUG    #level kept in the ring buffer - the per-frame detail the console doesn't show
+RING_SIZE = 1000              #records kept in the ring buffer
+RING_DEBUG_RATE = 20          #DEBUG records kept in the ring per second, the rest are skipped (~1 min of them in a full ring)
+FORMAT = '%(asctime)s %(levelname)-7s %(threadName)s %(name)s: %(message)s'
+
+#keeps the last capacity records and writes them out when a record at dumpLevel arrives.
+#records are formatted only when dumped
+class RingHandler(logging.Handler):
+
+    def __init__(self, capacity=RING_SIZE, stream=None, dumpLevel=logging.ERROR, debugRate=RING_DEBUG_RATE):
+        logging.Handler.__init__(self)
+        self.records = deque(maxlen=capacity)
+        self.stream = stream
+        self.dumpLevel = dumpLevel
+        self.debugRate = debugRate
+        self.second = None    #second the DEBUG records are being counted for
+        self.debugs = 0
+        self.skipped = 0
+        self.dumps = 0
+
+    #called with the handler's lock held
+    def emit(self, record):
+        if record.levelno <= logging.DEBUG and self.debugRate is not None:
+            second = int(record.created)
+            if second != self.second:
+                self.second, self.debugs = second, 0
+            self.debugs += 1
+            if self.debugs > self.debugRate:
+                self.skipped += 1
+                return
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)    #don't hold on to tracebacks
+            record.exc_info = None
+        self.records.append(record)
+        if record.levelno >= self.dumpLevel:
+            self.dump()
+
+    #writes the buffered records, oldest first, and empties the ring
+    def dump(self, stream=None):
+        stream = stream or self.stream or sys.stderr
+        self.acquire()
+        try:
+            records = list(self.records)
+            self.records.clear()
+            skipped, self.skipped = self.skipped, 0
+            self.dumps += 1
+        finally:
+            self.release()
+        stream.write("---- last %d log records (%d DEBUG records skipped) ----\n" % (len(records), skipped))
+        for record in records:
+            try:
+                stream.write(self.format(record) + "\n")
+            except Exception:
+                stream.write("unformattable log record: %r %r\n" % (record.msg, record.args))
+        stream.write("---- end of log records ----\n")
+        stream.flush()
+
+console = None
+ring = None
+lock = threading.Lock()
+consoleLevel = LEVEL
+
+#configures the root logger: console handler at level, ring buffer at ringLevel. Returns the ring handler
+def setup(level=LEVEL, ringLevel=RING_LEVEL, ringSize=RING_SIZE, stream=None):
+    global console, ring, consoleLevel
+    root = logging.getLogger()
+    with lock:
+        for handler in (console, ring):
+            if handler is not None:
+                root.removeHandler(handler)
+        formatter = logging.Formatter(FORMAT)
+        console = logging.StreamHandler(stream or sys.stdout)
+        console.setFormatter(formatter)
+        ring = RingHandler(ringSize)
+        ring.setFormatter(formatter)
+        ring.setLevel(ringLevel)
+        root.addHandler(console)
+        root.addHandler(ring)
+        consoleLevel = level
+    setLevel(level)
+    return ring
+
+#changes the console level at run time. The logger itself only lets through what some handler wants
+def setLevel(level):
+    if isinstance(level, basestring):
+        level = logging.getLevelName(level.upper())
+    with lock:
+        console.setLevel(level)
+        logging.getLogger().setLevel(min(level, ring.level))
+
+def currentLevel():
+    return console.level
+
+def dump(stream=None):
+    ring.dump(stream)
+
+#SIGUSR1 toggles DEBUG on the console, SIGUSR2 dumps the ring to stderr. Must be called from the main thread
+def installSignals():
+    def toggle(signum, frame):
+        setLevel(consoleLevel if currentLevel() == logging.DEBUG else logging.DEBUG)
+        logging.getLogger(__name__).warning("console log level now %s", logging.getLevelName(currentLevel()))
+    def dumpRing(signum, frame):
+        dump()
+    signal.signal(signal.SIGUSR1, toggle)
+    signal.signal(signal.SIGUSR2, dumpRing)
@@ -0,0 +1,189 @@
+#! /usr/bin/python
+
+# Recent readings kept in memory, so local consumers can look at them without going back to Thingspeak.
+# Each Qube has a Series: a ring of its last capacity calibrated readings, stored by column - one
+# array('d') of arrival times and one per reading field (the names in schemas.py, e.g. floatTemp).
+# Appending overwrites the oldest slot; queries copy the matching slots out with array slicing.
+# Memory is allocated up front and never grows: 8 bytes x capacity x (fields + 1) per Qube, so the
+# default 2880 readings (24 h at 30 s) of a 3-field Qube take 92 kB, about 8 MB for 84 Qubes. At most
+# max_sources Qubes are kept, so corrupted or spoofed serials can't grow it without bound: a new one
+# replaces the Qube heard from least recently.
+# Query results are array('d') columns; numpy.frombuffer(column) views one as a NumPy array without a copy.
+# usage: python history.py   fills a history from synthetic readings, checks the queries and times them
+
+import time
+import bisect
+import threading
+from array import array
+
+CAPACITY = 2880    #readings kept per Qube - 24 h at one reading every 30 s
+MAX_SOURCES = 1024    #Qubes kept (~90 MB at the default capacity)
+
+class Series(object):
+
+    def __init__(self, sensortype, names, capacity=CAPACITY):
+        self.sensortype = sensortype
+        self.names = tuple(names)
+        self.capacity = capacity
+        self.stamps = array('d', [0.0]) * capacity
+        self.columns = [array('d', [0.0]) * capacity for name in self.names]
+        self.next = 0     #slot the next reading goes into
+        self.count = 0
+        self.updated = 0.0    #arrival time of the last reading appended
+        self.lock = threading.Lock()
+
+    def append(self, stamp, values):
+        with self.lock:
+            i = self.next
+            self.stamps[i] = stamp
+            for column, value in zip(self.columns, values):
+                column[i] = value
+            self.next = (i + 1) % self.capacity
+            self.updated = stamp
+            if self.count < self.capacity:
+                self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    #slot of the n-th oldest reading
+    def slot(self, n):
+        return (self.next - self.count + n) % self.capacity
+
+    #arrival time of the n-th oldest reading, for bisect
+    def __getitem__(self, n):
+        return self.stamps[self.slot(n)]
+
+    #the oldest-first readings n to count as (stamps, {name: values}). Caller holds the lock
+    def copy(self, n):
+        first, last = self.slot(n), self.next
+        def part(column):
+            if n >= self.count:
+                return array('d')
+            if first < last:
+                return column[first:last]
+            return column[first:] + column[:last]    #wrapped around the end of the ring
+        return part(self.stamps), dict(zip(self.names, [part(column) for column in self.columns]))
+
+    #(stamp, {name: value}) of the newest reading, None if there is none
+    def latest(self):
+        with self.lock:
+            if not self.count:
+                return None
+            i = (self.next - 1) % self.capacity
+            return self.stamps[i], dict((name, column[i]) for name, column in zip(self.names, self.columns))
+
+    #readings that arrived at or after start
+    def since(self, start):
+        with self.lock:
+            return self.copy(bisect.bisect_left(self, start, 0, self.count))
+
+    #the newest n readings
+    def last(self, n):
+        with self.lock:
+            return self.copy(max(self.count - n, 0))
+
+    def memory(self):
+        return self.stamps.itemsize * self.capacity * (len(self.columns) + 1)
+
+class History(object):
+
+    def __init__(self, capacity=CAPACITY, max_sources=MAX_SOURCES):
+        self.capacity = capacity
+        self.max_sources = max_sources
+        self.lock = threading.Lock()
+        self.series = {}    #source -> Series
+        self.evicted = 0
+
+    #stores a calibrated reading (a schema's Reading namedtuple) from source
+    def record(self, source, schema, reading, stamp=None):
+        if stamp is None:
+            stamp = time.time()
+        series = self.series.get(source)
+        if series is None or series.sensortype != schema.typeid:
+            with self.lock:
+                series = self.series.get(source)
+                if series is None or series.sensortype != schema.typeid:
+                    if series is None and len(self.series) >= self.max_sources:
+                        del self.series[min(self.series, key=lambda known: self.series[known].updated)]    #only on a new source
+                        self.evicted += 1
+                    series = self.series[source] = Series(schema.typeid, schema.names, self.capacity)
+        series.append(stamp, reading)
+
+    def get(self, source):
+        return self.series.get(source)
+
+    def sources(self):
+        with self.lock:
+            return sorted(self.series)
+
+    def latest(self, source):
+        series = self.series.get(source)
+        return series.latest() if series is not None else None
+
+    #readings from the last minutes minutes
+    def recent(self, source, minutes, now=None):
+        series = self.series.get(source)
+        if series is None:
+            return None
+        return series.since((time.time() if now is None else now) - minutes * 60.0)
+
+    def memory(self):
+        with self.lock:
+            return sum(series.memory() for series in self.series.values())
+
+if __name__ == '__main__':
+    import random
+    import schemas
+    import bench_gateway
+
+    random.seed(1)
+    sources = bench_gateway.fleet()
+    history = History(capacity=100)
+    begin = 1600000000.0
+    kept = {}
+    for n in range(250):    #wraps each ring twice and a half
+        for serial, sensortype in sorted(sources.items()):
+            schema = schemas.SCHEMAS[sensortype]
+            reading = schema.decode(bench_gateway.synthetic_frame(serial, sensortype)['rf_data'])
+            stamp = begin + 30 * n
+            history.record(serial, schema, reading, stamp)
+            kept.setdefault(serial, []).append((stamp, reading))
+
+    for serial in sources:
+        expected = kept[serial][-100:]
+        stamp, values = history.latest(serial)
+        assert (stamp, values) == (expected[-1][0], expected[-1][1]._asdict())
+        stamps, columns = history.recent(serial, 10, now=begin + 30 * 249)
+        assert list(stamps) == [s for s, r in expected if s >= begin + 30 * 249 - 600] and len(stamps) == 21
+        stamps, columns = history.get(serial).last(100)
+        assert list(stamps) == [s for s, r in expected]
+        for name in columns:
+            assert list(columns[name]) == [getattr(r, name) for s, r in expected]
+        assert len(history.get(serial).last(500)[0]) == 100 and len(history.get(serial).since(begin * 2)[0]) == 0
+    print "queries match for %d Qubes, %d kB for %d readings each" % (len(sources), history.memory() // 1024, 100)
+
+    small = History(capacity=10, max_sources=10)
+    order = sorted(sources)
+    for n, serial in enumerate(order * 2):    #every Qube twice, so each new one replaces one heard from earlier
+        schema = schemas.SCHEMAS[sources[serial]]
+        small.record(serial, schema, schema.decode(bench_gateway.synthetic_frame(serial, schema.typeid)['rf_data']), begin + n)
+    assert small.sources() == sorted(order[-10:]) and small.evicted == 2 * len(order) - 10
+
+    full = History()
+    series = [(serial, schemas.SCHEMAS[sensortype]) for serial, sensortype in sorted(sources.items())]
+    readings = dict((serial, schema.decode(bench_gateway.synthetic_frame(serial, schema.typeid)['rf_data'])) for serial, schema in series)
+    start = time.time()
+    for n in range(CAPACITY):
+        for serial, schema in series:
+            full.record(serial, schema, readings[serial], begin + 30 * n)
+    elapsed = time.time() - start
+    print "%.1f us per append, %.1f MB for %d Qubes at %d readings" % (
+        elapsed / (CAPACITY * len(series)) * 1e6, full.memory() / 1e6, len(series), CAPACITY)
+    now = begin + 30 * CAPACITY
+    for minutes in (10, 60, 24 * 60):
+        start = time.time()
+        for r in range(10):
+            for serial, schema in series:
+                full.recent(serial, minutes, now)
+        print "last %4d minutes: %.1f us per query" % (minutes, (time.time() - start) / (10 * len(series)) * 1e6)
@@ -0,0 +1,87 @@
+#! /usr/bin/python
+
+# Write-behind store for Thingspeak write keys (writeKeys.json).
+# Behaves like the dict it replaces, but only writes the file when an entry is added
+# or changed. Changes made in quick succession are coalesced into a single write
+# `delay` seconds after the first one, and the file is replaced atomically
+# (temp file + rename) so a power cut never leaves a half-written key list.
+# Entries must be replaced, not mutated in place, for a change to be noticed.
+
+import os
+import json
+import threading
+
+class KeyStore(dict):
+
+    def __init__(self, path='writeKeys.json', delay=2.0):
+        dict.__init__(self)
+        self.path = path
+        self.delay = delay
+        self.lock = threading.RLock()
+        self.writeLock = threading.Lock()    #one write of the file at a time, in the order the snapshots were taken
+        self.dirty = False
+        self.timer = None
+        self.writes = 0
+        if os.path.isfile(path):
+            with open(path) as infile:
+                dict.update(self, json.load(infile))
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key in self and dict.__getitem__(self, key) == value:
+                return
+            dict.__setitem__(self, key, value)
+            self.changed()
+        if self.delay is None:
+            self.flush()    #outside the lock - flush takes the write lock first
+
+    def __delitem__(self, key):
+        with self.lock:
+            dict.__delitem__(self, key)
+            self.changed()
+        if self.delay is None:
+            self.flush()
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, value=None):
+        with self.lock:
+            if key not in self:
+                self[key] = value
+            return dict.__getitem__(self, key)
+
+    #marks the store dirty and schedules a flush unless one is already pending (with a delay). Caller holds the lock
+    def changed(self):
+        self.dirty = True
+        if self.delay is not None and self.timer is None:
+            self.timer = threading.Timer(self.delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    #writes the file now if anything changed since the last write. A flush from the timer and one from close()
+    #can run at once: the write lock keeps an older snapshot from being renamed over a newer one
+    def flush(self):
+        with self.writeLock:
+            with self.lock:
+                self.timer = None
+                if not self.dirty:
+                    return False
+                data = dict(self)
+                self.dirty = False
+            temp = self.path + '.tmp'
+            with open(temp, 'w') as outfile:
+                json.dump(data, outfile, indent=4)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.rename(temp, self.path)
+            self.writes += 1
+            return True
+
+    #cancels a pending delayed write and writes immediately - call before exiting
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+        self.flush()
@@ -1,8 +1,7 @@
 #!/bin/sh
 # launcher.sh
-# navigate to home directory, then to this directory, then execute python script, then back home
-cd /
-cd home/pi/zigb2net/
-sudo python ZigB2Netv4.py
-cd /
-
+# run the gateway from its own directory (local json files, spool and calibration csv live next to the script)
+# exec replaces the shell so the gateway receives signals directly - sudo relays SIGTERM and SIGINT to it,
+# and both run the gateway's clean shutdown (remaining readings spooled, connections closed)
+cd "$(dirname "$0")"
+exec sudo python ZigB2Netv5.3.py
@@ -0,0 +1,196 @@
+#! /usr/bin/python
+
+# Gateway instrumentation, exposed in the Prometheus text format on a local HTTP endpoint.
+# Recording is a lock, a bisect and an increment, and gauges such as queue depth are only read when
+# something scrapes /metrics, so the frame path pays almost nothing when nobody is looking.
+#   STAGE_SECONDS    per-frame latency histogram for each pipeline stage:
+#                    queue (frame received until a worker takes it), decode, calibrate, aggregate (folding into a window), spool,
+#                    resolve (channel and write key lookup), upload (HTTP request to Thingspeak),
+#                    sink_<name> (one batch written by an output sink, see sinks.py)
+#   FRAMES           frames received per sensor type, FRAMES_DROPPED per reason (duplicate, queue_full, unknown_type, error)
+#   UPLOADS          Thingspeak uploads by kind (bulk/single) and result (success/failure), UPLOADS_MERGED
+#                    readings folded into a pending single update by the rate-limit scheduler
+#   QUEUE_DEPTH      frames waiting for a worker, read at scrape time
+#   PORT_*           frames, payload bytes and lost frames per serial port (one per XBee coordinator) - rate() of
+#                    PORT_FRAMES/PORT_BYTES is each radio's throughput, PORT_RING_DEPTH frames waiting per port,
+#                    PORT_OVERRUN_BYTES bytes (not frames) the UART dropped - the frames they belonged to show up as checksum losses
+#   SINK_READINGS    readings written, dropped (queue full) or failed per output sink, SINK_QUEUE_DEPTH per sink
+# usage: metrics.serve(('127.0.0.1', 9108)), then curl http://127.0.0.1:9108/metrics
+
+import time
+import bisect
+import threading
+import BaseHTTPServer
+import SocketServer
+
+#latency buckets in seconds - 100 us to 30 s
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def labelText(names, values, extra=()):
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter(object):
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labelvalues):
+        self.add(1, *labelvalues)
+
+    def add(self, amount, *labelvalues):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues):
+        return self.values.get(labelvalues, 0)
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return [(self.name, labelText(self.labelnames, labels), value) for labels, value in values]
+
+#a value set directly, or read from a function when scraped
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=()):
+        Counter.__init__(self, name, help, labelnames)
+        self.functions = {}
+
+    def set(self, value, *labelvalues):
+        with self.lock:
+            self.values[labelvalues] = value
+
+    def track(self, function, *labelvalues):
+        self.functions[labelvalues] = function
+
+    def samples(self):
+        for labels, function in self.functions.items():
+            try:
+                self.set(function(), *labels)
+            except Exception:
+                pass
+        return Counter.samples(self)
+
+class Histogram(object):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}    #labels -> [per-bucket counts (last one is +Inf), sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labelvalues)
+            if series is None:
+                series = self.series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    #observes the time since start (a time.time() value) and returns now, for timing consecutive stages
+    def since(self, start, *labelvalues):
+        now = time.time()
+        self.observe(now - start, *labelvalues)
+        return now
+
+    def count(self, *labelvalues):
+        series = self.series.get(labelvalues)
+        return series[2] if series else 0
+
+    def samples(self):
+        with self.lock:
+            series = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count) in self.series.items())
+        samples = []
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                samples.append((self.name + '_bucket', labelText(self.labelnames, labels, [('le', number(bound))]), cumulative))
+            samples.append((self.name + '_sum', labelText(self.labelnames, labels), total))
+            samples.append((self.name + '_count', labelText(self.labelnames, labels), count))
+        return samples
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    #all metrics in the Prometheus text exposition format
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, labels, number(value)))
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram('gateway_stage_seconds', 'Time spent per frame in each pipeline stage', ('stage',)))
+FRAMES = REGISTRY.register(Counter('gateway_frames_total', 'Frames received per sensor type', ('sensortype',)))
+FRAMES_DROPPED = REGISTRY.register(Counter('gateway_frames_dropped_total', 'Frames dropped before processing', ('reason',)))
+UPLOADS = REGISTRY.register(Counter('gateway_uploads_total', 'Thingspeak upload requests', ('kind', 'result')))
+UPLOADED_READINGS = REGISTRY.register(Counter('gateway_uploaded_readings_total', 'Readings accepted by Thingspeak'))
+UPLOADS_MERGED = REGISTRY.register(Counter('gateway_uploads_merged_total', 'Readings merged into a channel update still waiting for its rate limit'))
+QUEUE_DEPTH = REGISTRY.register(Gauge('gateway_queue_depth', 'Frames waiting for a worker'))
+PORT_FRAMES = REGISTRY.register(Counter('gateway_port_frames_total', 'Frames read per serial port or frame source', ('port',)))
+PORT_BYTES = REGISTRY.register(Counter('gateway_port_bytes_total', 'Payload bytes read per serial port or frame source', ('port',)))
+PORT_LOST = REGISTRY.register(Counter('gateway_port_frames_lost_total', 'Frames lost per serial port by reason (checksum/ring_full/read_error/queue_full/duplicate)', ('port', 'reason')))
+PORT_OVERRUN_BYTES = REGISTRY.register(Counter('gateway_port_overrun_bytes_total', 'Bytes lost to UART and tty buffer overruns per serial port', ('port',)))
+PORT_RING_DEPTH = REGISTRY.register(Gauge('gateway_port_ring_depth', 'Frames received on a serial port waiting in its ring', ('port',)))
+SINK_READINGS = REGISTRY.register(Counter('gateway_sink_readings_total', 'Readings per output sink by result (written/dropped/failed)', ('sink', 'result')))
+SINK_QUEUE_DEPTH = REGISTRY.register(Gauge('gateway_sink_queue_depth', 'Readings waiting per output sink', ('sink',)))
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+#serves /metrics on a daemon thread, returns the server (shutdown() stops it)
+def serve(address=('127.0.0.1', 9108), registry=REGISTRY):
+    server = MetricsServer(address, MetricsHandler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
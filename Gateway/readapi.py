@@ -0,0 +1,177 @@
+#! /usr/bin/python
+
+# Local HTTP/JSON API serving the readings the gateway has just calibrated, from its in-memory history
+# (history.py), so dashboards on the building network don't have to poll Thingspeak for them.
+#   GET /latest                 newest reading of every Qube
+#   GET /latest?type=1          newest reading of every Qube of one sensor type
+#   GET /latest/<source>        newest reading of one Qube
+#   GET /recent/<source>?minutes=10   every reading of one Qube from the last minutes (default 10)
+#   GET /types                  sensor types with their description, Thingspeak field labels and Qube count
+# A reading is {"source", "channel" (Thingspeak channel ID from channelList.json, null until the channel
+# exists), "sensortype", "description", "time" (arrival, Unix seconds), "values" (by reading name, e.g.
+# floatTemp), "fields" (as uploaded to the channel, field1...)}.
+# Each request runs on its own thread and only holds a Qube's history lock while its values are copied,
+# so slow or numerous clients never hold up the frame path.
+# usage: readapi.serve(('127.0.0.1', 9109), history, channelRegistry.lookup), then curl http://127.0.0.1:9109/latest
+
+import json
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+import schemas
+
+#reading dict for the newest reading of source, None if there is none
+def latest(server, source, series):
+    newest = series.latest()
+    if newest is None:
+        return None
+    stamp, values = newest
+    schema = schemas.SCHEMAS.get(series.sensortype)
+    reading = {'source': source, 'channel': server.channel(source), 'sensortype': series.sensortype,
+               'description': schema.description if schema else None, 'time': stamp, 'values': values}
+    if schema is not None:
+        reading['fields'] = dict((field, values[schema.names[i]]) for field, i in zip(schema.uploadNames, schema.upload))
+    return reading
+
+class ReadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        parts = [part for part in url.path.split('/') if part]
+        history = self.server.history
+        try:
+            if parts == ['latest']:
+                sensortype = query.get('type', [None])[0]
+                readings = []
+                for source in history.sources():
+                    series = history.get(source)
+                    if sensortype is None or series.sensortype == sensortype:
+                        reading = latest(self.server, source, series)
+                        if reading is not None:
+                            readings.append(reading)
+                self.reply(200, {'readings': readings})
+            elif len(parts) == 2 and parts[0] == 'latest':
+                series = history.get(parts[1])
+                reading = latest(self.server, parts[1], series) if series is not None else None
+                if reading is None:
+                    self.reply(404, {'error': 'no readings from %s' % parts[1]})
+                else:
+                    self.reply(200, reading)
+            elif len(parts) == 2 and parts[0] == 'recent':
+                minutes = float(query.get('minutes', ['10'])[0])
+                series = history.get(parts[1])
+                if series is None:
+                    self.reply(404, {'error': 'no readings from %s' % parts[1]})
+                    return
+                stamps, columns = history.recent(parts[1], minutes)
+                self.reply(200, {'source': parts[1], 'channel': self.server.channel(parts[1]), 'sensortype': series.sensortype,
+                                 'time': stamps.tolist(), 'values': dict((name, column.tolist()) for name, column in columns.items())})
+            elif parts == ['types']:
+                counts = {}
+                for source in history.sources():
+                    sensortype = history.get(source).sensortype
+                    counts[sensortype] = counts.get(sensortype, 0) + 1
+                self.reply(200, dict((typeid, {'description': schema.description, 'fields': schema.channelFields(),
+                                               'sources': counts.get(typeid, 0)})
+                                     for typeid, schema in schemas.SCHEMAS.items()))
+            else:
+                self.reply(404, {'error': 'unknown path %s' % url.path})
+        except ValueError as e:
+            self.reply(400, {'error': str(e)})
+
+    def reply(self, status, data):
+        body = json.dumps(data)    #sort_keys would switch to the pure-Python encoder, several times slower
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")    #dashboards are served from elsewhere on the network
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class ReadServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 64    #clients connecting at once before the kernel refuses them
+
+#serves the API on a daemon thread, returns the server (shutdown() stops it).
+#channel(source) gives the Thingspeak channel ID of a Qube from memory, or None
+def serve(address, history, channel=lambda source: None):
+    server = ReadServer(address, ReadHandler)
+    server.history = history
+    server.channel = channel
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+if __name__ == '__main__':
+    import time
+    import random
+    import urllib2
+    import history as recent
+    import bench_gateway
+
+    random.seed(1)
+    sources = bench_gateway.fleet()
+    readings = recent.History(capacity=120)
+    server = serve(('127.0.0.1', 0), readings, lambda source: 1000 + sorted(sources).index(source))
+    url = 'http://127.0.0.1:%d' % server.server_port
+
+    #keep appending readings as the workers would while clients query
+    running = [True]
+    appended = [0]
+    def feed():
+        while running[0]:
+            for serial, sensortype in sources.items():
+                schema = schemas.SCHEMAS[sensortype]
+                readings.record(serial, schema, schema.decode(bench_gateway.synthetic_frame(serial, sensortype)['rf_data']))
+                appended[0] += 1
+            time.sleep(0.01)    #~7000 readings/s, far more than any Qube fleet sends
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    time.sleep(0.2)
+
+    everything = json.load(urllib2.urlopen(url + '/latest'))['readings']
+    assert len(everything) == len(sources)
+    thl = json.load(urllib2.urlopen(url + '/latest?type=1'))['readings']
+    assert thl and all(r['sensortype'] == '1' and len(r['fields']) == 3 for r in thl)
+    one = json.load(urllib2.urlopen(url + '/latest/' + thl[0]['source']))
+    assert one['channel'] == thl[0]['channel'] and set(one['values']) == set(['floatTemp', 'floatHum', 'intLight'])
+    series = json.load(urllib2.urlopen(url + '/recent/' + thl[0]['source'] + '?minutes=1'))
+    assert len(series['time']) == len(series['values']['floatTemp']) > 0
+    try:
+        urllib2.urlopen(url + '/latest/nosuchqube')
+        assert False
+    except urllib2.HTTPError as e:
+        assert e.code == 404
+
+    #many clients at once
+    clients = 50
+    requests = 20
+    failures = []
+    def client():
+        for i in range(requests):
+            try:
+                json.load(urllib2.urlopen(url + '/latest'))
+            except Exception as e:
+                failures.append(e)
+    before = appended[0]
+    start = time.time()
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    running[0] = False
+    feeder.join()
+    assert not failures, failures[:3]
+    print "%d clients x %d requests for all %d Qubes: %.0f requests/s, %d readings appended meanwhile" % (
+        clients, requests, len(sources), clients * requests / elapsed, appended[0] - before)
+    server.shutdown()
@@ -0,0 +1,251 @@
+#! /usr/bin/python
+
+# Rate-limited dispatch of single channel updates to Thingspeak.
+# Thingspeak rejects a channel update that arrives sooner than its rate limit after the previous one
+# (15 s on a free account), so a burst of readings from one Qube would mostly be sent only to fail.
+# Instead each channel has a token bucket and at most one pending update: a reading for a channel that
+# already has one waiting is merged into it (newer field values win), and the pending update is sent
+# as soon as the channel's bucket has a token. A fixed number of sender threads caps the requests in
+# flight. A failed update goes back to wait for the channel's next token, merged under anything newer,
+# so a reading is only ever replaced by a newer one and never simply dropped.
+# The buckets and the cap on requests in flight live in a RateLimiter, which the gateway shares between
+# this scheduler, the bulk upload buffer and the spool drainer - the limit is per channel, however its
+# updates are sent.
+
+import time
+import logging
+import threading
+import Queue
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+UPDATE_INTERVAL = 15.0    #seconds between updates of one channel that Thingspeak accepts (1 s with a paid licence)
+
+#refills at rate tokens per second up to burst
+class TokenBucket(object):
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst=1, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.time() if now is None else now
+
+    def refill(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    #takes a token if one is available
+    def take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    #seconds until a token is available
+    def delay(self, now):
+        self.refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    #empties the bucket, e.g. when the server says the last request came too soon
+    def drain(self, now):
+        self.refill(now)
+        self.tokens = min(self.tokens, 0.0)
+
+#a token bucket per channel, plus a cap on requests in flight across every channel (use as: with limiter.slots)
+class RateLimiter(object):
+
+    def __init__(self, interval=UPDATE_INTERVAL, burst=1, concurrency=2):
+        self.rate = 1.0 / interval
+        self.burst = burst
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.buckets = {}    #channelID -> TokenBucket
+        self.slots = threading.BoundedSemaphore(concurrency)
+
+    #caller holds the lock
+    def bucket(self, channelID, now):
+        bucket = self.buckets.get(channelID)
+        if bucket is None:
+            bucket = self.buckets[channelID] = TokenBucket(self.rate, self.burst, now)
+        return bucket
+
+    #takes a token for channelID if it may be updated now
+    def take(self, channelID, now=None):
+        with self.lock:
+            now = time.time() if now is None else now
+            return self.bucket(channelID, now).take(now)
+
+    #seconds until channelID may be updated
+    def delay(self, channelID, now=None):
+        with self.lock:
+            now = time.time() if now is None else now
+            return self.bucket(channelID, now).delay(now)
+
+    #changes every channel's interval, e.g. for a server with a different rate limit - buckets start over full
+    def setInterval(self, interval):
+        with self.lock:
+            self.rate = 1.0 / interval
+            self.buckets.clear()
+
+    #makes channelID wait a whole interval, e.g. after Thingspeak refused an update for coming too soon
+    def drain(self, channelID, now=None):
+        with self.lock:
+            now = time.time() if now is None else now
+            self.bucket(channelID, now).drain(now)
+
+class UploadScheduler(object):
+
+    #send(channelID, writeKey, fields, stamp) performs one update and returns True if Thingspeak accepted it
+    def __init__(self, send, interval=UPDATE_INTERVAL, burst=1, concurrency=2, limiter=None):
+        self.send = send
+        self.limiter = limiter if limiter is not None else RateLimiter(interval, burst, concurrency)
+        self.concurrency = concurrency
+        self.lock = threading.Condition(threading.Lock())
+        self.pending = {}    #channelID -> [writeKey, fields, stamp]
+        self.inflight = set()
+        self.ready = Queue.Queue()
+        self.threads = []
+        self.running = False
+        self.merged = 0
+
+    #queues one update, merging it into the channel's pending update if there is one
+    def submit(self, channelID, writeKey, fields, stamp=None):
+        if stamp is None:
+            stamp = time.time()
+        with self.lock:
+            entry = self.pending.get(channelID)
+            if entry is None:
+                self.pending[channelID] = [writeKey, dict(fields), stamp]
+            else:
+                entry[0] = writeKey
+                entry[1].update(fields)
+                entry[2] = max(entry[2], stamp)
+                self.merged += 1
+                metrics.UPLOADS_MERGED.inc()
+            self.lock.notify()
+
+    #hands every pending update whose bucket has a token to the senders, while fewer than concurrency are in flight.
+    #returns seconds until the next update could be due. Caller holds the lock
+    def dispatch(self, now):
+        wait = None
+        for channelID in list(self.pending):
+            if channelID in self.inflight:
+                continue
+            if len(self.inflight) >= self.concurrency:
+                return None    #woken when a request finishes
+            if self.limiter.take(channelID, now):
+                self.inflight.add(channelID)
+                self.ready.put((channelID,) + tuple(self.pending.pop(channelID)))
+            else:
+                delay = self.limiter.delay(channelID, now)
+                wait = delay if wait is None else min(wait, delay)
+        return wait
+
+    def run(self):
+        with self.lock:
+            while self.running:
+                wait = self.dispatch(time.time())
+                self.lock.wait(wait)
+
+    def sender(self):
+        while True:
+            item = self.ready.get()
+            if item is None:
+                return
+            channelID, writeKey, fields, stamp = item
+            try:
+                with self.limiter.slots:
+                    ok = self.send(channelID, writeKey, fields, stamp)
+            except Exception:
+                log.exception("error uploading to channel %s", channelID)
+                ok = False
+            with self.lock:
+                self.inflight.discard(channelID)
+                if not ok:
+                    self.limiter.drain(channelID)    #wait a whole interval before retrying
+                    newer = self.pending.get(channelID)
+                    if newer is not None:
+                        fields.update(newer[1])
+                        writeKey, stamp = newer[0], max(stamp, newer[2])
+                    self.pending[channelID] = [writeKey, fields, stamp]
+                self.lock.notify()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending) + len(self.inflight)
+
+    def start(self):
+        self.running = True
+        self.threads = [threading.Thread(target=self.run)]
+        self.threads += [threading.Thread(target=self.sender) for i in range(self.concurrency)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self, timeout=5.0):
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+        for thread in self.threads[1:]:
+            self.ready.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+        if self.pending:
+            log.warning("%d channel updates still waiting for their rate limit at shutdown", len(self.pending))
+
+if __name__ == '__main__':
+    import random
+
+    #a stub Thingspeak that enforces the rate limit: one update per channel per interval
+    interval = 0.2
+    lock = threading.Lock()
+    last = {}
+    accepted = []
+    rejected = []
+    active = [0, 0]    #requests in flight now, most at once
+    def send(channelID, writeKey, fields, stamp):
+        with lock:
+            active[0] += 1
+            active[1] = max(active)
+        time.sleep(0.01)
+        now = time.time()
+        with lock:
+            active[0] -= 1
+            if now - last.get(channelID, 0) < interval * 0.9:
+                rejected.append(channelID)
+                return False
+            last[channelID] = now
+            accepted.append((channelID, dict(fields)))
+            return True
+
+    random.seed(1)
+    scheduler = UploadScheduler(send, interval=interval, concurrency=3)
+    scheduler.start()
+    channels = range(20)
+    submitted = 0
+    latest = {}
+    start = time.time()
+    while time.time() - start < 2.0:
+        channelID = random.choice(channels)
+        submitted += 1
+        latest[channelID] = submitted
+        scheduler.submit(channelID, 'KEY', {'field1': submitted})
+        time.sleep(0.0005 if random.random() < 0.9 else 0.02)    #bursty
+    time.sleep(interval * 2)
+    scheduler.stop()
+
+    #nothing rejected for coming too soon, concurrency capped, and the last reading of every channel delivered
+    assert not rejected, "%d updates rejected" % len(rejected)
+    assert active[1] <= 3
+    delivered = {}
+    for channelID, fields in accepted:
+        delivered[channelID] = fields['field1']
+    assert delivered == latest
+    print "%d readings submitted in bursts to %d channels -> %d requests, %d merged, none rejected, at most %d in flight" % (
+        submitted, len(channels), len(accepted), scheduler.merged, active[1])
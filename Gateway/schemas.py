@@ -0,0 +1,221 @@
+#! /usr/bin/python
+
+# Sensor schema registry - one entry per Qube type, keyed by the type character that starts
+# every payload ("0".."5"). Each schema declares the payload fields and their parsers, the
+# calibration model for each field and the order/labels of the Thingspeak channel fields.
+# Everything is prepared once at import, so decoding a frame is a dict lookup, one split
+# and one parser call per field. Adding a type means registering one more schema.
+#
+# Qubes can also send a compact binary payload instead of ASCII CSV:
+#   byte 0     0x80 | sensor type   (ASCII payloads start with '0'..'9', so the first byte tells them apart)
+#   byte 1     layout version
+#   byte 2...  the payload fields, packed little-endian (AVR byte order) as declared in the schema's layouts
+# Binary payloads are decoded with struct.unpack_from straight out of the frame - no string parsing.
+
+import struct
+import logging
+from collections import namedtuple
+
+import calibration
+import voc
+
+log = logging.getLogger(__name__)
+
+#Thingspeak channel field labels
+TEMP = 'Dry Bulb Temperature - *C'
+HUM = 'Relative Humidity - %'
+LUX = 'Illuminance - Lux'
+TVOC = 'TVOC - ug/m3'
+PM2_5 = 'PM2.5 - ug/m3'
+PM10 = 'PM10 - ug/m3'
+CO2 = 'CO2 - ppm'
+NO2 = 'NO2 - ppm'
+
+#calibration models: ('linear', slope, intercept, ndigits) -> round(x*slope+intercept, ndigits)
+#                    ('power', A, B, ndigits)              -> round(A*pow(x,B), ndigits)
+LINEAR = 'linear'
+POWER = 'power'
+BINARY = 0x80    #set in the first byte of binary payloads
+VOC_TABLE = False    #convert Rs/Ro through voc.TVOCTable instead of evaluating the curve - see voc.py for the accuracy bound
+
+uncalibrated = set()    #sources already warned about missing calibration data
+
+COEFFICIENT = dict((name, i) for i, name in enumerate(calibration.Coefficients._fields))
+
+#payload parsers - int() and float() ignore surrounding whitespace and newlines themselves
+
+#Rs/Ro ratio from the TGS2602 to TVOC concentration
+if VOC_TABLE:
+    tvoc = voc.TVOCTable()
+else:
+    tvoc = voc.TVOCcalc
+
+#Lux reading, the light sensor reports darkness as NaN
+def lux(s):
+    try:
+        return int(s)
+    except ValueError:
+        if s.strip() == "NaN":
+            return 0
+        raise
+
+#integer if the Qube sent one, otherwise float
+def number(s):
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
+
+#binary field converters - the Qubes send fixed point integers
+
+#Rs/Ro ratio x1000 to TVOC concentration
+def tvocMilli(raw):
+    return tvoc(raw / 1000.0)
+
+#hundredths to float
+def centi(raw):
+    return raw / 100.0
+
+#Lux reading, darkness sent as 0xFFFF
+def luxRaw(raw):
+    if raw == 0xFFFF:
+        return 0
+    return raw
+
+class SensorSchema(object):
+
+    #payload: [(name, parser), ...] in the order the Qube sends them (after the type character)
+    #upload:  [(name, channel field label), ...] in Thingspeak field1, field2... order
+    #models:  {name: calibration model} for the fields that are calibrated
+    #layouts: {version: [(struct format character, converter or None), ...]} binary layouts, fields in payload order
+    #calibrate: optional hook(store, source, reading) -> reading replacing the model-based calibration
+    def __init__(self, typeid, description, payload, upload, models=None, layouts=None, calibrate=None):
+        self.typeid = typeid
+        self.description = description
+        self.names = tuple(name for name, parser in payload)
+        self.parsers = tuple(parser for name, parser in payload)
+        self.width = len(payload) + 1
+        self.Reading = namedtuple('Reading' + typeid, self.names)
+        self.upload = tuple(self.names.index(name) for name, label in upload)
+        self.labels = tuple(label for name, label in upload)
+        self.uploadNames = tuple('field%d' % (i + 1) for i in range(len(upload)))
+        self.models = tuple((self.names.index(name), kind, COEFFICIENT[first], COEFFICIENT[second], ndigits)
+                            for name, (kind, first, second, ndigits) in sorted((models or {}).items()))
+        self.binaryType = chr(BINARY | int(typeid))
+        self.layouts = {}
+        for version, layout in (layouts or {}).items():
+            if len(layout) != len(self.names):
+                raise ValueError("type %s layout %d should have %d fields" % (typeid, version, len(self.names)))
+            self.layouts[version] = (struct.Struct('<' + ''.join(fmt for fmt, convert in layout)),
+                                     tuple(convert for fmt, convert in layout))
+        if calibrate is not None:
+            self.calibrate = calibrate
+
+    #splits and parses a payload like "1,45.20, 21.30,310" into a Reading namedtuple
+    def decode(self, payload):
+        if payload[:1] == self.binaryType:
+            return self.unpack(payload)
+        parts = payload.split(",")
+        if len(parts) != self.width:
+            raise ValueError("type %s payload should have %d values, got %r" % (self.typeid, self.width, payload))
+        return self.Reading._make([parse(part) for parse, part in zip(self.parsers, parts[1:])])
+
+    #decodes a binary payload with the layout for its version
+    def unpack(self, payload):
+        if len(payload) < 2 or ord(payload[1]) not in self.layouts:
+            raise ValueError("type %s has no binary layout for payload %r" % (self.typeid, payload))
+        layout, converters = self.layouts[ord(payload[1])]
+        if len(payload) != layout.size + 2:
+            raise ValueError("type %s binary payload should be %d bytes, got %d" % (self.typeid, layout.size + 2, len(payload)))
+        values = layout.unpack_from(memoryview(payload), 2)
+        return self.Reading._make([value if convert is None else convert(value)
+                                   for convert, value in zip(converters, values)])
+
+    #binary payload for a reading - the inverse of unpack, for test frames and tools
+    def pack(self, raw, version=1):
+        layout = self.layouts[version][0]
+        return self.binaryType + chr(version) + layout.pack(*raw)
+
+    #applies the calibration models with the Qube's coefficients. Readings from Qubes missing from the
+    #calibration file are returned uncalibrated
+    def calibrate(self, store, source, reading):
+        if not self.models:
+            return reading
+        record = store.coefficients(source)
+        if record is None:
+            if source not in uncalibrated:
+                uncalibrated.add(source)
+                log.warning("no calibration data for %s - uploading uncalibrated values", source)
+            return reading
+        values = list(reading)
+        for index, kind, first, second, ndigits in self.models:
+            if kind == LINEAR:
+                values[index] = round(values[index] * record[first] + record[second], ndigits)
+            else:
+                values[index] = round(record[first] * pow(values[index], record[second]), ndigits)
+        return self.Reading._make(values)
+
+    #Thingspeak update fields for a reading: {'field1': ..., 'field2': ...}
+    def fields(self, reading):
+        return dict(zip(self.uploadNames, [reading[i] for i in self.upload]))
+
+    #Thingspeak channel field labels for creating a channel: {'field1': label, ...}
+    def channelFields(self):
+        return dict(zip(self.uploadNames, self.labels))
+
+SCHEMAS = {}
+
+DECODERS = {}    #first payload byte -> schema, for ASCII and binary payloads
+
+def register(schema):
+    SCHEMAS[schema.typeid] = schema
+    DECODERS[schema.typeid] = schema
+    DECODERS[schema.binaryType] = schema
+    return schema
+
+#schema for a payload (or type character), None if the type isn't registered
+def lookup(payload):
+    return DECODERS.get(payload[:1])
+
+register(SensorSchema("0", "TVOC,PM2.5,PM10 Qube",
+                      [('floatTVOC', tvoc), ('intPM2_5', int), ('intPM10', int)],
+                      [('floatTVOC', TVOC), ('intPM2_5', PM2_5), ('intPM10', PM10)],
+                      {'floatTVOC': (LINEAR, 'VOC_Slope', 'VOC_Intercept', 2),
+                       'intPM2_5': (LINEAR, 'PM2_5_Slope', 'PM2_5_Intercept', 0),
+                       'intPM10': (LINEAR, 'PM10_Slope', 'PM10_Intercept', 0)},
+                      {1: [('H', tvocMilli), ('H', None), ('H', None)]}))
+
+register(SensorSchema("1", "THL Qube",
+                      [('floatHum', float), ('floatTemp', float), ('intLight', lux)],
+                      [('floatTemp', TEMP), ('floatHum', HUM), ('intLight', LUX)],
+                      {'floatTemp': (LINEAR, 'Temp_Slope', 'Temp_Intercept', 1),
+                       'floatHum': (LINEAR, 'Humid_Slope', 'Humid_Intercept', 1),
+                       'intLight': (LINEAR, 'Lux_Slope', 'Lux_Intercept', 0)},
+                      {1: [('h', centi), ('h', centi), ('H', luxRaw)]}))
+
+register(SensorSchema("2", "TVOC & Lux Qube",
+                      [('floatTVOC', tvoc), ('intLight', lux)],
+                      [('floatTVOC', TVOC), ('intLight', LUX)],
+                      {'floatTVOC': (LINEAR, 'VOC_Slope', 'VOC_Intercept', 2),
+                       'intLight': (LINEAR, 'Lux_Slope', 'Lux_Intercept', 0)},
+                      {1: [('H', tvocMilli), ('H', luxRaw)]}))
+
+register(SensorSchema("3", "CO2 Qube",
+                      [('intCO2', int)],
+                      [('intCO2', CO2)],
+                      {'intCO2': (POWER, 'CO2_A', 'CO2_B', 0)},
+                      {1: [('h', None)]}))
+
+register(SensorSchema("4", "PM, VOC & CO2 Qube",
+                      [('floatTVOC', tvoc), ('intPM2_5', int), ('intPM10', int), ('intCO2', int)],
+                      [('floatTVOC', TVOC), ('intPM2_5', PM2_5), ('intPM10', PM10), ('intCO2', CO2)],
+                      {'floatTVOC': (LINEAR, 'VOC_Slope', 'VOC_Intercept', 2),
+                       'intPM2_5': (LINEAR, 'PM2_5_Slope', 'PM2_5_Intercept', 0),
+                       'intPM10': (LINEAR, 'PM10_Slope', 'PM10_Intercept', 0),
+                       'intCO2': (POWER, 'CO2_A', 'CO2_B', 0)},
+                      {1: [('H', tvocMilli), ('H', None), ('H', None), ('h', None)]}))
+
+register(SensorSchema("5", "NO2,Temp & Hum Qube",
+                      [('intNO2', number), ('floatTemp', float), ('floatHum', float)],
+                      [('intNO2', NO2), ('floatTemp', TEMP), ('floatHum', HUM)],
+                      layouts={1: [('h', None), ('h', centi), ('h', centi)]}))
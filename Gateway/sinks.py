@@ -0,0 +1,372 @@
+#! /usr/bin/python
+
+# Output sinks - the destinations every calibrated reading is fanned out to.
+#   ThingspeakSink(deliver)         hands readings to the Thingspeak path (aggregation, upload) when the gateway
+#                                   has no spool - with one, readings are spooled on the worker thread instead
+#   MQTTSink(host, port)            publishes each reading as JSON to a local MQTT broker (needs paho-mqtt)
+#   FileSink(folder)                appends readings to gzip-compressed CSV files, a new file every
+#                                   rotate seconds, oldest removed beyond keep files
+# Every sink has its own bounded queue and worker thread. put() never blocks: when a sink's queue is full
+# the reading is dropped for that sink only and counted, so a slow or failing destination can't hold up
+# the others, the workers or the serial reader. The worker takes everything waiting as one batch and
+# passes it to write(); an exception there is logged and counted against the whole batch, and the worker
+# carries on. A sink that can fail one reading at a time returns how many of the batch failed instead.
+# A new destination is a subclass of Sink with write(readings), plus open()/close() if it holds a connection.
+# usage: python sinks.py   fans synthetic readings out to a slow sink and a file sink and checks neither is held up,
+#                          then publishes to a local mosquitto if paho-mqtt is installed and a broker is listening
+
+import os
+import csv
+import json
+import glob
+import gzip
+import time
+import Queue
+import logging
+import threading
+
+import metrics
+import schemas
+
+log = logging.getLogger(__name__)
+
+QUEUE_SIZE = 10000    #readings waiting per sink before new ones are dropped for it
+FIELDS = ['field%d' % i for i in range(1, 9)]    #Thingspeak channels have up to 8 fields
+
+class Sink(object):
+
+    name = 'sink'
+
+    def __init__(self, size=QUEUE_SIZE):
+        self.queue = Queue.Queue(size)
+        self.thread = None
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        metrics.SINK_QUEUE_DEPTH.track(self.queue.qsize, self.name)
+
+    #queues one reading (its Thingspeak upload fields) - drops it if the sink is too far behind
+    def put(self, source, sensortype, fields, stamp):
+        try:
+            self.queue.put_nowait((source, sensortype, fields, stamp))
+        except Queue.Full:
+            self.dropped += 1
+            metrics.SINK_READINGS.inc(self.name, 'dropped')
+            if self.dropped & (self.dropped - 1) == 0:    #1st, 2nd, 4th, 8th... drop, not every one
+                log.warning("%s sink is not keeping up - %d readings dropped", self.name, self.dropped)
+
+    #writes a batch of (source, sensortype, fields, stamp) readings. Returns the number that failed, or None for none
+    def write(self, readings):
+        raise NotImplementedError
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def run(self):
+        try:
+            self.open()
+        except Exception:
+            log.exception("could not open %s sink", self.name)
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = None in batch
+            batch = [item for item in batch if item is not None]
+            if batch:
+                start = time.time()
+                try:
+                    failed = self.write(batch) or 0
+                    self.written += len(batch) - failed
+                    self.failed += failed
+                    metrics.SINK_READINGS.add(len(batch) - failed, self.name, 'written')
+                    metrics.SINK_READINGS.add(failed, self.name, 'failed')
+                except Exception:
+                    self.failed += len(batch)
+                    metrics.SINK_READINGS.add(len(batch), self.name, 'failed')
+                    log.exception("%s sink failed to write %d readings", self.name, len(batch))
+                metrics.STAGE_SECONDS.since(start, 'sink_' + self.name)
+            if stop:
+                break
+        try:
+            self.close()
+        except Exception:
+            log.exception("error closing %s sink", self.name)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=self.name + '-sink')
+        self.thread.daemon = True
+        self.thread.start()
+
+    #writes what is already queued, then stops
+    def stop(self, timeout=10.0):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+#the Thingspeak path: deliver(source, sensortype, fields, stamp) aggregates, spools or uploads one reading
+class ThingspeakSink(Sink):
+
+    name = 'thingspeak'
+
+    def __init__(self, deliver, size=QUEUE_SIZE):
+        Sink.__init__(self, size)
+        self.deliver = deliver
+
+    #each reading on its own, so one that can't be delivered doesn't take the rest of the batch with it
+    def write(self, readings):
+        failed = 0
+        for source, sensortype, fields, stamp in readings:
+            try:
+                self.deliver(source, sensortype, fields, stamp)
+            except Exception:
+                failed += 1
+                total = self.failed + failed
+                if total & (total - 1) == 0:    #1st, 2nd, 4th... failure, not every one
+                    log.exception("could not deliver reading from %s (%d failed so far)", source, total)
+        return failed
+
+#publishes {"source", "sensortype", "time", "fields", "labels"} to <prefix>/<sensortype>/<source>, retained so a new
+#subscriber gets every Qube's latest reading straight away. paho-mqtt reconnects in its own thread and, at qos 1 or 2,
+#buffers messages while the broker is away; at qos 0 a reading published while disconnected fails and is counted
+class MQTTSink(Sink):
+
+    name = 'mqtt'
+
+    def __init__(self, host='localhost', port=1883, prefix='qube', qos=0, size=QUEUE_SIZE, linger=5.0):
+        Sink.__init__(self, size)
+        import paho.mqtt.client as mqtt    #optional - only needed when this sink is used
+        self.mqtt = mqtt
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.qos = qos
+        self.linger = linger    #seconds close() waits for the broker to acknowledge what is still queued (qos 1 and 2)
+        self.client = mqtt.Client()
+        self.connected = threading.Event()
+        self.client.on_connect = lambda client, userdata, flags, rc: rc == 0 and self.connected.set()
+        self.unacked = []       #MQTTMessageInfo of qos 1 and 2 messages sent but not yet acknowledged
+
+    #connects in the background, waiting up to linger seconds so the first readings aren't published while disconnected
+    def open(self):
+        self.client.connect_async(self.host, self.port)
+        self.client.loop_start()
+        if not self.connected.wait(self.linger):
+            log.warning("mqtt broker %s:%s not connected yet - still trying", self.host, self.port)
+
+    def write(self, readings):
+        failed = 0
+        for source, sensortype, fields, stamp in readings:
+            schema = schemas.SCHEMAS.get(sensortype)
+            message = {'source': source, 'sensortype': sensortype, 'time': stamp, 'fields': fields,
+                       'labels': schema.channelFields() if schema else {}}
+            info = self.client.publish('%s/%s/%s' % (self.prefix, sensortype, source), json.dumps(message), self.qos, retain=True)
+            if info.rc == self.mqtt.MQTT_ERR_SUCCESS:
+                if self.qos:
+                    self.unacked.append(info)
+            elif not (self.qos and info.rc == self.mqtt.MQTT_ERR_NO_CONN):    #at qos 1 and 2 paho keeps it until it reconnects
+                failed += 1
+        if self.qos:
+            self.unacked = [info for info in self.unacked if not info.is_published()]
+        return failed
+
+    #waits (up to linger seconds) for queued messages to reach the broker - paho sends only a few at a time
+    #while it waits for their acknowledgements, and disconnecting drops the rest
+    def close(self):
+        deadline = time.time() + self.linger
+        while self.unacked and time.time() < deadline:
+            if self.unacked[0].is_published():
+                self.unacked.pop(0)
+            else:
+                time.sleep(0.01)
+        if self.unacked:
+            log.warning("mqtt broker has not acknowledged %d readings - they are lost", len(self.unacked))
+        self.client.disconnect()
+        self.client.loop_stop()
+
+#gzip-compressed CSV - columns time, source, sensortype, field1..field8 (see /types on the read API for what the
+#fields of each type are). Each file covers rotate seconds and is named readings-YYYYMMDD-HHMM.csv.gz (UTC start)
+class FileSink(Sink):
+
+    name = 'file'
+
+    def __init__(self, folder='readings', rotate=3600, keep=24 * 14, size=QUEUE_SIZE):
+        Sink.__init__(self, size)
+        self.folder = folder
+        self.rotate = rotate
+        self.keep = keep
+        self.file = None
+        self.writer = None
+        self.period = None
+
+    def path(self, period):
+        return os.path.join(self.folder, time.strftime("readings-%Y%m%d-%H%M.csv.gz", time.gmtime(period)))
+
+    #switches to the file for the period stamp falls in, removing the oldest files beyond keep
+    def select(self, stamp):
+        period = stamp - stamp % self.rotate
+        if period == self.period:
+            return
+        self.close()
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        path = self.path(period)
+        new = not os.path.exists(path)
+        self.file = gzip.open(path, 'ab')    #a restart within the period appends another gzip member
+        self.writer = csv.writer(self.file)
+        if new:
+            self.writer.writerow(['time', 'source', 'sensortype'] + FIELDS)
+        self.period = period
+        for old in sorted(glob.glob(os.path.join(self.folder, 'readings-*.csv.gz')))[:-self.keep]:
+            os.remove(old)
+
+    def write(self, readings):
+        for source, sensortype, fields, stamp in readings:
+            self.select(stamp)
+            self.writer.writerow(['%.3f' % stamp, source, sensortype] + [fields.get(field, '') for field in FIELDS])
+        self.file.flush()    #a sync flush per batch, so a crash loses at most the batch being written
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.period = None
+
+#fans readings out to several sinks
+class Fanout(object):
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    def put(self, source, sensortype, fields, stamp):
+        for sink in self.sinks:
+            sink.put(source, sensortype, fields, stamp)
+
+    def start(self):
+        for sink in self.sinks:
+            sink.start()
+
+    def stop(self):
+        for sink in self.sinks:
+            sink.stop()
+
+if __name__ == '__main__':
+    import shutil
+    import random
+    import tempfile
+    import bench_gateway
+
+    class SlowSink(Sink):
+        name = 'slow'
+        def write(self, readings):
+            time.sleep(0.05 * len(readings))    #a destination that has stalled
+
+    logging.basicConfig(level=logging.ERROR)
+    random.seed(1)
+    sources = bench_gateway.fleet()
+    folder = tempfile.mkdtemp()
+    delivered = []
+    files = FileSink(folder, rotate=600, keep=3)
+    fanout = Fanout([ThingspeakSink(lambda *reading: delivered.append(reading)), SlowSink(size=100), files])
+    fanout.start()
+
+    count = 20000
+    serials = sorted(sources)
+    readings = []
+    begin = 1600000000.0
+    for n in range(count):
+        serial = random.choice(serials)
+        sensortype = sources[serial]
+        schema = schemas.SCHEMAS[sensortype]
+        readings.append((serial, sensortype, schema.fields(schema.decode(bench_gateway.synthetic_frame(serial, sensortype)['rf_data'])),
+                         begin + n * 0.2))    #4000 s of readings
+    start = time.time()
+    for reading in readings:
+        fanout.put(*reading)
+    put = time.time() - start
+    slow = fanout.sinks[1]
+    fanout.sinks[0].stop()
+    files.stop()
+    assert len(delivered) == count, "thingspeak sink lost readings"
+    assert slow.dropped > 0 and slow.written + slow.queue.qsize() + slow.dropped <= count
+
+    #3 files kept of the 8 periods, each complete
+    names = sorted(os.listdir(folder))
+    assert len(names) == 3, names
+    rows = [row for name in names for row in csv.reader(gzip.open(os.path.join(folder, name)))]
+    assert rows.count(['time', 'source', 'sensortype'] + FIELDS) == 3
+    periods = sorted(set(reading[3] - reading[3] % 600 for reading in readings))
+    assert len(rows) - 3 == sum(1 for reading in readings if reading[3] >= periods[-3])
+    print "%d readings put in %.2f s (%.1f us each) - thingspeak sink got all of them, file sink wrote %d, the stalled sink dropped %d" % (
+        count, put, put / count * 1e6, files.written, slow.dropped)
+    shutil.rmtree(folder)
+
+    #a reading the Thingspeak path can't deliver fails on its own
+    logging.getLogger().setLevel(logging.CRITICAL)
+    def deliver(source, sensortype, fields, stamp):
+        if source == serials[0]:
+            raise TypeError("no write key")
+        delivered.append(source)
+    del delivered[:]
+    thingspeak = ThingspeakSink(deliver)
+    thingspeak.start()
+    for reading in readings[:1000]:
+        thingspeak.put(*reading)
+    thingspeak.stop()
+    bad = sum(1 for reading in readings[:1000] if reading[0] == serials[0])
+    assert thingspeak.failed == bad and thingspeak.written == len(delivered) == 1000 - bad
+    print "thingspeak sink: %d readings written, %d failed on their own" % (thingspeak.written, thingspeak.failed)
+
+    #MQTT against a local broker (mosquitto) - skipped without paho-mqtt or a broker on localhost:1883
+    import socket
+    try:
+        import paho.mqtt.client as mqtt
+        socket.create_connection(('localhost', 1883), 1).close()
+    except ImportError:
+        print "MQTT check skipped - paho-mqtt is not installed"
+    except socket.error:
+        print "MQTT check skipped - no broker on localhost:1883"
+    else:
+        prefix = 'sinkscheck%d' % os.getpid()
+        received = {}
+        messages = []
+        subscribed = threading.Event()
+        def onMessage(client, userdata, message):
+            messages.append(message.topic)
+            received[message.topic] = json.loads(message.payload)
+        subscriber = mqtt.Client()
+        subscriber.on_message = onMessage
+        subscriber.on_subscribe = lambda *args: subscribed.set()
+        subscriber.connect('localhost', 1883)
+        subscriber.subscribe(prefix + '/#', 1)
+        subscriber.loop_start()
+        assert subscribed.wait(5), "no SUBACK from the broker"
+        sink = MQTTSink('localhost', 1883, prefix=prefix, qos=1)
+        sink.start()
+        latest = {}
+        for source, sensortype, fields, stamp in readings[:500]:
+            sink.put(source, sensortype, fields, stamp)
+            latest['%s/%s/%s' % (prefix, sensortype, source)] = stamp
+        sink.stop()
+        deadline = time.time() + 10
+        while len(messages) < 500 and time.time() < deadline:
+            time.sleep(0.05)
+        subscriber.disconnect()
+        subscriber.loop_stop()
+        assert sink.written == 500 and not sink.failed, (sink.written, sink.failed)
+        assert len(messages) == 500, "%d of 500 published readings arrived" % len(messages)
+        assert dict((topic, message['time']) for topic, message in received.items()) == latest
+        assert all(message['labels'] for message in received.values())
+        print "mqtt sink: 500 readings published to %d topics, all received" % len(latest)
+        cleanup = mqtt.Client()    #clears the retained test messages
+        cleanup.connect('localhost', 1883)
+        for topic in latest:
+            cleanup.publish(topic, '', 1, retain=True)
+        cleanup.disconnect()
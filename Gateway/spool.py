@@ -0,0 +1,301 @@
+#! /usr/bin/python
+
+# Store-and-forward spool for calibrated readings.
+# Every reading is appended to an SQLite database in the gateway directory before anything
+# is sent, so readings survive network outages and restarts. A background SpoolDrainer
+# replays the backlog per sensor, oldest first, through Thingspeak's bulk update endpoint
+# and deletes readings only once Thingspeak has accepted them. Readings are spooled as they
+# arrive; when the drainer is given aggregation windows it sends one update per closed window
+# (aggregate.windowRows) and leaves the readings of a window still open in the spool.
+
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+import aggregate
+import bulkupload
+import scheduler
+
+log = logging.getLogger(__name__)
+
+class Spool(object):
+
+    def __init__(self, path='spool.db', max_rows=500000, synchronous='FULL'):
+        self.path = path
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")              #appends don't block the drainer's reads
+        self.db.execute("PRAGMA synchronous=" + synchronous)    #FULL = every append is on disk before append() returns
+        self.db.execute("CREATE TABLE IF NOT EXISTS readings (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "stamp REAL, source TEXT, sensortype TEXT, fields TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS readings_source ON readings (source, id)")
+        self.db.commit()
+        self.count = self.db.execute("SELECT COUNT(*) FROM readings").fetchone()[0]
+        self.dropped = 0
+
+    #stores one reading; fields is a dict like {'field1': 21.5}. Once max_rows is reached the oldest readings are discarded
+    def append(self, source, sensortype, fields, stamp=None):
+        if stamp is None:
+            stamp = time.time()
+        with self.lock:
+            with self.db:
+                self.db.execute("INSERT INTO readings (stamp, source, sensortype, fields) VALUES (?, ?, ?, ?)",
+                                (stamp, source, sensortype, json.dumps(fields)))
+                self.count += 1
+                if self.count > self.max_rows:
+                    excess = self.count - self.max_rows + max(1, self.max_rows // 100)    #trim in chunks, not on every append
+                    self.db.execute("DELETE FROM readings WHERE id IN (SELECT id FROM readings ORDER BY id LIMIT ?)", (excess,))
+                    self.count -= excess
+                    self.dropped += excess
+        return True
+
+    #sources with readings waiting, with the number waiting and the time of the oldest one
+    def sources(self):
+        with self.lock:
+            return self.db.execute("SELECT source, COUNT(*), MIN(stamp) FROM readings GROUP BY source").fetchall()
+
+    #oldest readings for one source as a list of (id, stamp, sensortype, fields)
+    def peek(self, source, limit):
+        with self.lock:
+            rows = self.db.execute("SELECT id, stamp, sensortype, fields FROM readings WHERE source = ? ORDER BY id LIMIT ?",
+                                   (source, limit)).fetchall()
+        return [(rowid, stamp, sensortype, json.loads(fields)) for rowid, stamp, sensortype, fields in rows]
+
+    #removes readings that have been delivered
+    def ack(self, ids):
+        with self.lock:
+            with self.db:
+                deleted = 0
+                for i in range(0, len(ids), 500):    #stay under SQLite's bound variable limit
+                    chunk = ids[i:i + 500]
+                    deleted += self.db.execute("DELETE FROM readings WHERE id IN (%s)" % ",".join("?" * len(chunk)), chunk).rowcount
+                self.count -= deleted
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+#Replays the spool to Thingspeak. resolve(source, sensortype) must return (channelID, writeKey) or None if
+#the channel can't be resolved yet (readings for that source then stay in the spool).
+#A source is sent once min_batch readings are waiting or its oldest reading is max_age seconds old.
+#Each pass sends at most one bulk request per source, round-robin, and a channel is only sent to again
+#interval seconds after its previous request (Thingspeak's per-channel rate limit, kept in limiter - a
+#scheduler.RateLimiter the gateway shares with its other upload paths), so a backlog larger
+#than BULK_LIMIT goes out one request per channel per interval and no source waits behind another's backlog.
+#Only a transport failure or server error ends a pass early. A source whose update is refused (4xx) is
+#skipped and backs off on its own - retry_interval, doubling up to max_retry_interval - and on 401/403/404
+#forget(source) is called so its write key is looked up again before the next attempt.
+#windows ({sensortype: seconds}, as aggregate.WINDOWS) makes each update the mean of one window of readings.
+
+class SpoolDrainer(object):
+
+    def __init__(self, spool, pool, resolve, forget=None, min_batch=20, max_age=120.0, interval=scheduler.UPDATE_INTERVAL,
+                 retry_interval=30.0, max_retry_interval=900.0, limiter=None, windows=None, grace=aggregate.GRACE):
+        self.spool = spool
+        self.pool = pool
+        self.resolve = resolve
+        self.forget = forget
+        self.min_batch = min_batch
+        self.max_age = max_age
+        self.limiter = limiter if limiter is not None else scheduler.RateLimiter(interval)
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.windows = windows
+        self.grace = grace
+        self.backoff = {}    #source -> [time of the next attempt, seconds to wait after the next refusal]
+        self.wakeup = threading.Event()
+        self.running = False
+        self.thread = None
+        self.next = None     #seconds until a channel with readings left may be sent to again, after a pass
+        self.sent = 0
+        self.requests = 0
+        self.failures = 0
+        self.refused = 0
+
+    #a refused update: the source waits before its next attempt, longer each time
+    def refuse(self, source, status, now):
+        self.refused += 1
+        wait = self.backoff.get(source, [0, self.retry_interval])[1]
+        self.backoff[source] = [now + wait, min(wait * 2, self.max_retry_interval)]
+        log.warning("readings from %s refused (%s) - next attempt in %.0f s", source, status, wait)
+        if status in (401, 403, 404) and self.forget is not None:
+            self.forget(source)    #wrong or revoked write key, or deleted channel - look it up again
+
+    #sends one request for every source that is due, oldest readings first.
+    #Returns False if Thingspeak couldn't be reached or failed, which ends the pass
+    def drain(self, everything=False):
+        now = time.time()
+        self.next = None
+        for source, waiting, oldest in self.spool.sources():
+            if not (self.running or everything):
+                break
+            if not (everything or waiting >= self.min_batch or now - oldest >= self.max_age):
+                continue
+            if source in self.backoff and now < self.backoff[source][0]:
+                continue
+            rows = self.spool.peek(source, bulkupload.BULK_LIMIT)
+            if self.windows:
+                more = len(rows) == bulkupload.BULK_LIMIT
+                groups = aggregate.windowRows(rows, self.windows, float('inf') if everything else time.time(), self.grace, more)
+            else:
+                groups = [([rowid], sensortype, fields, stamp) for rowid, stamp, sensortype, fields in rows]
+            if not groups:
+                continue    #nothing yet but a window that is still open
+            try:
+                key = self.resolve(source, groups[0][1])
+            except Exception as e:
+                log.warning("could not resolve channel for %s: %s", source, e)
+                key = None
+            if key is None:
+                continue    #try this source again on the next pass
+            channelID, writeKey = key
+            ids = [rowid for group in groups for rowid in group[0]]
+            updates = []
+            for members, sensortype, fields, stamp in groups:
+                if fields:
+                    update = dict(fields)
+                    update['created_at'] = bulkupload.bulkStamp(stamp)
+                    updates.append(update)
+            if not updates:
+                self.spool.ack(ids)    #readings without any values
+                continue
+            if not self.limiter.take(channelID):
+                self.later(self.limiter.delay(channelID))
+                continue
+            self.requests += 1
+            with self.limiter.slots:
+                status = bulkupload.bulkSend(self.pool, channelID, writeKey, updates)
+            if status is None or status >= 500:
+                self.failures += 1
+                return False
+            if status not in bulkupload.ACCEPTED:
+                if status == 429:
+                    self.limiter.drain(channelID)    #too soon after another request
+                self.refuse(source, status, time.time())
+                continue
+            self.backoff.pop(source, None)
+            self.spool.ack(ids)
+            self.sent += len(ids)
+            if len(rows) == bulkupload.BULK_LIMIT:
+                self.later(self.limiter.delay(channelID))    #more of the backlog once the channel's interval has passed
+        return True
+
+    #notes that a source has more to send in delay seconds
+    def later(self, delay):
+        self.next = delay if self.next is None else min(self.next, delay)
+
+    #wakes the drainer early, e.g. after a new reading has been spooled
+    def notify(self):
+        self.wakeup.set()
+
+    def run(self, interval):
+        while self.running:
+            ok = self.drain()
+            wait = interval if ok else self.retry_interval
+            if ok and self.next is not None:
+                wait = min(wait, self.next)
+            self.wakeup.wait(wait)
+            self.wakeup.clear()
+
+    def start(self, interval=5.0):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=(interval,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+
+# test routine - spools a 24 hour backlog for 84 Qubes (30 s readings) and replays it to a stub Thingspeak server
+# that enforces a per-channel rate limit (scaled down from 15 s), refuses one channel and one stale write key
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import tempfile
+    import BaseHTTPServer
+    import SocketServer
+    import connpool
+
+    interval = 0.5
+    lock = threading.Lock()
+    last = {}
+    tooSoon = []
+    refusedKeys = []
+
+    class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            channel = self.path.split('/')[2]
+            now = time.time()
+            with lock:
+                if channel == 'qube000':
+                    status = 400
+                elif body['write_api_key'] != 'KEY':
+                    status = 401
+                    refusedKeys.append(channel)
+                elif now - last.get(channel, 0) < interval * 0.9:
+                    status = 429
+                    tooSoon.append(channel)
+                else:
+                    status = 202
+                    last[channel] = now
+            self.send_response(status)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write("{}")
+        def log_message(self, *args):
+            pass
+
+    class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    stub = threading.Thread(target=server.serve_forever)
+    stub.daemon = True
+    stub.start()
+
+    logging.basicConfig(level=logging.ERROR)
+    qubes = int(sys.argv[1]) if len(sys.argv) > 1 else 84
+    hours = float(sys.argv[2]) if len(sys.argv) > 2 else 24
+    path = os.path.join(tempfile.mkdtemp(), 'spool.db')
+    spool = Spool(path, synchronous='NORMAL')
+    start = time.time() - hours * 3600
+    readings = int(hours * 120)
+    with spool.db:    #bulk-load the backlog in one transaction - append() commits per reading
+        spool.db.executemany("INSERT INTO readings (stamp, source, sensortype, fields) VALUES (?, ?, ?, ?)",
+                             ((start + i * 30, "qube%03d" % q, "1", json.dumps({'field1': 21.5, 'field2': 45.0, 'field3': 300}))
+                              for i in range(readings) for q in range(qubes)))
+    spool.count = qubes * readings
+    print len(spool), "readings spooled,", os.path.getsize(path) / 1024, "kB"
+
+    keys = {'qube001': 'OLD'}    #a write key that has been regenerated on Thingspeak
+    pool = connpool.ConnectionPool("127.0.0.1:%d" % server.server_port)
+    drainer = SpoolDrainer(spool, pool, lambda source, sensortype: (source, keys.get(source, 'KEY')),
+                           lambda source: keys.pop(source, None),
+                           interval=interval, retry_interval=0.2)
+    begin = time.time()
+    while len(spool) > readings and time.time() - begin < 60:    #everything but the refused channel's backlog
+        assert drainer.drain(everything=True)
+        time.sleep(drainer.next if drainer.next is not None else 0.05)
+    elapsed = time.time() - begin
+    print drainer.sent, "readings replayed in", drainer.requests, "requests, %.1f s (%.0f readings/s), %d refused" % (
+        elapsed, drainer.sent / elapsed, drainer.refused)
+    print len(spool), "readings left"
+    assert not tooSoon, "%d requests came too soon for their channel" % len(tooSoon)
+    assert refusedKeys == ['qube001'] and 'qube001' not in keys
+    assert [(source, count) for source, count, oldest in spool.sources()] == [('qube000', readings)]
+    rounds = -(-readings // bulkupload.BULK_LIMIT)
+    print "at Thingspeak's %.0f s per channel: %d requests per channel, %.0f s apart" % (scheduler.UPDATE_INTERVAL, rounds,
+                                                                                         scheduler.UPDATE_INTERVAL)
+    pool.close()
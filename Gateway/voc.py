@@ -0,0 +1,127 @@
+#! /usr/bin/python
+
+# TVOC conversion for the TGS2602 Rs/Ro ratio sent by the VOC Qubes - the one implementation
+# shared by the gateway scripts.
+#   TVOCcalc(RsRo)        scalar, NH3 curve evaluated in Horner form
+#   TVOCTable()(RsRo)     precomputed table over the Rs/Ro range the firmware sends, linear interpolation
+#   TVOCbatch(RsRo)       NumPy version for reprocessing arrays of readings
+# All three return mg/m^3 rounded to 2 decimals, negative concentrations clamped to 0.
+# usage: python voc.py   checks the accuracy bounds against the original formula and times each path
+
+#Regressed sensitivity curves constants for Rs/Ro to ppm from sensor manufacturer's datasheet
+#C7H8Curve = [37.22590719,2.078062258]                      #TGS2602 (0.3;1)( 0.8;10) (0.4;30)
+#H2S_Curve = [0.05566582614,-2.954075758]                   #TGS2602 (0.8,0.1) (0.4,1) (0.25,3)
+#C2H5OH_Curve = [0.5409499131,-2.312489623]                 #TGS2602 (0.75,1) (0.3,10) (0.17,30)
+NH3_Curve = [1052.3,-3377.3,4031.2,-2103.9,374.82,22.863]   #Ammonia sensitivity curve, highest power first
+NH3_MMass = 17.03 #(g/mol)
+Mvolume = 22.414
+PPM_TO_MG = NH3_MMass / Mvolume    #concentration(mg/m3) = concentration(ppm) X ( molar mass(g/mol) / molar volume(L) )
+
+#Rs/Ro range and resolution of the firmware: Ro is the highest resistance seen, so Rs/Ro never exceeds 1,
+#and it is sent with 2 decimals (ASCII) or x1000 (binary payload)
+RSRO_MAX = 1.0
+RSRO_STEP = 0.001
+
+#largest difference between the table and the exact curve in mg/m^3, before rounding, for any Rs/Ro in range.
+#interpolation error is at most step^2/8 * max|f''| = 1e-6/8 * 4208 ppm * PPM_TO_MG ~ 4e-4 mg/m^3 - after
+#rounding a reading can differ by one in the last decimal, and only when it lies within that of a rounding boundary.
+#at the firmware's own resolution (multiples of RSRO_STEP) the table is exact
+TABLE_ERROR_BOUND = 5e-4
+
+a0, a1, a2, a3, a4, a5 = NH3_Curve
+
+#NH3 curve in ppm, Horner form - 5 multiplications, no pow()
+def ppm(x):
+    return ((((a0*x + a1)*x + a2)*x + a3)*x + a4)*x + a5
+
+#calculates VOC concentration based on RsRo ratio - see TGS2602 datasheet for details
+def TVOCcalc(RsRo):
+    tvoc = ppm(float(RsRo))
+    if tvoc < 0:
+        return 0.00
+    return round(tvoc*PPM_TO_MG, 2)
+
+#unrounded concentration, clamped at zero
+def concentration(x):
+    return max(ppm(x), 0.0)*PPM_TO_MG
+
+#lookup table over 0..RSRO_MAX in RSRO_STEP steps. Rs/Ro outside the table falls back to TVOCcalc
+class TVOCTable(object):
+
+    def __init__(self, step=RSRO_STEP, upper=RSRO_MAX):
+        self.size = int(round(upper/step))
+        self.scale = 1.0/step
+        self.upper = upper
+        self.table = [ppm(i*step)*PPM_TO_MG for i in range(self.size + 1)]    #unclamped, so the curve stays smooth across zero
+
+    def __call__(self, RsRo):
+        x = float(RsRo)
+        if x < 0 or x >= self.upper:
+            return TVOCcalc(x)
+        return round(self.interpolate(x), 2)
+
+    #unrounded concentration for 0 <= x < upper, clamped at zero
+    def interpolate(self, x):
+        pos = x*self.scale
+        i = min(int(pos), self.size - 1)
+        low = self.table[i]
+        return max(low + (self.table[i + 1] - low)*(pos - i), 0.0)
+
+#TVOC for an array of Rs/Ro ratios, rounded like TVOCcalc
+def TVOCbatch(RsRo):
+    import numpy as np
+    from batchcalibration import round_half_away
+    x = np.asarray(RsRo, dtype=float)
+    tvoc = np.polyval(NH3_Curve, x)
+    return round_half_away(np.maximum(tvoc, 0.0)*PPM_TO_MG, 2)
+
+#the conversion as it was written before this module - reference for the accuracy checks
+def reference(RsRo):
+    x = float(RsRo)
+    tvoc = ((NH3_Curve[0]*pow(x,5))+(NH3_Curve[1]*pow(x,4))+(NH3_Curve[2]*pow(x,3))+(NH3_Curve[3]*pow(x,2)+NH3_Curve[4]*x)+NH3_Curve[5])
+    if tvoc < 0:
+        return 0.00
+    return round(tvoc*(NH3_MMass/Mvolume),2)
+
+if __name__ == '__main__':
+    import random
+    import timeit
+
+    table = TVOCTable()
+    grid = [i*RSRO_STEP for i in range(table.size + 1)]
+    ascii = ['%d.%02d' % (i // 100, i % 100) for i in range(101)]
+    off = [random.uniform(0, RSRO_MAX) for i in range(200000)]
+
+    #Horner vs the original formula - same polynomial, may only differ by float noise at an exact .005 tie
+    horner = sum(1 for x in grid + off if TVOCcalc(x) != reference(x))
+    print "Horner differs from the original formula on %d of %d values" % (horner, len(grid) + len(off))
+    assert horner <= 1e-4*(len(grid) + len(off))
+
+    #table at the firmware's resolution and at random points in between
+    assert all(table(x) == TVOCcalc(x) for x in ascii + grid), "table not exact at firmware resolution"
+    worst = max(abs(table.interpolate(x) - concentration(x)) for x in off)
+    print "table max error between grid points %.2g mg/m^3 (bound %.2g)" % (worst, TABLE_ERROR_BOUND)
+    assert worst <= TABLE_ERROR_BOUND
+    assert all(abs(table(x) - reference(x)) <= 0.01 + 1e-9 for x in off)
+    assert table(1.5) == reference(1.5) and table(-0.1) == reference(-0.1)
+
+    try:
+        import numpy as np
+        batch = TVOCbatch(grid + off)
+        expected = np.array([reference(x) for x in grid + off])
+        mismatches = int(np.sum(batch != expected))
+        print "batch differs from the original formula on %d of %d values" % (mismatches, len(expected))
+        assert mismatches <= 1e-4*len(expected)
+    except ImportError:
+        np = None
+        print "numpy not installed - batch path not checked"
+    print "accuracy checks passed"
+
+    samples = ascii*10
+    for name, convert in [('original', reference), ('Horner', TVOCcalc), ('table', table)]:
+        best = min(timeit.repeat(lambda: [convert(x) for x in samples], number=100, repeat=3))
+        print "%-10s %.2f us per reading" % (name, best/(100*len(samples))*1e6)
+    if np is not None:
+        values = np.array(off)
+        best = min(timeit.repeat(lambda: TVOCbatch(values), number=5, repeat=3))
+        print "%-10s %.3f us per reading" % ('batch', best/(5*len(values))*1e6)
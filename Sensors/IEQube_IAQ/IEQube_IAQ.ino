@@ -18,6 +18,8 @@
                     down when low bit is negative - add 1 to high bit on negative low bits to correct.
   26/09/2016 - EW - Added CO2 sensor back into PM, VOC and Particulate routine.
   10/02/2017 - EW - VOC sensor cleanest air value Ro now written to EEPROM to survive power off
+  18/10/2026 - AG - Readings sent as a packed binary payload (see Gateway/schemas.py) - set BINARY_PAYLOAD to 0 to send
+                    the old ASCII string to gateways that haven't been updated. Type 4 only - other types send ASCII
 */
 
 #include <Arduino.h>
@@ -42,6 +44,8 @@
 #define SENSORTYPE 4                    //4 = TVOC,PM2.5,PM10,CO2; 3 = CO2; 2 = VOCL & Lux; 1 = Temp, Hum, Lux; 0 = TVOC,PM2.5,PM10
 #define LENGTH 32
 #define READ_DELAY (30000)              //delay between readings in milliseconds
+#define BINARY_PAYLOAD 1                //1 = packed binary payload (SENSORTYPE 4 only, others send ASCII), 0 = ASCII comma separated string
+#define PAYLOAD_VERSION 1               //binary layout version, must match a layout in Gateway/schemas.py
 
 /*-----( Declare Global Variables )-----*/
 //***************************VOC Sensor Variables*****************************
@@ -62,6 +66,17 @@ word PM10Value = 0;
 //used to hold results in 1 ASCII string for passing to Pi
 char buff[16];
 
+//binary payload - 0x80 | SENSORTYPE, layout version, then the readings little-endian (10 bytes instead of up to 21).
+//Laid out for SENSORTYPE 4 - the type 4 layout in Gateway/schemas.py
+struct __attribute__((packed)) Payload {
+  uint8_t type;
+  uint8_t version;
+  uint16_t rs_ro;         //Rs/Ro ratio x 1000
+  uint16_t pm2_5;
+  uint16_t pm10;
+  int16_t co2;            //-1 if the CO2 checksum failed
+} payload;
+
 /*Set the RX/TX pins*/
 SoftwareSerial xbnss(xbRX, xbTX);
 SoftwareSerial pmss(pmRX, pmTX);
@@ -147,12 +162,24 @@ void loop() {
   rs_ro = calcConcentration(vout, vcc);
   Serial.print("rs_ro = "); Serial.println(rs_ro);
 
-  /*uses sprintf to pass results to Xbee as a string in comma separated format described below)*/
   xbnss.listen();
+#if BINARY_PAYLOAD && SENSORTYPE == 4
+  /*packs the readings into the binary payload - AVR is little-endian so the struct goes out as is*/
+  payload.type = 0x80 | SENSORTYPE;
+  payload.version = PAYLOAD_VERSION;
+  payload.rs_ro = (uint16_t)(rs_ro * 1000 + 0.5);
+  payload.pm2_5 = PM2_5Value;
+  payload.pm10 = PM10Value;
+  payload.co2 = (int16_t)co2ppm;
+  /*Send the data and wait for response*/
+  ZBTxRequest zbtx = ZBTxRequest(Broadcast, (uint8_t *)&payload, sizeof(payload));
+#else
+  /*uses sprintf to pass results to Xbee as a string in comma separated format described below)*/
   sprintf(buff, "%d,%d.%d,%d,%d,%d", int(SENSORTYPE), int(rs_ro), frac(rs_ro), int(PM2_5Value), int(PM10Value), int(co2ppm));
   Serial.println(buff);
   /*Send the data and wait for response*/
   ZBTxRequest zbtx = ZBTxRequest(Broadcast, (uint8_t *)buff, strlen(buff));
+#endif
   xbee.send(zbtx);
   Serial.println("Packet Sent!");
   getDeliveryStatus();
@@ -433,4 +460,4 @@ char getCheckSum(char *packet)
   Serial.print("checkSum = ");
   Serial.println(checksum, DEC);
   return checksum;
-}
+}